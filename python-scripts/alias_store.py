@@ -0,0 +1,196 @@
+"""
+Alias database with an in-memory hash index and an append-only journal.
+
+`product_alias.csv` holds the compacted aliases. New and changed aliases are
+appended to `product_alias.journal` as JSON lines instead of rewriting the CSV,
+and the journal is folded back into the CSV once it grows past a threshold.
+Writers take an exclusive file lock, so concurrent /update-alias calls from
+any thread or worker process never lose each other's writes.
+"""
+
+import fcntl
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+import pandas as pd
+from matching_methods.normalize import normalize_key
+
+# Number of journal entries after which the journal is compacted into the CSV
+ALIAS_COMPACT_THRESHOLD = int(os.environ.get('ALIAS_COMPACT_THRESHOLD', '1000'))
+
+# Product ids pandas reads back from the CSV as numbers
+INTEGER_PATTERN = re.compile(r'[+-]?\d+')
+FLOAT_PATTERN = re.compile(r'[+-]?(\d+\.\d*|\.\d+|\d+)([eE][+-]?\d+)?')
+
+
+def get_file_signature(path: str):
+    """Return (mtime_ns, size) of a file, or None if it doesn't exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def csv_value(value):
+    """
+    Return `value` with the type pandas gives it when reading it back from the CSV,
+    e.g. the product_id "1002" posted as JSON is the number 1002, like in product_db.csv.
+    """
+    if not isinstance(value, str):
+        return value
+    text = value.strip()
+    if INTEGER_PATTERN.fullmatch(text):
+        return int(text)
+    if FLOAT_PATTERN.fullmatch(text):
+        return float(text)
+    return value
+
+
+class AliasStore:
+    """Keeps {alias_name: product_id} in memory, in sync with the CSV and journal on disk"""
+
+    def __init__(self, csv_path: str, journal_path: str = None, lock_path: str = None):
+        base_path = os.path.splitext(csv_path)[0]
+        self.csv_path = csv_path
+        self.journal_path = journal_path or base_path + '.journal'
+        self.lock_path = lock_path or base_path + '.lock'
+        self._aliases = {}
+        self._lookup = {}
+        self._csv_signature = None
+        self._journal_offset = 0
+        self._journal_entries = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def signature(self):
+        """Signature of the files backing the store, changes on every write"""
+        return (get_file_signature(self.csv_path), get_file_signature(self.journal_path))
+
+    def lookup_map(self) -> dict:
+        """
+        Return a copy of the {lowercase alias_name: product_id} map,
+        after catching up with writes made by other processes.
+        """
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            self._refresh()
+            return dict(self._lookup)
+
+    def aliases(self) -> list[tuple]:
+        """Return every (alias_name, product_id) pair, journal entries included"""
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            self._refresh()
+            return list(self._aliases.items())
+
+    def upsert(self, aliases: list[tuple]) -> int:
+        """
+        Add or update (alias_name, product_id) pairs.
+        Only new aliases and aliases pointing to a different product are written.
+        Returns the number of aliases written.
+        """
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+
+            changes = []
+            for alias_name, product_id in aliases:
+                # Journal entries get the type compaction would give them, so they match the catalog ids
+                product_id = csv_value(product_id)
+                if alias_name in self._aliases and self._aliases[alias_name] == product_id:
+                    continue
+                self._set(alias_name, product_id)
+                changes.append({'alias_name': alias_name, 'product_id': product_id})
+
+            if changes:
+                # Append the changes to the journal in one write
+                lines = ''.join(json.dumps(change, ensure_ascii=False) + '\n' for change in changes)
+                with open(self.journal_path, 'a', encoding='utf-8') as f:
+                    f.write(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self._journal_offset = f.tell()
+                self._journal_entries += len(changes)
+
+                if self._journal_entries >= ALIAS_COMPACT_THRESHOLD:
+                    self._compact()
+
+            return len(changes)
+
+    def compact(self):
+        """Fold the journal back into the CSV"""
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            self._compact()
+
+    @contextmanager
+    def _file_lock(self, operation: int):
+        """Hold a lock shared by every process using the same alias files"""
+        os.makedirs(os.path.dirname(self.lock_path) or '.', exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _set(self, alias_name, product_id):
+        self._aliases[alias_name] = product_id
+        # Keys of the lookup map are normalized like the item names looked up in it
+        self._lookup[normalize_key(str(alias_name))] = product_id
+
+    def _refresh(self):
+        """Load the CSV if it changed, then replay the journal entries not seen yet"""
+        csv_signature = get_file_signature(self.csv_path)
+        journal_size = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+        # Reload everything if another process compacted the journal
+        if not self._loaded or csv_signature != self._csv_signature or journal_size < self._journal_offset:
+            self._load_csv(csv_signature)
+        if journal_size > self._journal_offset:
+            self._replay_journal()
+
+    def _load_csv(self, csv_signature):
+        self._aliases = {}
+        self._lookup = {}
+        if csv_signature is not None:
+            print(f"Loading alias database from {self.csv_path}")
+            alias_df = pd.read_csv(self.csv_path)
+            for row in alias_df.to_dict(orient='records'):
+                self._set(row['alias_name'], row['product_id'])
+        else:
+            print(f"Alias database not found at {self.csv_path}")
+        self._csv_signature = csv_signature
+        self._journal_offset = 0
+        self._journal_entries = 0
+        self._loaded = True
+
+    def _replay_journal(self):
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._journal_offset)
+            data = f.read()
+        # Writers hold the lock, but never replay a line that isn't complete
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            # Entries written before the ids were typed may hold "1002" for 1002
+            self._set(entry['alias_name'], csv_value(entry['product_id']))
+            self._journal_entries += 1
+        self._journal_offset += end
+
+    def _compact(self):
+        """Rewrite the CSV from memory and truncate the journal. Caller holds the locks."""
+        print(f"Compacting alias journal into {self.csv_path}")
+        alias_df = pd.DataFrame(
+            {'alias_name': list(self._aliases.keys()), 'product_id': list(self._aliases.values())},
+            columns=['alias_name', 'product_id']
+        )
+        tmp_path = self.csv_path + '.tmp'
+        alias_df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, self.csv_path)
+        # Truncate the journal only once the CSV holds its entries
+        open(self.journal_path, 'w').close()
+        self._csv_signature = get_file_signature(self.csv_path)
+        self._journal_offset = 0
+        self._journal_entries = 0
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the product matching pipeline.
+
+Generates synthetic Chinese/English catalogs and invoices with controlled typo
+and alias rates, then measures basic_matching, fuzzy_matching, alias_match_item
+and the full /process-invoice path through the Flask test client. Everything
+runs offline. Each (catalog size, method) pair runs in its own process so the
+reported peak RSS belongs to that method only.
+
+Example:
+    python benchmark.py --catalog-sizes 1000 10000 --invoice-lines 1 50 500 --output results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Make the service modules importable when run from another directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+METHODS = ['alias', 'basic', 'fuzzy', 'process_invoice_basic', 'process_invoice_fuzzy']
+
+CHINESE_WORDS = [
+    '豬', '牛', '雞', '鴨', '魚', '蝦', '肉', '皮', '腿', '胸', '翅', '排', '絞', '里肌',
+    '高麗', '菜', '青江', '空心', '地瓜', '葉', '蘿蔔', '紅', '白', '黃', '綠', '蘋果', '香蕉',
+    '富士', '芭樂', '番茄', '洋蔥', '蒜', '薑', '蔥', '辣椒', '豆腐', '豆干', '香菇', '木耳',
+    '玉米', '筍', '冬瓜', '南瓜', '絲瓜', '茄子', '生菜', '芹菜', '韭菜', '花椰', '米', '麵',
+]
+ENGLISH_WORDS = [
+    'pork', 'beef', 'chicken', 'duck', 'fish', 'shrimp', 'belly', 'skin', 'leg', 'breast',
+    'wing', 'rib', 'minced', 'loin', 'cabbage', 'spinach', 'carrot', 'apple', 'banana',
+    'tomato', 'onion', 'garlic', 'ginger', 'tofu', 'mushroom', 'corn', 'pumpkin', 'lettuce',
+    'fresh', 'frozen', 'organic', 'large', 'small', 'sliced', 'whole', 'premium',
+]
+UNITS = ['斤', 'KG', '兩', '包', '盒', '箱', '顆', '把']
+CURRENCIES = ['TWD', 'USD']
+
+
+def generate_product_name(rng: random.Random) -> str:
+    """Build a Chinese, English or mixed product name, sometimes with separators"""
+    kind = rng.random()
+    if kind < 0.6:
+        name = ''.join(rng.choice(CHINESE_WORDS) for _ in range(rng.randint(2, 4)))
+    elif kind < 0.85:
+        name = ' '.join(rng.choice(ENGLISH_WORDS) for _ in range(rng.randint(1, 3))).title()
+    else:
+        name = ''.join(rng.choice(CHINESE_WORDS) for _ in range(2)) + ' ' + rng.choice(ENGLISH_WORDS)
+    extra = rng.random()
+    if extra < 0.1:
+        # Alternative names, e.g. "肉皮\\豬皮" or "廣東A/生菜葉"
+        name += rng.choice(['/', '\\']) + ''.join(rng.choice(CHINESE_WORDS) for _ in range(2))
+    elif extra < 0.15:
+        name += f"({rng.choice(ENGLISH_WORDS)})"
+    return name
+
+
+def generate_catalog(size: int, seed: int = 0) -> list[dict]:
+    """Generate `size` products with unique names"""
+    rng = random.Random(seed)
+    products = []
+    seen = set()
+    while len(products) < size:
+        name = generate_product_name(rng)
+        if name in seen:
+            # Disambiguate repeated names with a grade suffix
+            name = f"{name}{rng.choice('ABCDEFGH')}{len(products) % 97}"
+            if name in seen:
+                continue
+        seen.add(name)
+        products.append({
+            'product_id': f"P{len(products):07d}",
+            'product_name': name,
+            'unit': rng.choice(UNITS),
+            'currency': rng.choice(CURRENCIES),
+        })
+    return products
+
+
+def add_typo(name: str, rng: random.Random) -> str:
+    """Drop, duplicate, swap or replace one character, or add a stray space"""
+    if len(name) < 2:
+        return name
+    i = rng.randrange(len(name) - 1)
+    kind = rng.randrange(5)
+    if kind == 0:
+        return name[:i] + name[i + 1:]
+    if kind == 1:
+        return name[:i] + name[i] + name[i:]
+    if kind == 2:
+        return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+    if kind == 3:
+        return name[:i] + rng.choice(CHINESE_WORDS)[0] + name[i + 1:]
+    return name[:i] + ' ' + name[i:]
+
+
+def generate_aliases(catalog: list[dict], alias_rate: float, seed: int = 0) -> list[dict]:
+    """Create an alias for a share of the catalog, like the ones learned from manual corrections"""
+    rng = random.Random(seed + 1)
+    aliases = []
+    for product in catalog:
+        if rng.random() < alias_rate:
+            aliases.append({
+                'alias_name': add_typo(product['product_name'], rng) + rng.choice(['', '(散)', ' 特']),
+                'product_id': product['product_id'],
+            })
+    return aliases
+
+
+def generate_invoice(catalog: list[dict], aliases: list[dict], lines: int, typo_rate: float,
+                     alias_rate: float, seed: int = 0) -> dict:
+    """Generate an invoice whose item names are exact, misspelled or alias names"""
+    rng = random.Random(seed)
+    items = []
+    for _ in range(lines):
+        if aliases and rng.random() < alias_rate:
+            name = rng.choice(aliases)['alias_name']
+        else:
+            name = rng.choice(catalog)['product_name']
+            if rng.random() < typo_rate:
+                name = add_typo(name, rng)
+        quantity = rng.randint(1, 20)
+        unit_price = rng.randint(10, 500)
+        items.append({
+            'product_id': '',
+            'product_name': name,
+            'quantity': quantity,
+            'unit': rng.choice(UNITS),
+            'unit_price': unit_price,
+            'subtotal': quantity * unit_price,
+        })
+    return {
+        'invoice_number': f"BENCH{seed:06d}",
+        'invoice_date': '2025-01-01',
+        'vendor_name': 'Benchmark Vendor',
+        'currency': 'TWD',
+        'items': items,
+    }
+
+
+def write_shared_dir(shared_dir: str, catalog: list[dict], aliases: list[dict]):
+    """Write the catalog and aliases where CatalogStore expects them"""
+    import pandas as pd
+    os.makedirs(shared_dir, exist_ok=True)
+    pd.DataFrame(catalog, columns=['product_id', 'product_name', 'unit', 'currency']).to_csv(
+        os.path.join(shared_dir, 'product_db.csv'), index=False)
+    pd.DataFrame(aliases, columns=['alias_name', 'product_id']).to_csv(
+        os.path.join(shared_dir, 'product_alias.csv'), index=False)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Percentile with linear interpolation between closest ranks"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def setup_service(shared_dir: str):
+    """
+    Point the service at the synthetic databases and build the indexes up front,
+    like the gunicorn master does before fork. Returns the snapshot and a test client.
+    """
+    import product_matching
+    from catalog_store import CatalogStore
+    from match_memo import MatchMemo
+    product_matching.catalog_store = CatalogStore(shared_dir)
+    # Keep the synthetic results out of the service's match memo, its warm-up drops other versions
+    product_matching.match_memo = MatchMemo(os.path.join(shared_dir, 'match_memo.sqlite3'),
+                                            product_matching.match_memo.max_rows)
+    snapshot = product_matching.warm_up()
+    return snapshot, product_matching.app.test_client()
+
+
+def run_method(method: str, snapshot, client, invoices: list[dict], use_cache: bool) -> list[float]:
+    """Run `method` on every invoice and return the latency of each run in seconds"""
+    import contextlib
+    import copy
+    import product_matching
+
+    latencies = []
+    # Without caches, neither read nor write the match memo
+    with contextlib.nullcontext() if use_cache else product_matching.match_memo.suspended():
+        for invoice in invoices:
+            if not use_cache:
+                product_matching.match_cache.invalidate()
+                product_matching.response_cache.invalidate()
+            latencies.append(run_invoice(method, snapshot, client, copy.deepcopy(invoice)))
+    return latencies
+
+
+def run_invoice(method: str, snapshot, client, invoice: dict) -> float:
+    """Run `method` on one invoice and return its latency in seconds"""
+    from matching_methods import (alias_match_item, basic_matching, BasicMatchIndex,
+                                  fuzzy_matching, FuzzyMatchIndex)
+
+    start = time.perf_counter()
+    if method == 'alias':
+        for item in invoice['items']:
+            alias_match_item(item, snapshot.alias_map, snapshot.product_db)
+    elif method == 'basic':
+        basic_matching(invoice, snapshot.product_db, snapshot.get_index('basic', BasicMatchIndex))
+    elif method == 'fuzzy':
+        fuzzy_matching(invoice, snapshot.product_db, index=snapshot.get_index('fuzzy', FuzzyMatchIndex))
+    else:
+        match_method = method.rsplit('_', 1)[1]
+        response = client.post('/process-invoice', json={'invoice_data': invoice, 'match_method': match_method})
+        if response.status_code != 200:
+            raise RuntimeError(f"/process-invoice failed with status {response.status_code}")
+    return time.perf_counter() - start
+
+
+def benchmark_worker(queue, method: str, shared_dir: str, invoices_by_lines: dict, use_cache: bool):
+    """Child process entry point, reports its results and peak RSS through `queue`"""
+    try:
+        snapshot, client = setup_service(shared_dir)
+        results = []
+        for lines, invoices in invoices_by_lines.items():
+            latencies = run_method(method, snapshot, client, invoices, use_cache)
+            total_time = sum(latencies)
+            results.append({
+                'invoice_lines': lines,
+                'runs': len(latencies),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+                'invoices_per_second': round(len(latencies) / total_time, 2) if total_time else None,
+                'items_per_second': round(len(latencies) * lines / total_time, 1) if total_time else None,
+            })
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        queue.put({'results': results, 'peak_rss_mb': peak_rss_mb})
+    except Exception as e:
+        queue.put({'error': f"{type(e).__name__}: {e}"})
+
+
+def run_benchmarks(args) -> dict:
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {
+            'catalog_sizes': args.catalog_sizes,
+            'invoice_lines': args.invoice_lines,
+            'runs': args.runs,
+            'typo_rate': args.typo_rate,
+            'alias_rate': args.alias_rate,
+            'use_cache': args.use_cache,
+            'methods': args.methods,
+            'seed': args.seed,
+        },
+        'results': [],
+    }
+    context = multiprocessing.get_context('spawn')
+
+    for catalog_size in args.catalog_sizes:
+        work_dir = tempfile.mkdtemp(prefix='invoice-bench-')
+        try:
+            catalog = generate_catalog(catalog_size, args.seed)
+            aliases = generate_aliases(catalog, args.alias_rate, args.seed)
+            write_shared_dir(work_dir, catalog, aliases)
+            invoices_by_lines = {
+                lines: [generate_invoice(catalog, aliases, lines, args.typo_rate, args.alias_rate, args.seed + run)
+                        for run in range(args.runs)]
+                for lines in args.invoice_lines
+            }
+
+            for method in args.methods:
+                print(f"Benchmarking {method} on {catalog_size} products...", flush=True)
+                queue = context.Queue()
+                process = context.Process(target=benchmark_worker,
+                                          args=(queue, method, work_dir, invoices_by_lines, args.use_cache))
+                process.start()
+                outcome = queue.get()
+                process.join()
+                if 'error' in outcome:
+                    print(f"  failed: {outcome['error']}")
+                    report['results'].append({'method': method, 'catalog_size': catalog_size, 'error': outcome['error']})
+                    continue
+                for result in outcome['results']:
+                    result = {'method': method, 'catalog_size': catalog_size, **result,
+                              'peak_rss_mb': outcome['peak_rss_mb']}
+                    report['results'].append(result)
+                    print(f"  {result['invoice_lines']:>4} lines: p50 {result['p50_ms']:.2f} ms, "
+                          f"p95 {result['p95_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+                          f"{result['items_per_second']} items/s, peak RSS {result['peak_rss_mb']} MB")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the product matching pipeline")
+    parser.add_argument('--catalog-sizes', type=int, nargs='+', default=[1000, 10000, 50000, 200000],
+                        help="Number of products in each synthetic catalog")
+    parser.add_argument('--invoice-lines', type=int, nargs='+', default=[1, 50, 500],
+                        help="Number of items in each synthetic invoice")
+    parser.add_argument('--runs', type=int, default=5, help="Invoices timed per configuration")
+    parser.add_argument('--typo-rate', type=float, default=0.2, help="Share of item names with a typo")
+    parser.add_argument('--alias-rate', type=float, default=0.1,
+                        help="Share of products with an alias, and of item names using one")
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=METHODS)
+    parser.add_argument('--use-cache', action='store_true', help="Keep the match cache, match memo and response cache between runs")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Save the results as JSON to this path")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+Binary, memory-mapped snapshot of the product database and its matching indexes.
+
+`utils/excel_converter.py` writes `product_db.snapshot` next to `product_db.csv`.
+It holds the catalog columns, the name variant lookup used by basic matching and
+the normalized names and n-gram postings used by fuzzy matching, all as flat
+arrays. The service memory-maps the file instead of parsing the CSV and
+normalizing every name, so loading is near-instant, and every worker reads the
+same physical pages from the OS page cache.
+
+Layout: MAGIC, the header length (uint64), a JSON header describing each
+section, then the sections, each aligned to 8 bytes. Strings are stored as one
+UTF-8 blob plus int64 offsets.
+
+Run `python catalog_snapshot.py [product_db.csv]` to rebuild the snapshot of an
+existing CSV.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import numpy as np
+from matching_methods import ProductCatalog, BasicMatchIndex, FuzzyMatchIndex
+from matching_methods.ngram import NgramIndex
+
+MAGIC = b'INVCAT1\n'
+# Bump whenever the layout or the normalization of the stored names changes
+FORMAT_VERSION = 2
+ALIGNMENT = 8
+
+
+def get_snapshot_path(product_db_path: str) -> str:
+    """Path of the snapshot that belongs to a product_db.csv"""
+    return os.path.splitext(product_db_path)[0] + '.snapshot'
+
+
+def get_file_digest(path: str) -> dict:
+    """Size and SHA-256 of a file, used to tell whether a snapshot matches its CSV"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return {'size': os.path.getsize(path), 'sha256': digest.hexdigest()}
+
+
+def encode_key(value: str) -> bytes:
+    return value.encode('utf-8', 'surrogatepass')
+
+
+class StringColumn:
+    """Read-only sequence of values stored as a UTF-8 blob and offsets"""
+
+    __slots__ = ('_data', '_offsets', '_nulls', '_kind')
+
+    def __init__(self, data: memoryview, offsets: np.ndarray, nulls: np.ndarray = None, kind: str = 'str'):
+        self._data = data
+        self._offsets = offsets
+        # Rows holding NaN, the value pandas reads for an empty cell
+        self._nulls = nulls
+        # 'str' for text, 'json' for columns holding other values such as numbers
+        self._kind = kind
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def raw(self, i: int) -> bytes:
+        """The encoded value of row `i`"""
+        return bytes(self._data[self._offsets[i]:self._offsets[i + 1]])
+
+    def __getitem__(self, i: int):
+        if self._nulls is not None and self._nulls[i]:
+            return float('nan')
+        value = self.raw(i).decode('utf-8', 'surrogatepass')
+        return json.loads(value) if self._kind == 'json' else value
+
+
+class SortedStringMap:
+    """Read-only {str: int} map stored as sorted keys, looked up by binary search"""
+
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self, keys: StringColumn, values: np.ndarray):
+        self._keys = keys
+        self._values = values
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def position(self, key) -> int:
+        """Position of `key` in the sorted keys, or -1 if it isn't there"""
+        if not isinstance(key, str):
+            return -1
+        target = encode_key(key)
+        lo, hi = 0, len(self._keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._keys.raw(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._keys) and self._keys.raw(lo) == target:
+            return lo
+        return -1
+
+    def get(self, key, default=None):
+        i = self.position(key)
+        return int(self._values[i]) if i >= 0 else default
+
+    def __contains__(self, key) -> bool:
+        return self.position(key) >= 0
+
+
+class Postings:
+    """Read-only {str: array slice} map of CSR postings, e.g. n-gram -> product indices"""
+
+    __slots__ = ('_keys', '_offsets', '_arrays')
+
+    def __init__(self, keys: SortedStringMap, offsets: np.ndarray, arrays: tuple):
+        self._keys = keys
+        self._offsets = offsets
+        self._arrays = arrays
+
+    def get(self, key, default=None):
+        i = self._keys.position(key)
+        if i < 0:
+            return default
+        start, end = self._offsets[i], self._offsets[i + 1]
+        slices = tuple(array[start:end] for array in self._arrays)
+        return slices if len(slices) > 1 else slices[0]
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys
+
+
+class SnapshotWriter:
+    """Collects the sections of a snapshot and writes them to disk"""
+
+    def __init__(self):
+        self.sections = {}
+        self.blobs = []
+        self.size = 0
+
+    def add_bytes(self, name: str, data: bytes, dtype: str = 'bytes'):
+        padding = -self.size % ALIGNMENT
+        if padding:
+            self.blobs.append(b'\0' * padding)
+            self.size += padding
+        self.sections[name] = {'offset': self.size, 'length': len(data), 'dtype': dtype}
+        self.blobs.append(data)
+        self.size += len(data)
+
+    def add_array(self, name: str, array: np.ndarray):
+        array = np.ascontiguousarray(array)
+        self.add_bytes(name, array.tobytes(), array.dtype.str)
+
+    def add_strings(self, name: str, values) -> dict:
+        """Store a column of values, returning its description for the header"""
+        values = list(values)
+        kind = 'str'
+        nulls = np.zeros(len(values), dtype=np.uint8)
+        encoded = []
+        for i, value in enumerate(values):
+            if isinstance(value, float) and value != value:
+                nulls[i] = 1
+                encoded.append(b'')
+            elif isinstance(value, str):
+                encoded.append(encode_key(value))
+            else:
+                kind = 'json'
+                encoded.append(b'')
+        if kind == 'json':
+            # Mixed or non-text values keep their type through JSON
+            encoded = [json.dumps(value).encode('utf-8') if not nulls[i] else b''
+                       for i, value in enumerate(values)]
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        self.add_bytes(name + '.data', b''.join(encoded))
+        self.add_array(name + '.offsets', offsets)
+        has_nulls = bool(nulls.any())
+        if has_nulls:
+            self.add_array(name + '.nulls', nulls)
+        return {'kind': kind, 'nulls': has_nulls}
+
+    def add_map(self, name: str, mapping: dict):
+        """Store a {str: int} map as sorted keys and values"""
+        items = sorted(mapping.items(), key=lambda item: encode_key(item[0]))
+        self.add_strings(name + '.keys', [key for key, _ in items])
+        self.add_array(name + '.values', np.array([value for _, value in items], dtype=np.int64))
+
+    def add_postings(self, name: str, postings: dict, width: int = 1):
+        """Store {str: array, or tuple of `width` arrays} as sorted keys, offsets and concatenated arrays"""
+        keys = sorted(postings, key=encode_key)
+        self.add_map(name, {key: i for i, key in enumerate(keys)})
+        values = [postings[key] if isinstance(postings[key], tuple) else (postings[key],) for key in keys]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(value[0]) for value in values], out=offsets[1:])
+        self.add_array(name + '.offsets', offsets)
+        for j in range(width):
+            parts = [value[j] for value in values]
+            self.add_array(f'{name}.{j}', np.concatenate(parts) if parts else np.zeros(0, dtype=np.int32))
+
+    def write(self, path: str, header: dict):
+        header = {**header, 'sections': self.sections}
+        header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        prefix = MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes
+        prefix += b'\0' * (-len(prefix) % ALIGNMENT)
+        # Write to a new file and swap it in, the old one may still be mapped
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(prefix)
+            for blob in self.blobs:
+                f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+def write_snapshot(product_db_path: str, snapshot_path: str = None, catalog: ProductCatalog = None,
+                   source: dict = None) -> str:
+    """
+    Build the snapshot of a product_db.csv.
+    The CSV is parsed exactly like the service parses it, so the snapshot holds the same values.
+    Pass `catalog` and `source` to snapshot a catalog that doesn't come from a CSV, e.g. the
+    product database, `source` is what load_snapshot checks the snapshot against.
+    Returns the path of the snapshot.
+    """
+    snapshot_path = snapshot_path or get_snapshot_path(product_db_path)
+    if catalog is None:
+        catalog = ProductCatalog.from_csv(product_db_path)
+        source = get_file_digest(product_db_path)
+    basic_index = BasicMatchIndex(catalog)
+    fuzzy_index = FuzzyMatchIndex(catalog)
+    ngram_index = fuzzy_index.ngram_index
+
+    writer = SnapshotWriter()
+    columns = {}
+    columns['product_id'] = writer.add_strings('column.product_id', catalog.product_ids)
+    columns['product_name'] = writer.add_strings('column.product_name', catalog.product_names)
+    columns['unit'] = writer.add_strings('column.unit', catalog.units)
+    columns['currency'] = writer.add_strings('column.currency', catalog.currencies)
+    for name, values in catalog.extra_columns.items():
+        columns[name] = writer.add_strings(f'column.{name}', values)
+    # Text product_ids are looked up through a sorted map instead of a dict
+    id_map = columns['product_id']['kind'] == 'str' and not columns['product_id']['nulls']
+    if id_map:
+        writer.add_map('product_id_index', catalog._id_index)
+
+    writer.add_map('basic.product_map', basic_index.product_map)
+    writer.add_array('fuzzy.rows', fuzzy_index.rows)
+    writer.add_strings('fuzzy.choices', fuzzy_index.choices)
+    writer.add_array('ngram.lengths', ngram_index.lengths)
+    writer.add_array('ngram.spaces', ngram_index.spaces)
+    writer.add_postings('ngram.char_postings', ngram_index.char_postings, width=2)
+    writer.add_postings('ngram.gram_postings', ngram_index.gram_postings)
+
+    writer.write(snapshot_path, {
+        'format': FORMAT_VERSION,
+        'source': source,
+        'rows': len(catalog),
+        'columns': list(catalog.columns),
+        'column_types': columns,
+        'product_id_index': id_map,
+        'ngram_n': ngram_index.n,
+    })
+    return snapshot_path
+
+
+class SnapshotReader:
+    """Memory-maps a snapshot file and gives access to its sections"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        header_length = struct.unpack_from('<Q', self.mm, len(MAGIC))[0]
+        header_start = len(MAGIC) + 8
+        self.header = json.loads(self.mm[header_start:header_start + header_length].decode('utf-8'))
+        header_end = header_start + header_length
+        self.data_start = header_end + (-header_end % ALIGNMENT)
+        self.view = memoryview(self.mm)
+
+    def has(self, name: str) -> bool:
+        return name in self.header['sections']
+
+    def bytes(self, name: str) -> memoryview:
+        section = self.header['sections'][name]
+        start = self.data_start + section['offset']
+        return self.view[start:start + section['length']]
+
+    def array(self, name: str) -> np.ndarray:
+        section = self.header['sections'][name]
+        return np.frombuffer(self.mm, dtype=np.dtype(section['dtype']),
+                             count=section['length'] // np.dtype(section['dtype']).itemsize,
+                             offset=self.data_start + section['offset'])
+
+    def strings(self, name: str, kind: str = 'str') -> StringColumn:
+        nulls = self.array(name + '.nulls') if self.has(name + '.nulls') else None
+        return StringColumn(self.bytes(name + '.data'), self.array(name + '.offsets'), nulls, kind)
+
+    def map(self, name: str) -> SortedStringMap:
+        return SortedStringMap(self.strings(name + '.keys'), self.array(name + '.values'))
+
+    def postings(self, name: str, width: int) -> Postings:
+        arrays = tuple(self.array(f'{name}.{j}') for j in range(width))
+        return Postings(self.map(name), self.array(name + '.offsets'), arrays)
+
+
+def load_snapshot(snapshot_path: str, product_db_path: str, version: str = None, source: dict = None):
+    """
+    Memory-map the snapshot of product_db.csv, or of the catalog `source` describes.
+    Returns (catalog, {index name: prebuilt index}), or None if there is no
+    snapshot or it was built from a different CSV or catalog.
+    """
+    if not os.path.exists(snapshot_path):
+        return None
+    try:
+        reader = SnapshotReader(snapshot_path)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring catalog snapshot {snapshot_path}: {e}")
+        return None
+    header = reader.header
+    if source is None:
+        source = get_file_digest(product_db_path)
+    if header.get('format') != FORMAT_VERSION or header.get('source') != source:
+        print(f"Ignoring catalog snapshot {snapshot_path}: it doesn't match {product_db_path}")
+        return None
+
+    column_types = header['column_types']
+    columns = {name: reader.strings(f'column.{name}', column_types[name]['kind']) for name in column_types}
+    catalog = ProductCatalog(
+        columns.pop('product_id'),
+        columns.pop('product_name'),
+        columns.pop('unit'),
+        columns.pop('currency'),
+        extra_columns=columns,
+        columns=header['columns'],
+        id_index=reader.map('product_id_index') if header['product_id_index'] else None
+    )
+
+    ngram_index = NgramIndex.from_postings(
+        header['ngram_n'],
+        reader.array('ngram.lengths'),
+        reader.array('ngram.spaces'),
+        reader.postings('ngram.char_postings', 2),
+        reader.postings('ngram.gram_postings', 1),
+    )
+    indexes = {
+        'basic': BasicMatchIndex.from_map(catalog, reader.map('basic.product_map'), version),
+        # rapidfuzz needs the normalized names as Python strings
+        'fuzzy': FuzzyMatchIndex.from_arrays(catalog, reader.array('fuzzy.rows'),
+                                             list(reader.strings('fuzzy.choices')), ngram_index, version),
+    }
+    return catalog, indexes
+
+
+if __name__ == '__main__':
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__) or '.', 'shared', 'product_db.csv')
+    print(f"Catalog snapshot written to {write_snapshot(csv_path)}")
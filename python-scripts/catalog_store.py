@@ -0,0 +1,192 @@
+"""
+Process-level store for the product and alias databases.
+
+The files are parsed once and kept in memory as an immutable snapshot.
+A fresh snapshot is only built when the mtime or size of one of the files
+changes, and it replaces the current one with a single reference swap, so
+requests already holding a snapshot keep a consistent view.
+Once `product_db.sqlite3` holds products (see product_store.py), also when
+it was migrated while the service runs, the products are read from it instead
+of the CSVs, and the versions it stamps on every write play the part of the
+file signatures. Aliases and single products are then point lookups in it.
+"""
+
+import os
+import threading
+from alias_store import AliasStore, get_file_signature
+from catalog_snapshot import get_snapshot_path, load_snapshot
+from product_store import ProductStore, DatabaseAliasStore, get_database_path, get_product_id_variants
+from matching_methods import ProductCatalog
+
+
+def format_version(signature) -> str:
+    """Turn a file signature, or a tuple of them, into a short version string"""
+    if signature is None:
+        return "missing"
+    if isinstance(signature[0], tuple) or signature[0] is None:
+        return '.'.join(format_version(s) for s in signature)
+    mtime_ns, size = signature
+    return f"{mtime_ns:x}-{size:x}"
+
+
+class CatalogSnapshot:
+    """
+    Immutable view of the product and alias databases at one point in time.
+    Never mutate the structures held here, they are shared between requests.
+    """
+
+    def __init__(self, product_db: ProductCatalog, alias_map: dict,
+                 product_signature, alias_signature, indexes: dict = None, index_lock=None):
+        self.product_db = product_db
+        self.alias_map = alias_map
+        self.product_signature = product_signature
+        self.alias_signature = alias_signature
+        self.catalog_version = format_version(product_signature)
+        self.alias_version = format_version(alias_signature)
+        # Matching indexes built from product_db, shared by snapshots of the same catalog
+        self._indexes = indexes if indexes is not None else {}
+        self._index_lock = index_lock or threading.Lock()
+
+    def get_index(self, name: str, builder):
+        """
+        Return the matching index `name` for this catalog.
+        It is built on first use with `builder(product_db, catalog_version)` and reused
+        by every later request until the product database changes.
+        """
+        index = self._indexes.get(name)
+        if index is not None:
+            return index
+        with self._index_lock:
+            index = self._indexes.get(name)
+            if index is None:
+                index = builder(self.product_db, self.catalog_version)
+                self._indexes[name] = index
+            return index
+
+
+class CatalogStore:
+    """Loads the databases from `shared_dir` once and hot-reloads them on change"""
+
+    def __init__(self, shared_dir: str):
+        self.shared_dir = shared_dir
+        self.product_db_path = os.path.join(shared_dir, 'product_db.csv')
+        # Pre-normalized binary copy of the product database written by excel_converter.py
+        self.product_snapshot_path = get_snapshot_path(self.product_db_path)
+        self.alias_db_path = os.path.join(shared_dir, 'product_alias.csv')
+        # Products and aliases are stored in the database once the CSVs were migrated to it
+        self.database_path = get_database_path(shared_dir)
+        self.product_store = None
+        self._database_candidate = None
+        # Until then, aliases are written through the store and read back from its journal
+        self.alias_store = AliasStore(self.alias_db_path)
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._check_database()
+
+    def _check_database(self):
+        """Switch to the product database once the CSVs were migrated to it, checked before every lookup"""
+        if self.product_store is not None or not os.path.exists(self.database_path):
+            return
+        with self._lock:
+            if self.product_store is not None:
+                return
+            if self._database_candidate is None:
+                self._database_candidate = ProductStore(self.database_path)
+            # Keep reading the CSVs until the migration imported the products
+            if self._database_candidate.catalog_signature() is None:
+                return
+            print(f"Switching to the product database at {self.database_path}")
+            self.alias_store = DatabaseAliasStore(self._database_candidate)
+            self.product_store = self._database_candidate
+
+    def find_product(self, product_id) -> dict:
+        """
+        Return the product with `product_id`, or None, see ProductStore.find_product.
+        A point lookup in the product database, or a lookup in the loaded catalog before the migration.
+        Raises FileNotFoundError if there is no product database at all.
+        """
+        self._check_database()
+        if self.product_store is not None:
+            return self.product_store.find_product(product_id)
+        catalog = self.get_snapshot().product_db
+        for candidate in get_product_id_variants(product_id):
+            row = catalog.find(candidate)
+            if row is not None:
+                return catalog.record(row)
+        return None
+
+    def get_snapshot(self) -> CatalogSnapshot:
+        """
+        Return the current snapshot, reloading it first if a file changed.
+        Raises FileNotFoundError if the product database doesn't exist.
+        """
+        self._check_database()
+        if self.product_store is not None:
+            product_signature = self.product_store.catalog_signature()
+        else:
+            product_signature = get_file_signature(self.product_db_path)
+        alias_signature = self.alias_store.signature()
+
+        snapshot = self._snapshot
+        if snapshot is not None and self._is_current(snapshot, product_signature, alias_signature):
+            return snapshot
+
+        # Only one thread rebuilds, the others wait and reuse its result
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and self._is_current(snapshot, product_signature, alias_signature):
+                return snapshot
+            snapshot = self._load(snapshot, product_signature, alias_signature)
+            # Publish the new snapshot with a single reference swap
+            self._snapshot = snapshot
+            return snapshot
+
+    @staticmethod
+    def _is_current(snapshot: CatalogSnapshot, product_signature, alias_signature) -> bool:
+        return (snapshot.product_signature == product_signature
+                and snapshot.alias_signature == alias_signature)
+
+    def _load(self, previous: CatalogSnapshot, product_signature, alias_signature) -> CatalogSnapshot:
+        """Build a new snapshot, reusing the parts of `previous` that didn't change"""
+        if product_signature is None:
+            if self.product_store is not None:
+                raise FileNotFoundError(f"No products imported into {self.product_store.path}")
+            raise FileNotFoundError(f"Product database not found at {self.product_db_path}")
+
+        if previous is not None and previous.product_signature == product_signature:
+            product_db = previous.product_db
+            indexes = previous._indexes
+            index_lock = previous._index_lock
+        else:
+            indexes = None
+            index_lock = None
+            # Memory-map the snapshot if it was built from these products, it comes with the matching indexes
+            loaded = self._load_snapshot(product_signature)
+            if loaded is not None:
+                print(f"Loading product database from {self.product_snapshot_path}")
+                product_db, indexes = loaded
+            elif self.product_store is not None:
+                print(f"Loading product database from {self.product_store.path}")
+                product_db = self.product_store.load_catalog()
+            else:
+                print(f"Loading product database from {self.product_db_path}")
+                # Columnar catalog, rows are looked up by product_id through it
+                product_db = ProductCatalog.from_csv(self.product_db_path)
+
+        if previous is not None and previous.alias_signature == alias_signature:
+            alias_map = previous.alias_map
+        else:
+            # Only the journal entries written since the last snapshot are read
+            alias_map = self.alias_store.lookup_map()
+
+        return CatalogSnapshot(product_db, alias_map,
+                               product_signature, alias_signature, indexes, index_lock)
+
+    def _load_snapshot(self, product_signature):
+        """Memory-map the catalog snapshot if it was built from the current CSV or database products"""
+        version = format_version(product_signature)
+        if self.product_store is not None:
+            # Snapshots of the database products are tagged with the version they were imported with
+            return load_snapshot(self.product_snapshot_path, self.product_store.path, version,
+                                 source={'catalog_signature': list(product_signature)})
+        return load_snapshot(self.product_snapshot_path, self.product_db_path, version)
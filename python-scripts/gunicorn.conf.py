@@ -0,0 +1,105 @@
+"""
+Gunicorn configuration for the product matching service.
+
+Run it with: gunicorn -c gunicorn.conf.py product_matching:app
+
+The app is loaded in the master before the workers are forked, and the
+catalog and matching indexes are built there too, so every worker shares
+the same pages copy-on-write instead of loading its own copy.
+"""
+
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+# Matching is CPU bound, so default to one worker per core
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', '1'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+preload_app = True
+accesslog = '-'
+
+# Seconds the master spends on the startup self-benchmark, 0 disables it
+SELF_BENCHMARK_SECONDS = float(os.environ.get('SELF_BENCHMARK_SECONDS', '1'))
+
+
+def when_ready(server):
+    """Build the catalog in the master before any worker is forked"""
+    import metrics
+    import product_matching
+    # /metrics sums the metrics every worker writes there
+    metrics.use_shared_directory(os.environ.get('METRICS_DIR', os.path.join(product_matching.SHARED_DIR, 'metrics')))
+    try:
+        snapshot = product_matching.warm_up()
+    except Exception:
+        # The workers load the catalog on their first request instead
+        server.log.exception("Warm-up failed, the catalog will be loaded by each worker")
+        snapshot = None
+    if snapshot is not None:
+        server.log.info("Catalog loaded before fork: %d products (version %s)",
+                        len(snapshot.product_db), snapshot.catalog_version)
+        # Once here rather than in every worker, which would delay each worker
+        # (including the ones max_requests recycles) before it accepts traffic
+        if SELF_BENCHMARK_SECONDS > 0:
+            self_benchmark(server, snapshot)
+    # Move everything loaded so far out of the garbage collector's reach,
+    # so collections in the workers don't touch and copy the shared pages
+    gc.freeze()
+
+
+def self_benchmark(server, snapshot):
+    """Report the requests per second a worker can serve, measured in the master before fork"""
+    import metrics
+    import product_matching
+    from self_benchmark import run_self_benchmark
+
+    def clear_caches():
+        # Measure matching, not the caches
+        product_matching.match_cache.invalidate()
+        product_matching.response_cache.invalidate()
+
+    try:
+        # Keep the synthetic invoice out of the persistent match memo and the request metrics
+        with product_matching.match_memo.suspended(), metrics.suspended():
+            result = run_self_benchmark(
+                product_matching.app, snapshot.product_db, SELF_BENCHMARK_SECONDS,
+                before_request=clear_caches
+            )
+    except Exception as e:
+        server.log.warning("Self-benchmark failed: %s", e)
+        return
+    finally:
+        # Don't leave the synthetic invoice in the cache, refill it with the memoized results instead
+        clear_caches()
+        # The workers inherit the counters, start them from zero
+        product_matching.match_cache.reset_stats()
+        product_matching.response_cache.reset_stats()
+        product_matching.warm_up_match_cache(snapshot)
+    server.log.info("Self-benchmark: %.1f req/s per worker, master RSS %s MB before fork",
+                    result['requests_per_second'], result.get('rss_mb', '?'))
+
+
+def post_worker_init(worker):
+    """Fork the parallel matching pool, then report the worker's memory"""
+    import product_matching
+    from self_benchmark import get_memory_usage
+    # The pool processes inherit the catalog the worker got from the master
+    if product_matching.match_pool.enabled:
+        product_matching.match_pool.start()
+        worker.log.info("Parallel matching pool started with %d processes", product_matching.match_pool.size)
+    memory = get_memory_usage()
+    worker.log.info("Worker (pid %s) memory: RSS %s MB (PSS %s MB, shared %s MB)",
+                    worker.pid, memory.get('rss_mb', '?'), memory.get('pss_mb', '?'), memory.get('shared_mb', '?'))
+
+
+def worker_exit(server, worker):
+    """Write the last metrics of the worker before it exits"""
+    import metrics
+    metrics.flush()
+
+
+def child_exit(server, worker):
+    """Keep the metrics of an exited worker in the totals, e.g. when max_requests recycles it"""
+    import metrics
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,91 @@
+"""
+Bounded LRU cache of item name match results.
+
+The same supplier line items show up on almost every invoice, so the result of
+matching a name is kept and reused until the catalog or the alias database
+changes. Keys include both versions, and the cache is cleared as soon as a
+request sees new ones.
+"""
+
+from collections import OrderedDict
+import threading
+from matching_methods.normalize import normalize_key
+
+
+def normalize_cache_name(name) -> str:
+    """
+    Return the cache key for an item name, or None if it must not be cached.
+    Every matcher starts from the normalize_key of the name, so names with the same key share results.
+    Blank names are special-cased by the matchers and never cached.
+    """
+    if not isinstance(name, str):
+        return None
+    key = normalize_key(name)
+    return key or None
+
+
+class MatchCache:
+    """Thread-safe LRU map of match results with hit, miss and eviction counters"""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._versions = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def sync_versions(self, catalog_version: str, alias_version: str):
+        """Drop every entry if the catalog or alias database changed since the last call"""
+        versions = (catalog_version, alias_version)
+        if versions == self._versions:
+            return
+        with self._lock:
+            if versions != self._versions:
+                self._entries.clear()
+                self._versions = versions
+
+    def get(self, key):
+        """Return the cached value for `key`, or None"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store `value`, evicting the least recently used entries beyond max_size"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._versions = None
+
+    def reset_stats(self):
+        """Zero the cache counters"""
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        """Get the cache counters"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
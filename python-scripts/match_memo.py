@@ -0,0 +1,206 @@
+"""
+Persistent memo of item name match results, shared by every worker.
+
+The in-memory match cache is per process and lost on every restart, and the
+container restarts whenever it fails. Results are also written to a SQLite
+database in WAL mode under shared/, so a name matched by any worker is reused
+by the others and after a restart. Entries are keyed like the match cache, by
+normalized name, method, options and catalog/alias versions, and the least
+recently used ones are evicted beyond a maximum number of rows. At startup the
+most recently used entries of the current versions fill the match cache.
+The memo is only a cache: if the database can't be used, names are matched as usual.
+"""
+
+from contextlib import closing, contextmanager
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Seconds before a hit refreshes the last use of an entry, so reads rarely write
+TOUCH_INTERVAL = 300
+# Seconds to wait for another worker's write to finish
+BUSY_TIMEOUT = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS match_memo (
+    key TEXT PRIMARY KEY,
+    catalog_version TEXT NOT NULL,
+    alias_version TEXT NOT NULL,
+    result TEXT NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS match_memo_versions ON match_memo (catalog_version, alias_version, used_at);
+CREATE INDEX IF NOT EXISTS match_memo_used_at ON match_memo (used_at);
+"""
+
+
+def encode_key(key: tuple) -> str:
+    """Serialize a match cache key, a tuple of JSON values"""
+    return json.dumps(key, ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_key(text: str) -> tuple:
+    """Turn a serialized key back into the match cache key, lists become tuples"""
+    def to_tuple(value):
+        return tuple(to_tuple(item) for item in value) if isinstance(value, list) else value
+    return to_tuple(json.loads(text))
+
+
+class MatchMemo:
+    """SQLite memo of match results, safe to use from several threads and processes"""
+
+    def __init__(self, path: str, max_rows: int = 100000):
+        self.path = path
+        self.max_rows = max_rows
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._suspended = False
+        # Rows written since the last eviction
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_rows > 0 and not self._suspended
+
+    @contextmanager
+    def suspended(self):
+        """Neither read nor write the memo meanwhile, e.g. while matching synthetic invoices"""
+        self._suspended = True
+        try:
+            yield
+        finally:
+            self._suspended = False
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # Losing the last writes on a power cut only costs matching those names again
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(SCHEMA)
+        return connection
+
+    def _connection(self) -> sqlite3.Connection:
+        """Connection of the current thread, connections are never shared across threads or forks"""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = self._connect()
+            local.pid = os.getpid()
+        return local.connection
+
+    def _failed(self, action: str, e: Exception):
+        with self._lock:
+            self.errors += 1
+        print(f"Match memo {action} failed: {e}")
+
+    def get_many(self, keys: list[tuple]) -> dict:
+        """Return {key: result} for the keys found in the memo"""
+        if not self.enabled or not keys:
+            return {}
+        encoded = {encode_key(key): key for key in keys}
+        found = {}
+        stale = []
+        now = time.time()
+        try:
+            connection = self._connection()
+            # Stay well below SQLite's limit on the number of parameters
+            texts = list(encoded)
+            for start in range(0, len(texts), 500):
+                chunk = texts[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT key, result, used_at FROM match_memo WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for text, result, used_at in rows:
+                    found[encoded[text]] = json.loads(result)
+                    if used_at < now - TOUCH_INTERVAL:
+                        stale.append((now, text))
+            if stale:
+                connection.executemany("UPDATE match_memo SET used_at = ? WHERE key = ?", stale)
+        except sqlite3.Error as e:
+            self._failed('lookup', e)
+            return found
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, entries: dict, catalog_version: str, alias_version: str):
+        """Store {key: result} for the given catalog and alias versions, then evict beyond max_rows"""
+        if not self.enabled or not entries:
+            return
+        now = time.time()
+        rows = [
+            (encode_key(key), catalog_version, alias_version, json.dumps(result, ensure_ascii=False), now)
+            for key, result in entries.items()
+        ]
+        try:
+            connection = self._connection()
+            with connection:
+                connection.execute('BEGIN')
+                connection.executemany("INSERT OR REPLACE INTO match_memo VALUES (?, ?, ?, ?, ?)", rows)
+            with self._lock:
+                self._writes += len(rows)
+                # Counting the rows scans the table, so only check every tenth of max_rows written
+                evict = self._writes >= max(1, self.max_rows // 10)
+                if evict:
+                    self._writes = 0
+            if evict:
+                self.evict()
+        except sqlite3.Error as e:
+            self._failed('write', e)
+
+    def evict(self):
+        """Delete the least recently used entries beyond max_rows"""
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            deleted = connection.execute(
+                "DELETE FROM match_memo WHERE key IN "
+                "(SELECT key FROM match_memo ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,)
+            ).rowcount
+        with self._lock:
+            self.evictions += deleted
+
+    def warm_up(self, catalog_version: str, alias_version: str, limit: int) -> list[tuple]:
+        """
+        Drop the entries of other catalog or alias versions, and return the `limit` most
+        recently used (key, result) pairs of these versions, least recent first.
+        Uses its own connection, so it is safe to call before forking workers.
+        """
+        if not self.enabled or limit <= 0:
+            return []
+        try:
+            with closing(self._connect()) as connection:
+                with connection:
+                    connection.execute('BEGIN IMMEDIATE')
+                    connection.execute(
+                        "DELETE FROM match_memo WHERE catalog_version != ? OR alias_version != ?",
+                        (catalog_version, alias_version)
+                    )
+                rows = connection.execute(
+                    "SELECT key, result FROM match_memo WHERE catalog_version = ? AND alias_version = ? "
+                    "ORDER BY used_at DESC LIMIT ?",
+                    (catalog_version, alias_version, limit)
+                ).fetchall()
+        except sqlite3.Error as e:
+            self._failed('warm-up', e)
+            return []
+        return [(decode_key(key), json.loads(result)) for key, result in reversed(rows)]
+
+    def stats(self) -> dict:
+        """Get the memo counters of this process"""
+        with self._lock:
+            return {
+                'max_rows': self.max_rows,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'errors': self.errors,
+            }
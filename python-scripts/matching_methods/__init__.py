@@ -1,31 +1,51 @@
-from .basic import basic_matching
-from .fuzzy import fuzzy_matching
+from .basic import basic_matching, BasicMatchIndex, ExactMatchIndex
+from .cascade import (cascade_matching, Matcher, AliasMatcher, ExactMatcher, VariantMatcher, NgramMatcher,
+                      FuzzyMatcher)
+from .catalog import ProductCatalog
+from .fuzzy import fuzzy_matching, FuzzyMatchIndex
+from .normalize import normalize_key, normalize_text
+from .search import search_products, ProductSearchIndex
 import pandas as pd
 
-__all__ = ['basic_matching', 'fuzzy_matching', 'alias_match_item']
+__all__ = ['basic_matching', 'BasicMatchIndex', 'ExactMatchIndex', 'fuzzy_matching', 'FuzzyMatchIndex',
+           'cascade_matching', 'Matcher', 'ProductCatalog', 'alias_match_item', 'MATCHERS', 'register_matcher',
+           'get_matchers', 'normalize_key', 'normalize_text', 'search_products', 'ProductSearchIndex']
 
-def alias_match_item(item, alias_map, product_id_map):
+# Matchers the cascade runs, by name
+MATCHERS = {}
+
+def register_matcher(matcher: Matcher) -> Matcher:
+    """Add a matcher to the cascade, replacing any matcher with the same name"""
+    MATCHERS[matcher.name] = matcher
+    return matcher
+
+def get_matchers() -> list[Matcher]:
+    """Return the registered matchers, cheapest first"""
+    return sorted(MATCHERS.values(), key=lambda matcher: matcher.cost)
+
+for _matcher in (AliasMatcher(), ExactMatcher(), VariantMatcher(), NgramMatcher(), FuzzyMatcher()):
+    register_matcher(_matcher)
+
+def alias_match_item(item, alias_map, catalog):
     """
     Matches a single item using the alias map.
     Returns the enhanced item if a match is found, otherwise None.
     """
     # Find the product_id from the alias_map if the input_name is in it
-    input_name = item.get('product_name', '').strip()
-    product_id = alias_map.get(input_name.lower())
+    product_id = alias_map.get(normalize_key(item.get('product_name', '')))
 
-    # Check if the product_id (alias) is in the product_id_map (database)
-    if product_id and product_id in product_id_map:
-        # Get the actual product_name from the product_id_map
-        matched_product = product_id_map[product_id]
+    # Check if the product_id (alias) is in the catalog (database)
+    matched_row = catalog.find(product_id) if product_id else None
+    if matched_row is not None:
         enhanced_item = item.copy()
         # Rename product_name to original_name
         if 'product_name' in enhanced_item:
             enhanced_item['original_name'] = enhanced_item.pop('product_name')
         # Update the item with the matched product information
         enhanced_item.update({
-            'product_id': matched_product.get('product_id'),
-            'matched_name': matched_product.get('product_name'),
-            'unit': matched_product.get('unit'),
+            'product_id': catalog.product_ids[matched_row],
+            'matched_name': catalog.product_names[matched_row],
+            'unit': catalog.units[matched_row],
             'match_score': 100
         })
         return enhanced_item
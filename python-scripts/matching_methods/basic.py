@@ -1,24 +1,77 @@
-import re
 from datetime import datetime
+from .catalog import ProductCatalog, as_catalog
+from .normalize import normalize_catalog_key, normalize_catalog_text, normalize_key
 
-def basic_matching(invoice_data: dict, product_db: list[dict]) -> dict:
-    """Enhanced invoice processing with basic exact matching"""
-    # Pre-process product_db into a lookup map and handle duplicates
-    product_map = {}
-    seen_product_names = set()
-    for product in product_db:
-        product_name = product.get('product_name')
-        # Skip if product name is empty or already processed
-        if not product_name or product_name in seen_product_names:
-            continue
-        seen_product_names.add(product_name)
+class BasicMatchIndex:
+    """
+    Lookup map from every product name variant to the catalog row of its product.
+    Built once per catalog and reused by every request, so matching an invoice
+    only costs one lookup per item instead of a pass over the whole catalog.
+    """
+
+    def __init__(self, product_db: ProductCatalog, version: str = None):
+        # Version of the catalog this index was built from
+        self.version = version
+        self.catalog = product_db = as_catalog(product_db)
+
+        # Pre-process product_db into a lookup map and handle duplicates
+        # Output: {name variant: row}
+        product_map = {}
+        seen_product_names = set()
+        for row, product_name in enumerate(product_db.product_names):
+            # Skip if product name is empty, not text (e.g. NaN for a blank cell) or already processed
+            if not product_name or not isinstance(product_name, str) or product_name in seen_product_names:
+                continue
+            seen_product_names.add(product_name)
+
+            # Get all variants of the product name
+            parts, concatenated = get_product_name_variants(product_name)
+            # Use dict comprehension for cleaner and more efficient mapping
+            product_map.update({part: row for part in parts if part not in product_map})
+            if concatenated not in product_map:
+                product_map[concatenated] = row
+        self.product_map = product_map
+
+    @classmethod
+    def from_map(cls, product_db: ProductCatalog, product_map, version: str = None) -> 'BasicMatchIndex':
+        """
+        Wrap a prebuilt {name variant: row} lookup, e.g. the one stored in a catalog snapshot.
+        `product_map` only needs a `get` method.
+        """
+        index = cls.__new__(cls)
+        index.version = version
+        index.catalog = product_db
+        index.product_map = product_map
+        return index
+
+class ExactMatchIndex:
+    """
+    Lookup map from every product name, only folded and lowercased (see normalize_key),
+    to the catalog row of its product. Used by the exact tier of the matcher cascade.
+    """
+
+    def __init__(self, product_db: ProductCatalog, version: str = None):
+        # Version of the catalog this index was built from
+        self.version = version
+        self.catalog = product_db = as_catalog(product_db)
 
-        # Get all variants of the product name
-        parts, concatenated = get_product_name_variants(product_name)
-        # Use dict comprehension for cleaner and more efficient mapping
-        product_map.update({part: product for part in parts if part not in product_map})
-        if concatenated not in product_map:
-            product_map[concatenated] = product
+        # Output: {product name key: row}, the first row wins on duplicates
+        product_map = {}
+        for row, product_name in enumerate(product_db.product_names):
+            if not product_name or not isinstance(product_name, str):
+                continue
+            product_map.setdefault(normalize_catalog_key(product_name), row)
+        self.product_map = product_map
+
+def basic_matching(invoice_data: dict, product_db: ProductCatalog, index: BasicMatchIndex = None) -> dict:
+    """
+    Enhanced invoice processing with basic exact matching.
+    Pass a prebuilt `index` to skip building the lookup map from `product_db`.
+    """
+    if index is None:
+        index = BasicMatchIndex(product_db)
+    product_map = index.product_map
+    catalog = index.catalog
 
     if 'items' not in invoice_data:
         return invoice_data
@@ -27,7 +80,7 @@ def basic_matching(invoice_data: dict, product_db: list[dict]) -> dict:
     enhanced_items = []
     
     for item in invoice_data['items']:
-        enhanced_item = basic_match_product(item, product_map)
+        enhanced_item = basic_match_product(item, product_map, catalog)
         
         # Override subtotal
         if enhanced_item.get('quantity') and enhanced_item.get('unit_price'):
@@ -41,48 +94,38 @@ def basic_matching(invoice_data: dict, product_db: list[dict]) -> dict:
     
     return invoice_data
 
-def normalize_text(text: str) -> str:
-    """
-    Normalize text by lowercasing, removing extra spaces, and special characters.
-    """
-    text = text.lower()
-    text = text.replace('\\', '/')  # Convert backslashes to forward slashes
-    text = re.sub(r'[\(\)/,-]', '', text)  # Remove forward slashes and other special chars
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
-
 def get_product_name_variants(product_name: str) -> tuple[list[str], str]:
     """
     Get all variants of a product name (individual parts and concatenated).
     For example, "豬皮/肉皮\\豬皮" will be split into ["豬皮", "肉皮", "豬皮"] and "豬皮肉皮豬皮".
     This is to handle the case where the product name is not always in the same format.
     """
-    # Normalize separators and split into parts
-    normalized = normalize_text(product_name)
+    # Normalize separators and split into parts, catalog names are memoized
+    normalized = normalize_catalog_text(product_name)
     parts = normalized.split('/')
     concatenated = ''.join(parts)
     
     # Return both parts and concatenated version
     return parts, concatenated
 
-def basic_match_product(item: dict, product_map: dict) -> dict:
-    """Basic exact string matching using a pre-processed product map."""
+def basic_match_product(item: dict, product_map: dict, catalog: ProductCatalog) -> dict:
+    """Basic exact string matching using a pre-processed map of name variants to catalog rows."""
     # Get the input product name and copy the item
-    input_name = item.get('product_name', '').strip().lower()
+    input_name = normalize_key(item.get('product_name', ''))
     enhanced_item = item.copy()
     
     # Rename product_name to original_name
     if 'product_name' in enhanced_item:
         enhanced_item['original_name'] = enhanced_item.pop('product_name')
     
-    # Get the matched product from the product map
-    matched_product = product_map.get(input_name)
+    # Get the row of the matched product from the product map
+    matched_row = product_map.get(input_name)
     
-    if matched_product:
+    if matched_row is not None:
         # Update the invoice data with the matched product
-        enhanced_item['product_id'] = matched_product.get('product_id')
-        enhanced_item['matched_name'] = matched_product.get('product_name')
-        enhanced_item['unit'] = matched_product.get('unit')
+        enhanced_item['product_id'] = catalog.product_ids[matched_row]
+        enhanced_item['matched_name'] = catalog.product_names[matched_row]
+        enhanced_item['unit'] = catalog.units[matched_row]
     else:
         # If no match is found, set the product_id and matched_name to None
         enhanced_item['product_id'] = None
@@ -0,0 +1,158 @@
+from .basic import BasicMatchIndex, ExactMatchIndex
+from .catalog import ProductCatalog
+from .fuzzy import FuzzyMatchIndex, build_fuzzy_match, fuzzy_matching
+from .normalize import normalize_key, normalize_text
+
+class Matcher:
+    """
+    One tier of the matcher cascade.
+    `cost` is a rough relative price of matching one name, the cascade runs the
+    cheapest matchers first and only passes on the names they couldn't match.
+    """
+
+    name = None
+    cost = 0
+
+    def match(self, names: list[str], context, options: dict, stats: dict = None) -> list[dict]:
+        """
+        Match `names`, returning one enhanced item per name.
+        Names without a confident match come back with product_id None.
+        `context` is a catalog snapshot, with product_db, alias_map and get_index(name, builder).
+        `options` holds the fuzzy threshold, suggestion_threshold and max_suggestions.
+        """
+        raise NotImplementedError
+
+class AliasMatcher(Matcher):
+    """Names corrected by users before, looked up in the alias map"""
+
+    name = 'alias'
+    cost = 1
+
+    def match(self, names, context, options, stats=None):
+        catalog = context.product_db
+        rows = []
+        for name in names:
+            product_id = context.alias_map.get(normalize_key(name))
+            rows.append(catalog.find(product_id) if product_id else None)
+        return [lookup_item(name, row, catalog) for name, row in zip(names, rows)]
+
+class ExactMatcher(Matcher):
+    """Names written exactly like a catalog product name, ignoring case"""
+
+    name = 'exact'
+    cost = 2
+
+    def match(self, names, context, options, stats=None):
+        index = context.get_index('exact', ExactMatchIndex)
+        return [lookup_item(name, index.product_map.get(normalize_key(name)), index.catalog) for name in names]
+
+class VariantMatcher(Matcher):
+    """Names equal to a normalized variant of a catalog product name, like basic matching"""
+
+    name = 'variant'
+    cost = 3
+
+    def match(self, names, context, options, stats=None):
+        index = context.get_index('basic', BasicMatchIndex)
+        items = []
+        for name in names:
+            # Try the name as basic matching does first, then normalized like the variants
+            matched_row = index.product_map.get(normalize_key(name))
+            if matched_row is None:
+                matched_row = index.product_map.get(normalize_text(name))
+            items.append(lookup_item(name, matched_row, index.catalog))
+        return items
+
+class NgramMatcher(Matcher):
+    """Fuzzy scores against only the products sharing a bigram with the name"""
+
+    name = 'ngram'
+    cost = 20
+
+    def match(self, names, context, options, stats=None):
+        index = context.get_index('fuzzy', FuzzyMatchIndex)
+        scores = index.score(names, options['suggestion_threshold'], pruning='ngram')
+        return [
+            build_fuzzy_match({'product_name': name}, index, item_scores, options['threshold'],
+                              options['suggestion_threshold'], candidates, options['max_suggestions'])
+            for name, (candidates, item_scores) in zip(names, scores)
+        ]
+
+class FuzzyMatcher(Matcher):
+    """Fuzzy scores against every product that can reach the suggestion threshold"""
+
+    name = 'fuzzy'
+    cost = 100
+
+    def match(self, names, context, options, stats=None):
+        index = context.get_index('fuzzy', FuzzyMatchIndex)
+        names_data = {'items': [{'product_name': name} for name in names]}
+        return fuzzy_matching(names_data, context.product_db, index=index, stats=stats, **options)['items']
+
+def lookup_item(name: str, matched_row, catalog: ProductCatalog) -> dict:
+    """Enhanced item of a name matched (or not) to a catalog row by a lookup"""
+    if matched_row is None:
+        return unmatched_item(name)
+    return {
+        'original_name': name,
+        'product_id': catalog.product_ids[matched_row],
+        'matched_name': catalog.product_names[matched_row],
+        'unit': catalog.units[matched_row],
+        'match_score': 100
+    }
+
+def unmatched_item(name: str) -> dict:
+    return {'original_name': name, 'product_id': None, 'matched_name': None, 'match_score': 0}
+
+def cascade_matching(invoice_data: dict, context, matchers: list[Matcher], options: dict,
+                     stats: dict = None) -> dict:
+    """
+    Invoice processing with a cascade of matchers, cheapest first.
+    Each distinct item name is passed down the cascade until a matcher finds a
+    confident match, so the expensive matchers only see the names the cheap ones
+    couldn't match. Every item records the tier that matched it in `match_tier`,
+    or None if no tier did, in which case it keeps the last tier's suggestions.
+    """
+    if 'items' not in invoice_data:
+        return invoice_data
+
+    items = invoice_data['items']
+    names = [item.get('product_name', '') for item in items]
+    pending = list(dict.fromkeys(name for name in names if name and name.strip()))
+
+    # Output: {name: enhanced item}
+    results = {}
+    # Last unconfident result of each name, e.g. the possible matches of fuzzy matching
+    fallbacks = {}
+    for matcher in sorted(matchers, key=lambda matcher: matcher.cost):
+        if not pending:
+            break
+        still_pending = []
+        for name, matched in zip(pending, matcher.match(pending, context, options, stats)):
+            if matched.get('product_id'):
+                results[name] = {**matched, 'match_tier': matcher.name}
+            else:
+                fallbacks[name] = matched
+                still_pending.append(name)
+        pending = still_pending
+    for name in pending:
+        results[name] = {**(fallbacks.get(name) or unmatched_item(name)), 'match_tier': None}
+
+    # Initialize a list to store the enhanced items
+    enhanced_items = []
+    for item, name in zip(items, names):
+        enhanced_item = item.copy()
+        # Rename product_name to original_name
+        if 'product_name' in enhanced_item:
+            enhanced_item['original_name'] = enhanced_item.pop('product_name')
+        enhanced_item.update(results.get(name) or {**unmatched_item(name), 'match_tier': None})
+
+        # Override subtotal
+        if enhanced_item.get('quantity') and enhanced_item.get('unit_price'):
+            enhanced_item['subtotal'] = enhanced_item['quantity'] * enhanced_item['unit_price']
+
+        enhanced_items.append(enhanced_item)
+
+    invoice_data['items'] = enhanced_items
+
+    return invoice_data
@@ -0,0 +1,109 @@
+import sys
+import pandas as pd
+
+# Columns of product_db.csv every matcher relies on
+CATALOG_COLUMNS = ('product_id', 'product_name', 'unit', 'currency')
+
+class ProductCatalog:
+    """
+    Column-oriented product database.
+    Every column is a list indexed by row number, so a product costs one slot per
+    column instead of a dict holding its own copy of every key. Units and currencies
+    repeat across the whole catalog and are interned, so rows share one string object.
+    Products are referred to by their integer row number.
+    Columns can be any read-only sequence, e.g. the memory-mapped columns of a
+    catalog snapshot (see catalog_snapshot.py).
+    """
+
+    __slots__ = ('columns', 'product_ids', 'product_names', 'units', 'currencies', 'extra_columns', '_id_index')
+
+    def __init__(self, product_ids, product_names, units=None, currencies=None,
+                 extra_columns: dict = None, columns: tuple = None, id_index=None):
+        size = len(product_ids)
+        # Names of the columns the catalog was loaded with, in their original order
+        self.columns = tuple(columns) if columns is not None else CATALOG_COLUMNS
+        self.product_ids = product_ids
+        self.product_names = product_names
+        self.units = units if units is not None else [None] * size
+        self.currencies = currencies if currencies is not None else [None] * size
+        # Any other column, e.g. unit_price
+        # Output: {column: [value of each row]}
+        self.extra_columns = dict(extra_columns or {})
+        # Create a product_id -> row map for quick lookups, the last row wins on duplicates
+        if id_index is None:
+            id_index = {product_id: row for row, product_id in enumerate(product_ids)}
+        self._id_index = id_index
+
+    @classmethod
+    def from_columns(cls, columns: dict, size: int) -> 'ProductCatalog':
+        """Build the catalog from {column: [value of each row]}"""
+        columns = {name: list(values) for name, values in columns.items()}
+        names = tuple(columns)
+        # Units and currencies repeat on every row, share one object per value
+        for name in ('unit', 'currency'):
+            if name in columns:
+                columns[name] = [intern_value(value) for value in columns[name]]
+        return cls(
+            columns.pop('product_id', [None] * size),
+            columns.pop('product_name', [None] * size),
+            columns.pop('unit', None),
+            columns.pop('currency', None),
+            extra_columns=columns,
+            columns=names
+        )
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> 'ProductCatalog':
+        """Build the catalog from a dataframe with the columns of product_db.csv"""
+        # tolist() returns native Python values, like to_dict(orient='records') does
+        return cls.from_columns({name: df[name].tolist() for name in df.columns}, len(df))
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'ProductCatalog':
+        """Load the catalog from product_db.csv"""
+        return cls.from_dataframe(pd.read_csv(path))
+
+    @classmethod
+    def from_records(cls, records: list[dict]) -> 'ProductCatalog':
+        """Build the catalog from a list of product dicts"""
+        names = list(dict.fromkeys(key for record in records for key in record))
+        return cls.from_columns({name: [record.get(name) for record in records] for name in names}, len(records))
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    def find(self, product_id):
+        """Return the row of `product_id`, or None if it isn't in the catalog"""
+        return self._id_index.get(product_id)
+
+    def get(self, row, column: str, default=None):
+        """Return the value of `column` in `row`, or `default` if either doesn't exist"""
+        if row is None or column not in self.columns:
+            return default
+        if column == 'product_id':
+            return self.product_ids[row]
+        if column == 'product_name':
+            return self.product_names[row]
+        if column == 'unit':
+            return self.units[row]
+        if column == 'currency':
+            return self.currencies[row]
+        return self.extra_columns[column][row]
+
+    def record(self, row: int) -> dict:
+        """Return `row` as a product dict"""
+        return {column: self.get(row, column) for column in self.columns}
+
+    def to_records(self) -> list[dict]:
+        """Return the whole catalog as a list of product dicts"""
+        return [self.record(row) for row in range(len(self))]
+
+def intern_value(value):
+    """Intern strings so equal values share one object, leave anything else as it is"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+def as_catalog(product_db) -> ProductCatalog:
+    """Accept a ProductCatalog or a list of product dicts"""
+    if isinstance(product_db, ProductCatalog):
+        return product_db
+    return ProductCatalog.from_records(product_db)
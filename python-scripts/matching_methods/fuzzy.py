@@ -1,29 +1,154 @@
-import re
+import heapq
+import os
 from datetime import datetime
-from thefuzz import fuzz
+import numpy as np
+from rapidfuzz import fuzz as rapid_fuzz, process as rapid_process
+from thefuzz import utils as fuzz_utils
+from .catalog import ProductCatalog, as_catalog
+from .ngram import NgramIndex, PRUNING_MODES
+from .normalize import memoize_catalog, normalize_text
 
-def fuzzy_matching(invoice_data: dict, product_db: list[dict], threshold: int = 85, suggestion_threshold: int = 60) -> dict:
+# Number of CPU cores the batch scorer may use, -1 uses all of them
+FUZZY_WORKERS = int(os.environ.get('FUZZY_WORKERS', '1'))
+# How candidates are pruned before scoring, one of PRUNING_MODES
+FUZZY_PRUNING = os.environ.get('FUZZY_PRUNING', 'exact')
+# Upper bound on the number of cells (items x products) scored in one chunk
+MAX_SCORE_CELLS = 4_000_000
+
+class FuzzyMatchIndex:
     """
-    Enhanced invoice processing with fuzzy matching.
+    Catalog names normalized once, ready to be scored against many invoice items.
+    Built once per catalog and reused by every request.
     """
-    # Pre-process product_db into a lookup map and handle duplicates
-    unique_products = []
-    seen_product_names = set()
-    for product in product_db:
-        product_name = product.get('product_name')
-        # Skip if product name is empty or already processed
-        if not product_name or product_name in seen_product_names:
-            continue
-        unique_products.append(product)
-        seen_product_names.add(product_name)
 
+    def __init__(self, product_db: ProductCatalog, version: str = None):
+        # Version of the catalog this index was built from
+        self.version = version
+        self.catalog = product_db = as_catalog(product_db)
+
+        # Pre-process product_db into the catalog rows of the unique products
+        rows = []
+        seen_product_names = set()
+        for row, product_name in enumerate(product_db.product_names):
+            # Skip if product name is empty, not a string or already processed
+            if not product_name or not isinstance(product_name, str) or product_name in seen_product_names:
+                continue
+            rows.append(row)
+            seen_product_names.add(product_name)
+        self.rows = np.array(rows, dtype=np.int64)
+        self.choices = [prepare_catalog_text(product_db.product_names[row]) for row in rows]
+        # n-gram index used to skip the products that can't reach the suggestion threshold
+        self.ngram_index = NgramIndex(self.choices)
+
+    @classmethod
+    def from_arrays(cls, product_db: ProductCatalog, rows, choices: list[str], ngram_index: NgramIndex,
+                    version: str = None) -> 'FuzzyMatchIndex':
+        """Wrap prebuilt rows, normalized names and n-gram index, e.g. the ones stored in a catalog snapshot"""
+        index = cls.__new__(cls)
+        index.version = version
+        index.catalog = product_db
+        index.rows = rows
+        index.choices = choices
+        index.ngram_index = ngram_index
+        return index
+
+    def score(self, names: list[str], suggestion_threshold: int = 60, pruning: str = None,
+              workers: int = None, stats: dict = None):
+        """
+        Score every name against the catalog.
+        Yields one (candidates, scores) pair per name: `scores` holds integer scores
+        for the product indices in `candidates`, or for every product if it is None.
+        Pass a `stats` dict to collect how many products were scored and pruned.
+        """
+        if workers is None:
+            workers = FUZZY_WORKERS
+        if pruning is None:
+            pruning = FUZZY_PRUNING
+        if pruning not in PRUNING_MODES:
+            raise ValueError(f"Unknown pruning mode '{pruning}', expected one of {PRUNING_MODES}")
+        queries = [prepare_text(name) for name in names]
+
+        if pruning == 'off':
+            for scores in self._score_all(queries, workers):
+                self._count(stats, len(self.choices))
+                yield None, scores
+            return
+
+        for query in queries:
+            candidates = self.ngram_index.candidates(query, suggestion_threshold, pruning)
+            if candidates is None:
+                scores = next(self._score_all([query], workers))
+                self._count(stats, len(self.choices))
+                yield None, scores
+                continue
+            scores = self.score_candidates(query, candidates, workers)
+            self._count(stats, len(candidates))
+            yield candidates, scores
+
+    def score_candidates(self, query: str, candidates, workers: int = None):
+        """Score a query already passed through prepare_text against the product indices in `candidates`"""
+        if workers is None:
+            workers = FUZZY_WORKERS
+        choices = [self.choices[i] for i in candidates]
+        return self._cdist([query], choices, workers)[0] if choices else np.zeros(0, dtype=np.int64)
+
+    def _score_all(self, queries: list[str], workers: int):
+        """Yield the scores of each query against the whole catalog"""
+        if not self.choices:
+            for _ in queries:
+                yield np.zeros(0, dtype=np.int64)
+            return
+
+        # Score the items in chunks to bound the size of the score matrix
+        chunk_size = max(1, MAX_SCORE_CELLS // len(self.choices))
+        for start in range(0, len(queries), chunk_size):
+            yield from self._cdist(queries[start:start + chunk_size], self.choices, workers)
+
+    @staticmethod
+    def _cdist(queries: list[str], choices: list[str], workers: int):
+        """Score queries against choices with token_set_ratio"""
+        matrix = rapid_process.cdist(
+            queries, choices,
+            scorer=rapid_fuzz.token_set_ratio, dtype=np.float64, workers=workers
+        )
+        # Round like thefuzz does (round half to even)
+        return np.rint(matrix).astype(np.int64)
+
+    def _count(self, stats: dict, scored: int):
+        """Add one item to the pruning statistics"""
+        if stats is None:
+            return
+        stats['items'] = stats.get('items', 0) + 1
+        stats['catalog_size'] = len(self.choices)
+        stats['scored'] = stats.get('scored', 0) + scored
+        stats['pruned'] = stats.get('pruned', 0) + len(self.choices) - scored
+
+def fuzzy_matching(invoice_data: dict, product_db: ProductCatalog, threshold: int = 85, suggestion_threshold: int = 60,
+                   index: FuzzyMatchIndex = None, stats: dict = None, max_suggestions: int = None) -> dict:
+    """
+    Enhanced invoice processing with fuzzy matching.
+    All items are scored against the catalog in one batch.
+    Pass a prebuilt `index` to skip normalizing the names in `product_db`,
+    and a `stats` dict to collect how many products were pruned before scoring.
+    `max_suggestions` caps the number of possible matches per item, None keeps them all.
+    """
     if 'items' not in invoice_data:
         return invoice_data
 
+    if index is None:
+        index = FuzzyMatchIndex(product_db)
+
+    # Score all named items at once
+    items = invoice_data['items']
+    names = [item.get('product_name', '') for item in items]
+    scores = index.score([name for name in names if name], suggestion_threshold, stats=stats)
+
     # Initialize a list to store the enhanced items
     enhanced_items = []
-    for item in invoice_data['items']:
-        enhanced_item = fuzzy_match_product(item, unique_products, threshold, suggestion_threshold)
+    for item, name in zip(items, names):
+        candidates, item_scores = next(scores) if name else (None, None)
+        enhanced_item = build_fuzzy_match(item, index, item_scores, threshold, suggestion_threshold, candidates,
+                                          max_suggestions)
         
         # Override subtotal
         if enhanced_item.get('quantity') and enhanced_item.get('unit_price'):
@@ -35,49 +160,59 @@ def fuzzy_matching(invoice_data: dict, product_db: list[dict], threshold: int =
     
     return invoice_data
 
-def normalize_text(text: str) -> str:
+def prepare_text(text: str) -> str:
     """
-    Normalize text by lowercasing, removing extra spaces, and special characters.
+    Normalize text and apply the processing thefuzz.fuzz.token_set_ratio does
+    before scoring, so rapidfuzz scores match thefuzz exactly.
     """
-    text = text.lower()
-    text = text.replace('\\', '/')  # Convert backslashes to forward slashes
-    text = re.sub(r'[\(\)/,-]', '', text)  # Remove forward slashes and other special chars
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
+    return fuzz_utils.full_process(normalize_text(text), force_ascii=True)
 
-def fuzzy_match_product(item: dict, product_db: list[dict], threshold: int = 85, suggestion_threshold: int = 60) -> dict:
+# Catalog names are prepared again every time the index is rebuilt
+prepare_catalog_text = memoize_catalog(prepare_text)
+
+def fuzzy_match_product(item: dict, product_db: ProductCatalog, threshold: int = 85, suggestion_threshold: int = 60,
+                        max_suggestions: int = None) -> dict:
     """
     Finds the best product match for an item using fuzzy string matching.
     If no match is found above the threshold, it returns a list of possible matches.
     """
+    index = FuzzyMatchIndex(product_db)
     input_name = item.get('product_name', '')
-    
+    candidates, scores = next(index.score([input_name], suggestion_threshold)) if input_name else (None, None)
+    return build_fuzzy_match(item, index, scores, threshold, suggestion_threshold, candidates, max_suggestions)
+
+def build_fuzzy_match(item: dict, index: FuzzyMatchIndex, scores, threshold: int = 85, suggestion_threshold: int = 60,
+                      candidates=None, max_suggestions: int = None) -> dict:
+    """
+    Builds the enhanced item from the scores of `item` against the products of `index`.
+    `scores` is aligned with the product indices in `candidates`, or with all the products
+    of the index if `candidates` is None. `scores` is None if the item has no name.
+    Only the best `max_suggestions` products are kept as possible matches.
+    """
     # If no product name, return empty JSON
-    if not input_name:
+    if scores is None:
         return {**item, 'product_id': None, 'matched_name': None, 'match_score': 0, 'possible_matches': []}
+    if candidates is None:
+        candidates = np.arange(len(scores))
 
-    normalized_input_name = normalize_text(input_name)
-    
-    scored_products = []
-    # Calculate the match score for each product
-    for product in product_db:
-        db_product_name = product.get('product_name', '')
-        if not db_product_name:
-            continue
-
-        normalized_db_name = normalize_text(db_product_name)
-        
-        # Using token_set_ratio which is good for matching strings of different lengths
-        match_score = fuzz.token_set_ratio(normalized_input_name, normalized_db_name)
-
-        # If the match score is greater than the suggestion threshold, add the product to the list
-        # For example, the default suggestion threshold is 60
-        # If the match score is 60 or higher, it will be added to the list
-        if match_score >= suggestion_threshold:
-            scored_products.append({
-                'product': product,
-                'match_score': match_score
-            })
+    # Keep the products whose score reaches the suggestion threshold
+    # For example, the default suggestion threshold is 60
+    # If the match score is 60 or higher, it will be added to the list
+    keep = scores >= suggestion_threshold
+    candidates, scores = candidates[keep], scores[keep]
+    # Sort them by match_score in descending order, keeping catalog order for ties
+    if max_suggestions is None:
+        order = np.argsort(-scores, kind='stable')
+    else:
+        # Only the best few are returned, so keep them in a bounded heap instead of sorting everything
+        # heapq.nlargest keeps the order of equal scores like a stable sort
+        score_list = scores.tolist()
+        order = heapq.nlargest(max_suggestions, range(len(score_list)), key=score_list.__getitem__)
+    catalog = index.catalog
+    scored_products = [{
+        'row': int(index.rows[candidates[i]]),
+        'match_score': int(scores[i])
+    } for i in order]
 
     # Copy the item and rename product_name to original_name
     enhanced_item = item.copy()
@@ -93,31 +228,28 @@ def fuzzy_match_product(item: dict, product_db: list[dict], threshold: int = 85,
             'possible_matches': [""]
         })
         return enhanced_item
-
-    # Sort the scored products by match_score in descending order
-    scored_products.sort(key=lambda x: x['match_score'], reverse=True)
     
     # Get the best match from the list
     best_match_info = scored_products[0]
     highest_score = best_match_info['match_score']
-    best_match = best_match_info['product']
+    best_row = best_match_info['row']
 
     # If the best match score is greater than the threshold, update the enhanced item
     # For example, the default threshold is 85
     # If the match score is 85 or higher, it will be updated
     if highest_score >= threshold:
         enhanced_item.update({
-            'product_id': best_match.get('product_id'),
-            'matched_name': best_match.get('product_name'),
-            'unit': best_match.get('unit'),
+            'product_id': catalog.product_ids[best_row],
+            'matched_name': catalog.product_names[best_row],
+            'unit': catalog.units[best_row],
             'match_score': highest_score
         })
     else:
         # Otherwise, set the possible matches
         suggestions = [{
-            'product_id': p['product'].get('product_id'),
-            'matched_name': p['product'].get('product_name'),
-            'unit': p['product'].get('unit'),
+            'product_id': catalog.product_ids[p['row']],
+            'matched_name': catalog.product_names[p['row']],
+            'unit': catalog.units[p['row']],
             'match_score': p['match_score']
         } for p in scored_products]
         
@@ -128,4 +260,4 @@ def fuzzy_match_product(item: dict, product_db: list[dict], threshold: int = 85,
             'possible_matches': suggestions
         })
         
-    return enhanced_item
\ No newline at end of file
+    return enhanced_item
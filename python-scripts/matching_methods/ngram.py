@@ -0,0 +1,132 @@
+from collections import Counter
+import numpy as np
+
+# Recall modes for candidate pruning
+#   exact: only drop products that provably can't reach the suggestion threshold
+#   ngram: only keep products sharing at least one n-gram with the item (faster, may miss typos)
+#   off:   score every product
+PRUNING_MODES = ('exact', 'ngram', 'off')
+
+def canonical_tokens(text: str) -> str:
+    """
+    Join the unique whitespace tokens of a processed name in sorted order.
+    This is the string token_set_ratio effectively compares, so its length and
+    characters bound the score.
+    """
+    return ' '.join(sorted(set(text.split())))
+
+def extract_ngrams(text: str, n: int = 2) -> set[str]:
+    """
+    Get the character n-grams of every token in a processed name.
+    Chinese names have no word boundaries, so bigrams are used by default,
+    e.g. "肉皮豬皮" -> {"肉皮", "皮豬", "豬皮"}. Tokens shorter than n are kept whole.
+    """
+    grams = set()
+    for token in text.split():
+        if len(token) <= n:
+            grams.add(token)
+        else:
+            grams.update(token[i:i + n] for i in range(len(token) - n + 1))
+    return grams
+
+class NgramIndex:
+    """
+    Inverted index over processed catalog names used to pick, for each invoice
+    item, the small set of products worth scoring with token_set_ratio.
+    """
+
+    def __init__(self, names: list[str], n: int = 2):
+        self.n = n
+        self.size = len(names)
+
+        lengths = np.zeros(self.size, dtype=np.int32)
+        spaces = np.zeros(self.size, dtype=np.int32)
+        char_postings = {}
+        gram_postings = {}
+        for i, name in enumerate(names):
+            canonical = canonical_tokens(name)
+            lengths[i] = len(canonical)
+            spaces[i] = canonical.count(' ')
+            for char, count in Counter(canonical.replace(' ', '')).items():
+                char_postings.setdefault(char, ([], []))
+                char_postings[char][0].append(i)
+                char_postings[char][1].append(count)
+            for gram in extract_ngrams(name, n):
+                gram_postings.setdefault(gram, []).append(i)
+
+        self.lengths = lengths
+        self.spaces = spaces
+        # Output: {char: (product indices, occurrences in each product)}
+        self.char_postings = {
+            char: (np.array(ids, dtype=np.int32), np.array(counts, dtype=np.int32))
+            for char, (ids, counts) in char_postings.items()
+        }
+        # Output: {n-gram: product indices}
+        self.gram_postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in gram_postings.items()}
+
+    @classmethod
+    def from_postings(cls, n: int, lengths: np.ndarray, spaces: np.ndarray, char_postings: dict,
+                      gram_postings: dict) -> 'NgramIndex':
+        """Wrap prebuilt arrays and postings, e.g. the ones stored in a catalog snapshot"""
+        index = cls.__new__(cls)
+        index.n = n
+        index.size = len(lengths)
+        index.lengths = lengths
+        index.spaces = spaces
+        index.char_postings = char_postings
+        index.gram_postings = gram_postings
+        return index
+
+    def candidates(self, query: str, suggestion_threshold: int, mode: str = 'exact'):
+        """
+        Return the sorted indices of the products worth scoring against `query`,
+        or None if every product has to be scored.
+        """
+        if mode == 'ngram':
+            postings = [self.gram_postings[g] for g in extract_ngrams(query, self.n) if g in self.gram_postings]
+            if not postings:
+                return np.zeros(0, dtype=np.int32)
+            return np.unique(np.concatenate(postings))
+
+        if mode != 'exact':
+            return None
+        return self._exact_candidates(query, suggestion_threshold)
+
+    def containing(self, query: str):
+        """Return the sorted indices of the products containing every character of `query`"""
+        ids = None
+        for char in set(query.replace(' ', '')):
+            posting = self.char_postings.get(char)
+            if posting is None:
+                return np.zeros(0, dtype=np.int32)
+            ids = posting[0] if ids is None else np.intersect1d(ids, posting[0], assume_unique=True)
+        return ids if ids is not None else np.zeros(0, dtype=np.int32)
+
+    def _exact_candidates(self, query: str, suggestion_threshold: int):
+        """
+        Keep every product whose token_set_ratio against `query` could round up
+        to `suggestion_threshold`, so pruning never changes the result.
+
+        With c the number of characters (spaces included) two canonical names share
+        and Lq, Lp their lengths, every ratio token_set_ratio takes the max of is
+        at most 2c / (c + min(Lq, Lp)). A product sharing no character except
+        spaces can't score 50 or more, so it is dropped once the threshold is above 50.
+        """
+        canonical = canonical_tokens(query)
+        if not canonical or suggestion_threshold <= 50:
+            return None
+
+        # Count the characters each product shares with the query
+        overlap = np.zeros(self.size, dtype=np.int32)
+        for char, count in Counter(canonical.replace(' ', '')).items():
+            posting = self.char_postings.get(char)
+            if posting is None:
+                continue
+            ids, counts = posting
+            overlap[ids] += np.minimum(counts, count)
+
+        candidates = np.flatnonzero(overlap)
+        shared = overlap[candidates] + np.minimum(canonical.count(' '), self.spaces[candidates])
+        upper_bound = 200 * shared / (shared + np.minimum(len(canonical), self.lengths[candidates]))
+        # Scores are rounded, so anything from threshold - 0.5 may still reach it
+        return candidates[upper_bound >= suggestion_threshold - 0.5 - 1e-9]
@@ -0,0 +1,47 @@
+"""
+Text normalization shared by every matcher, the alias map and the index builders.
+
+Scanned Chinese invoices mix full-width and half-width forms of the same
+characters, e.g. "ＡＢＣ牛奶" and "ABC牛奶", or "（大）" and "(大)". Unicode NFKC
+folds them to one form before anything else is done with the text.
+Catalog names are normalized again every time an index is rebuilt, so the
+catalog variants are memoized and a reload only pays for the names that changed.
+"""
+
+from functools import lru_cache
+import unicodedata
+
+# Number of catalog strings remembered by the memoized variants
+CATALOG_CACHE_SIZE = 1 << 18
+
+# Separators removed from product names, backslashes included as they are used like slashes
+SEPARATORS_TABLE = str.maketrans('', '', '()/,-\\')
+
+def fold_width(text: str) -> str:
+    """Fold full-width/half-width forms and other compatibility characters with NFKC"""
+    # ASCII text is already in NFKC
+    if text.isascii():
+        return text
+    return unicodedata.normalize('NFKC', text)
+
+def normalize_key(text: str) -> str:
+    """
+    Key of an item name for exact lookups: folded, stripped and lowercased.
+    Used by the alias map, exact matching and the match cache.
+    """
+    return fold_width(text).strip().lower()
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text by folding its width, lowercasing, removing separators and extra spaces.
+    """
+    text = fold_width(text).lower()
+    text = text.translate(SEPARATORS_TABLE)
+    return ' '.join(text.split())
+
+def memoize_catalog(func):
+    """Memoize a normalization function for catalog strings"""
+    return lru_cache(maxsize=CATALOG_CACHE_SIZE)(func)
+
+normalize_catalog_key = memoize_catalog(normalize_key)
+normalize_catalog_text = memoize_catalog(normalize_text)
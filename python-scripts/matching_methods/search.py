@@ -0,0 +1,77 @@
+import bisect
+import heapq
+from .catalog import ProductCatalog, as_catalog
+from .fuzzy import FuzzyMatchIndex, prepare_text
+from .normalize import normalize_catalog_key, normalize_key
+
+class ProductSearchIndex:
+    """
+    Product names sorted by their lookup key, for prefix search.
+    Built once per catalog and reused by every search.
+    """
+
+    def __init__(self, product_db: ProductCatalog, version: str = None):
+        # Version of the catalog this index was built from
+        self.version = version
+        self.catalog = product_db = as_catalog(product_db)
+
+        # Output: {product name key: row}, the first row wins on duplicates
+        entries = {}
+        for row, product_name in enumerate(product_db.product_names):
+            if not product_name or not isinstance(product_name, str):
+                continue
+            entries.setdefault(normalize_catalog_key(product_name), row)
+        self.keys = sorted(entries)
+        self.rows = [entries[key] for key in self.keys]
+
+    def prefix(self, key: str, limit: int) -> list[int]:
+        """Return the rows of up to `limit` products whose key starts with `key`, in key order"""
+        rows = []
+        for i in range(bisect.bisect_left(self.keys, key), len(self.keys)):
+            if len(rows) >= limit or not self.keys[i].startswith(key):
+                break
+            rows.append(self.rows[i])
+        return rows
+
+def search_products(query: str, search_index: ProductSearchIndex, fuzzy_index: FuzzyMatchIndex,
+                    limit: int = 20) -> list[dict]:
+    """
+    Find the products best matching a typed query, at most `limit` of them.
+    Products whose name starts with the query come first, then the products sharing
+    a bigram with it (or containing all its characters for one-character queries)
+    ranked by fuzzy score. An empty query returns the first products in name order.
+    """
+    catalog = search_index.catalog
+    key = normalize_key(query)
+    rows = search_index.prefix(key, limit)
+    results = [search_result(catalog, row, 100, 'prefix') for row in rows]
+    if not key or len(results) >= limit:
+        return results
+
+    # Rank the products sharing a bigram with the query by their fuzzy score
+    prepared = prepare_text(query)
+    ngram_index = fuzzy_index.ngram_index
+    candidates = ngram_index.candidates(prepared, 0, 'ngram')
+    if not len(candidates):
+        candidates = ngram_index.containing(prepared)
+    scores = fuzzy_index.score_candidates(prepared, candidates).tolist()
+    seen_keys = {normalize_catalog_key(catalog.product_names[row]) for row in rows}
+    for i in heapq.nlargest(limit + len(rows), range(len(scores)), key=scores.__getitem__):
+        row = int(fuzzy_index.rows[candidates[i]])
+        name_key = normalize_catalog_key(catalog.product_names[row])
+        if name_key in seen_keys:
+            continue
+        seen_keys.add(name_key)
+        results.append(search_result(catalog, row, scores[i], 'fuzzy'))
+        if len(results) >= limit:
+            break
+    return results
+
+def search_result(catalog: ProductCatalog, row: int, match_score: int, match_type: str) -> dict:
+    return {
+        'product_id': catalog.product_ids[row],
+        'product_name': catalog.product_names[row],
+        'unit': catalog.units[row],
+        'match_score': match_score,
+        'match_type': match_type
+    }
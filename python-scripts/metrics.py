@@ -0,0 +1,338 @@
+"""
+Request timing instrumentation and Prometheus-style metrics.
+
+StageTimer measures the stages of one request. The module-level histograms
+and counters aggregate them over all requests handled by this process and
+are rendered in the Prometheus text exposition format by /metrics.
+
+Under gunicorn a scrape is answered by any one worker, so every process also
+writes its values to its own file in a shared directory, at most every
+FLUSH_INTERVAL seconds, and /metrics renders the sum over every file. The files
+of workers that exited are folded into one file of totals, so the sums never
+go backwards when a worker is restarted.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Seconds between two writes of the metrics of a process to the shared directory
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '1'))
+# File of the totals of the processes that exited
+EXITED_FILE = 'exited.json'
+
+# Set while recording is suspended, see `suspended()`
+_suspended = False
+# Directory shared by the processes whose metrics are summed, see `use_shared_directory()`
+_directory = None
+# Process writing the values held by this module, they are inherited on fork
+_process_pid = None
+_changed = False
+_process_lock = threading.Lock()
+
+
+class StageTimer:
+    """Collects the duration of the named stages of one request"""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the enclosed block, adding to the stage if it runs more than once"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+
+@contextmanager
+def time_stage(timer: StageTimer, name: str):
+    """Time the enclosed block with `timer`, or do nothing if it is None"""
+    if timer is None:
+        yield
+    else:
+        with timer.stage(name):
+            yield
+
+
+@contextmanager
+def suspended():
+    """Record nothing meanwhile, e.g. while the startup self-benchmark sends synthetic requests"""
+    global _suspended
+    _suspended = True
+    try:
+        yield
+    finally:
+        _suspended = False
+
+
+def escape_label_value(value) -> str:
+    """Escape backslashes, quotes and newlines in a label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: dict) -> str:
+    """Format labels as {name="value",...}"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        if _suspended:
+            return
+        before_record()
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        after_record()
+
+    def values(self) -> dict:
+        """Copy of {label values: value}"""
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    @staticmethod
+    def merge(value, other):
+        return (value or 0) + other
+
+    def render(self, values: dict = None) -> list[str]:
+        """Render `values`, this process's values by default"""
+        values = self.values() if values is None else values
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(dict(zip(self.labelnames, key)))} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative histogram with labels"""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # Output: {label values: [bucket counts..., sum, count]}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        if _suspended:
+            return
+        before_record()
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            data = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+        after_record()
+
+    def values(self) -> dict:
+        """Copy of {label values: [bucket counts..., sum, count]}"""
+        with self._lock:
+            return {key: list(data) for key, data in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    @staticmethod
+    def merge(data, other):
+        return [a + b for a, b in zip(data, other)] if data is not None else list(other)
+
+    def render(self, values: dict = None) -> list[str]:
+        """Render `values`, this process's values by default"""
+        values = self.values() if values is None else values
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, data in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, data):
+                lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': repr(bound)})} {count}")
+            lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': '+Inf'})} {data[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {data[-2]}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {data[-1]}")
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    'invoice_request_duration_seconds', "Time spent handling a matching request.",
+    ('endpoint', 'match_method'))
+STAGE_DURATION = Histogram(
+    'invoice_stage_duration_seconds', "Time spent in each stage of a matching request.",
+    ('stage', 'match_method'))
+ITEMS_MATCHED = Counter(
+    'invoice_items_matched_total', "Invoice items matched, by the matcher that matched them.",
+    ('matcher',))
+ITEMS_UNMATCHED = Counter(
+    'invoice_items_unmatched_total', "Invoice items left without a product.",
+    ('match_method',))
+
+RESPONSE_CACHE_REQUESTS = Counter(
+    'invoice_response_cache_requests_total', "Matching requests by how the response cache served them.",
+    ('result',))
+
+REGISTRY = [REQUEST_DURATION, STAGE_DURATION, ITEMS_MATCHED, ITEMS_UNMATCHED, RESPONSE_CACHE_REQUESTS]
+
+
+def observe_stages(timer: StageTimer, match_method: str):
+    """Add the stage durations of one request to the stage histogram"""
+    for stage, seconds in timer.timings.items():
+        STAGE_DURATION.observe(seconds, stage=stage, match_method=match_method)
+
+
+def render_metrics() -> str:
+    """Render every metric in the Prometheus text exposition format, summed over every process sharing them"""
+    others = read_other_processes() if _directory is not None else []
+    lines = []
+    for metric in REGISTRY:
+        values = metric.values()
+        for data in others:
+            for key, value in data.get(metric.name, []):
+                key = tuple(key)
+                values[key] = metric.merge(values.get(key), value)
+        lines.extend(metric.render(values))
+    return '\n'.join(lines) + '\n'
+
+
+# --- Metrics shared by several processes ---
+
+def use_shared_directory(path: str):
+    """
+    Sum the metrics of every process writing to `path`, e.g. the gunicorn workers.
+    Call it once before forking them, it removes the files left by an earlier run.
+    """
+    global _directory
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(path, name))
+    _directory = path
+
+
+def get_process_path(pid: int) -> str:
+    return os.path.join(_directory, f'{pid}.json')
+
+
+def before_record():
+    """Start writing the metrics of this process on its first record, forgetting the values of the parent"""
+    global _process_pid
+    if _directory is None or _process_pid == os.getpid():
+        return
+    with _process_lock:
+        if _process_pid == os.getpid():
+            return
+        # The parent keeps reporting the values recorded before the fork
+        if _process_pid is not None:
+            for metric in REGISTRY:
+                metric.reset()
+        _process_pid = os.getpid()
+        threading.Thread(target=flush_periodically, name='metrics-flush', daemon=True).start()
+
+
+def after_record():
+    global _changed
+    _changed = True
+
+
+def flush_periodically():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+
+def flush():
+    """Write the metrics of this process to its file in the shared directory, if they changed"""
+    global _changed
+    if _directory is None or _process_pid != os.getpid() or not _changed:
+        return
+    _changed = False
+    data = {metric.name: [[list(key), value] for key, value in metric.values().items()] for metric in REGISTRY}
+    path = get_process_path(os.getpid())
+    try:
+        write_json(path, data)
+    except OSError as e:
+        _changed = True
+        print(f"Writing metrics to {path} failed: {e}")
+
+
+def mark_process_dead(pid: int):
+    """Fold the metrics of a process that exited into the totals of exited processes"""
+    if _directory is None:
+        return
+    path = get_process_path(pid)
+    with shared_lock(fcntl.LOCK_EX):
+        data = read_json(path)
+        if data is None:
+            return
+        exited_path = os.path.join(_directory, EXITED_FILE)
+        totals = read_json(exited_path) or {}
+        for metric in REGISTRY:
+            values = {tuple(key): value for key, value in totals.get(metric.name, [])}
+            for key, value in data.get(metric.name, []):
+                key = tuple(key)
+                values[key] = metric.merge(values.get(key), value)
+            totals[metric.name] = [[list(key), value] for key, value in values.items()]
+        # Readers hold the lock, so they never see the process counted twice or not at all
+        write_json(exited_path, totals)
+        os.remove(path)
+
+
+def read_other_processes() -> list[dict]:
+    """Read the metrics written by the other processes and the totals of the exited ones"""
+    own_name = os.path.basename(get_process_path(os.getpid()))
+    with shared_lock(fcntl.LOCK_SH):
+        names = [name for name in os.listdir(_directory) if name.endswith('.json') and name != own_name]
+        return [data for data in (read_json(os.path.join(_directory, name)) for name in names) if data]
+
+
+@contextmanager
+def shared_lock(operation: int):
+    """Hold the lock of the shared directory"""
+    with open(os.path.join(_directory, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_json(path: str):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path: str, data: dict):
+    """Replace the file in one step, readers never see it half written"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
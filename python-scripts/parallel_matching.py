@@ -0,0 +1,183 @@
+"""
+Process pool for fuzzy matching the items of one large invoice in parallel.
+
+The pool processes are forked from the service process once its catalog is
+loaded, so they start with the catalog and the fuzzy index already in memory
+and only reload them if the product database changes. The item names of a
+request are split into chunks, matched across the pool and merged back in
+their original order. Names whose chunk didn't finish within the request's
+time budget are returned for review instead of letting the request time out.
+
+A request only keeps as many chunks in the pool as it has processes, and the
+pool processes stop matching a chunk once its deadline passes, so a request
+that ran out of time doesn't leave work queued behind it for the next one.
+"""
+
+import concurrent.futures
+import math
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from matching_methods import fuzzy_matching, FuzzyMatchIndex
+
+# Number of processes in the pool, 0 disables parallel matching
+MATCH_POOL_SIZE = int(os.environ.get('MATCH_POOL_SIZE', '0'))
+# Default seconds a parallel request may spend matching
+MATCH_TIME_BUDGET = float(os.environ.get('MATCH_TIME_BUDGET', '20'))
+# Names per chunk are chosen so every process gets a few chunks,
+# small chunks make the time budget more precise
+CHUNKS_PER_PROCESS = 4
+
+# Catalog store of the pool process, set by _init_process
+_store = None
+
+
+def _init_process(store):
+    """Runs in every pool process after fork"""
+    global _store
+    _store = store
+    # Leave signal handling to the parent, the pool exits when it does
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _match_chunk(names: list[str], fuzzy_options: dict, debug: bool, deadline: float):
+    """
+    Fuzzy match a chunk of names in a pool process, returns (matched items, pruning stats).
+    Names left once `deadline` passes are returned as Review Required without matching them.
+    """
+    snapshot = _store.get_snapshot()
+    index = snapshot.get_index('fuzzy', FuzzyMatchIndex)
+    stats = {} if debug else None
+    items = []
+    for name in names:
+        if time.time() >= deadline:
+            items.append(review_required_match(name))
+            continue
+        names_data = {'items': [{'product_name': name}]}
+        names_data = fuzzy_matching(names_data, snapshot.product_db, index=index, stats=stats, **fuzzy_options)
+        items.extend(names_data['items'])
+    return items, stats
+
+
+def review_required_match(name: str) -> dict:
+    """Result of a name that wasn't matched within the time budget"""
+    return {
+        'original_name': name,
+        'product_id': None,
+        'matched_name': None,
+        'match_score': 0,
+        'possible_matches': [],
+        'status': 'Review Required',
+        'review_reason': 'time_budget_exceeded'
+    }
+
+
+class MatchPool:
+    """Pool of forked processes matching invoice item names in parallel"""
+
+    def __init__(self, store, size: int = MATCH_POOL_SIZE):
+        self.store = store
+        self.size = size
+        self._executor = None
+        self._lock = threading.Lock()
+        # Chunks submitted by any request and not finished yet
+        self._busy_chunks = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def start(self):
+        """
+        Fork the pool processes now.
+        Call it after the catalog is loaded and before the process starts serving
+        requests from several threads, forking is only safe while single threaded.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.size,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_init_process,
+                    initargs=(self.store,)
+                )
+                # Processes are forked on the first submit, do it now
+                self._executor.submit(os.getpid).result()
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def stats(self) -> dict:
+        """Size of the pool and number of chunks it is still working on"""
+        with self._lock:
+            return {'size': self.size, 'busy_chunks': self._busy_chunks}
+
+    def match_names(self, names: list[str], fuzzy_options: dict, deadline: float,
+                    pruning_stats: dict = None) -> tuple[list[dict], int]:
+        """
+        Fuzzy match `names` across the pool until `deadline` (a time.time() value).
+        `fuzzy_options` holds the threshold, suggestion_threshold and max_suggestions.
+        Returns the matched items in the order of `names` and the number of names that
+        ran out of time, which are returned as Review Required.
+        """
+        executor = self.start()
+        chunk_size = max(1, math.ceil(len(names) / (self.size * CHUNKS_PER_PROCESS)))
+        chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+
+        # Keep at most one chunk per process in the pool, the next chunk is only
+        # submitted once one finishes, and none are submitted after the deadline
+        futures = []
+        pending = set()
+        while True:
+            while len(futures) < len(chunks) and len(pending) < self.size and time.time() < deadline:
+                future = self._submit(executor, chunks[len(futures)], fuzzy_options, pruning_stats is not None, deadline)
+                futures.append(future)
+                pending.add(future)
+            if not pending:
+                break
+            done, pending = concurrent.futures.wait(pending, timeout=max(0.0, deadline - time.time()),
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                break
+
+        # Merge the results back in the original order
+        matched_items = []
+        timed_out = 0
+        for i, chunk in enumerate(chunks):
+            future = futures[i] if i < len(futures) else None
+            if future is not None and future.done():
+                items, stats = future.result()
+                matched_items.extend(items)
+                timed_out += sum(1 for item in items if item.get('review_reason') == 'time_budget_exceeded')
+                for key, value in (stats or {}).items():
+                    if key == 'catalog_size':
+                        pruning_stats[key] = value
+                    else:
+                        pruning_stats[key] = pruning_stats.get(key, 0) + value
+            else:
+                # Running chunks stop at the deadline on their own, chunks never submitted are skipped
+                matched_items.extend(review_required_match(name) for name in chunk)
+                timed_out += len(chunk)
+        return matched_items, timed_out
+
+    def _submit(self, executor, *args) -> concurrent.futures.Future:
+        """Submit a chunk to the pool and count it as busy until it finishes"""
+        future = executor.submit(_match_chunk, *args)
+        with self._lock:
+            self._busy_chunks += 1
+        # Runs at once if the chunk already finished, after the count was raised
+        future.add_done_callback(self._chunk_done)
+        return future
+
+    def _chunk_done(self, future):
+        with self._lock:
+            self._busy_chunks -= 1
@@ -3,16 +3,88 @@
 Simple Invoice processing service with basic product matching
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, make_response, stream_with_context
 from datetime import datetime, timezone, timedelta
+import functools
+import math
 import os
-import pandas as pd
-from matching_methods import basic_matching, fuzzy_matching, alias_match_item
+from matching_methods import (basic_matching, BasicMatchIndex, fuzzy_matching, FuzzyMatchIndex, alias_match_item,
+                              cascade_matching, get_matchers, ExactMatchIndex, search_products, ProductSearchIndex)
+from catalog_store import CatalogStore
+from match_cache import MatchCache, normalize_cache_name
+from match_memo import MatchMemo
+from response_cache import ResponseCache, CachedResponse, make_request_key
+from parallel_matching import MatchPool, MATCH_TIME_BUDGET
+from metrics import (StageTimer, time_stage, observe_stages, render_metrics,
+                     REQUEST_DURATION, ITEMS_MATCHED, ITEMS_UNMATCHED, RESPONSE_CACHE_REQUESTS)
 import time
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 
+# Product and alias databases are loaded once per process and hot-reloaded on change
+SHARED_DIR = os.path.join(os.path.dirname(__file__), 'shared')
+catalog_store = CatalogStore(SHARED_DIR)
+
+# Results of matching item names, reused until the catalog or alias database changes
+match_cache = MatchCache(int(os.environ.get('MATCH_CACHE_SIZE', '10000')))
+# Match results shared by every worker and kept across restarts, behind the match cache
+match_memo = MatchMemo(os.environ.get('MATCH_MEMO_PATH', os.path.join(SHARED_DIR, 'match_memo.sqlite3')),
+                       int(os.environ.get('MATCH_MEMO_SIZE', '100000')))
+
+# Responses of repeated identical requests, e.g. n8n retries or double submissions
+response_cache = ResponseCache(int(os.environ.get('RESPONSE_CACHE_BYTES', str(64 * 1024 * 1024))),
+                               float(os.environ.get('RESPONSE_CACHE_TTL', '300')))
+
+# Process pool for requests asking to fuzzy match their items in parallel
+match_pool = MatchPool(catalog_store)
+
+# Fuzzy matching thresholds, requests can override them
+FUZZY_THRESHOLD = 85
+FUZZY_SUGGESTION_THRESHOLD = 60
+# Maximum number of possible matches returned per item
+FUZZY_MAX_SUGGESTIONS = int(os.environ.get('FUZZY_MAX_SUGGESTIONS', '10'))
+# Default and maximum number of products returned by /search-products
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+# Formats of the suggestions of unmatched items: possible_matches dicts, or compact suggestions lists
+SUGGESTION_FORMATS = ('full', 'compact')
+# Number of items matched at once in streaming mode, each batch is sent as soon as it is matched
+STREAM_BATCH_ITEMS = int(os.environ.get('STREAM_BATCH_ITEMS', '50'))
+
+def cached_response(view):
+    """
+    Serve repeated submissions of the same request body from the response cache.
+    Identical requests arriving while the first one is being matched share its response.
+    Streaming and diagnostic requests (debug, include_timings) always run.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        data = request.get_json(silent=True)
+        if (not response_cache.enabled or not isinstance(data, dict)
+                or data.get('stream') or data.get('debug') or data.get('include_timings')):
+            return view(*args, **kwargs)
+        try:
+            snapshot = catalog_store.get_snapshot()
+        except FileNotFoundError:
+            return view(*args, **kwargs)
+
+        response_cache.sync_versions(snapshot.catalog_version, snapshot.alias_version)
+        key = make_request_key(request.path, data, snapshot.catalog_version, snapshot.alias_version)
+
+        def compute() -> CachedResponse:
+            response = make_response(view(*args, **kwargs))
+            # Only successful responses are kept, views can opt out with g.response_cacheable
+            cacheable = response.status_code == 200 and g.get('response_cacheable', True)
+            return CachedResponse(response.get_data(), response.status_code, response.mimetype, cacheable)
+
+        cached, result = response_cache.get_or_compute(key, compute)
+        RESPONSE_CACHE_REQUESTS.inc(result=result)
+        response = Response(cached.body, status=cached.status, mimetype=cached.mimetype)
+        response.headers['X-Response-Cache'] = result
+        return response
+    return wrapper
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -23,20 +95,70 @@ def health_check():
         "status": "healthy",
         "timestamp": datetime.now(utc_plus_8).isoformat(),
         "service": "invoice-agent-python",
-        "features": ["basic_matching", "fuzzy_matching"]
+        "features": ["basic_matching", "fuzzy_matching", "cascade_matching", "product_search"],
+        "match_cache": match_cache.stats(),
+        "match_memo": match_memo.stats(),
+        "response_cache": response_cache.stats(),
+        "match_pool": match_pool.stats()
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics of the requests handled by every worker"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/search-products', methods=['GET'])
+def search_products_endpoint():
+    """Find the products matching a typed query, for the product pickers of the review UI"""
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', SEARCH_LIMIT))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= SEARCH_MAX_LIMIT:
+        return jsonify({"success": False,
+                        "message": f"'limit' must be an integer between 1 and {SEARCH_MAX_LIMIT}"}), 400
+
+    try:
+        try:
+            snapshot = catalog_store.get_snapshot()
+        except FileNotFoundError:
+            return jsonify({
+                "success": False,
+                "error": "Product database file not found on the server.",
+                "timestamp": datetime.now().isoformat()
+            }), 500
+
+        # Reuse the indexes built for this catalog version
+        search_index = snapshot.get_index('search', ProductSearchIndex)
+        fuzzy_index = snapshot.get_index('fuzzy', FuzzyMatchIndex)
+        results = search_products(query, search_index, fuzzy_index, limit)
+        return jsonify({
+            "success": True,
+            "timestamp": datetime.now().isoformat(),
+            "query": query,
+            "catalog_version": snapshot.catalog_version,
+            "results": results
+        })
+
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "timestamp": datetime.now().isoformat()
+        }), 500
+
 @app.route('/process-invoice', methods=['POST'])
+@cached_response
 def process_invoice():
     """Process invoice data sent from n8n with basic matching"""
     start_time = time.time()
+    timer = StageTimer()
     try:
-        # Load product database from a fixed path
+        # Get the product and alias databases from the in-memory store
         try:
-            shared_dir = os.path.join(os.path.dirname(__file__), 'shared')
-            product_db_path = os.path.join(shared_dir, 'product_db.csv')
-            df = pd.read_csv(product_db_path)
-            product_db = df.to_dict(orient='records')
+            with timer.stage('catalog_load'):
+                snapshot = catalog_store.get_snapshot()
         except FileNotFoundError:
             return jsonify({
                 "success": False,
@@ -44,23 +166,29 @@ def process_invoice():
                 "timestamp": datetime.now().isoformat()
             }), 500
 
-        # Load alias database
-        alias_db_path = os.path.join(shared_dir, 'product_alias.csv')
-        alias_map = {}
-        if os.path.exists(alias_db_path):
-            print(f"Loading alias database from {alias_db_path}")
-            # Load the alias database
-            alias_df = pd.read_csv(alias_db_path)
-            # Create a map for quick lookups, ensuring keys are lowercase
-            # Output: {alias_name: product_id}
-            alias_map = {str(k).lower(): v for k, v in pd.Series(alias_df.product_id.values, index=alias_df.alias_name).to_dict().items()}
-        else:
-            print(f"Alias database not found at {alias_db_path}")
-
         # Get the invoice data from the request
         data = request.get_json()
         invoice_data = data.get('invoice_data', {})
         match_method = data.get('match_method', 'basic') # Default to basic
+        # Report how many catalog entries were pruned before fuzzy scoring
+        debug = bool(data.get('debug', False))
+        pruning_stats = {} if debug else None
+        # Report how long each stage of the request took
+        include_timings = bool(data.get('include_timings', False))
+        # Match the items across the process pool, within a time budget
+        parallel = bool(data.get('parallel', False))
+        try:
+            deadline = start_time + get_time_budget(data)
+            fuzzy_options = get_fuzzy_options(data)
+            suggestion_format = get_suggestion_format(data)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+
+        # Send one NDJSON line per item as soon as it is matched, then a stats line
+        if data.get('stream', False):
+            lines = stream_invoice(invoice_data, snapshot, match_method, pruning_stats, timer, parallel, deadline,
+                                   fuzzy_options, start_time, include_timings, suggestion_format)
+            return Response(stream_with_context(lines), mimetype='application/x-ndjson')
 
         # Check if the "items" is empty
         if not invoice_data.get('items'):
@@ -77,31 +205,9 @@ def process_invoice():
                 "processed_data": invoice_data
             }), 200
 
-        # Create a product_id -> product names map for quick lookups
-        # Output: {product_id: product_name}
-        product_id_map = {p['product_id']: p for p in product_db}
-
-        # Pre-process items with alias matching
-        processed_items = []
-        items_have_no_alias = []
-        for item in invoice_data.get('items', []):
-            matched_item = alias_match_item(item, alias_map, product_id_map)
-            if matched_item:
-                processed_items.append(matched_item)
-            else:
-                items_have_no_alias.append(item)
-        
-        # Process remaining items with the selected method
-        if items_have_no_alias:
-            remaining_invoice_data = invoice_data.copy()
-            remaining_invoice_data['items'] = items_have_no_alias
-            
-            if match_method == 'fuzzy':
-                further_processed_data = fuzzy_matching(remaining_invoice_data, product_db)
-            else:
-                further_processed_data = basic_matching(remaining_invoice_data, product_db)
-            
-            processed_items.extend(further_processed_data['items'])
+        # Match the items with the alias -> basic/fuzzy pipeline
+        processed_items = match_invoices([invoice_data], snapshot, match_method, pruning_stats, timer,
+                                         parallel, deadline, fuzzy_options, suggestion_format)[0]
         
         # Final processed data
         processed_data = invoice_data.copy()
@@ -110,13 +216,29 @@ def process_invoice():
         end_time = time.time()
         processing_time = end_time - start_time
         
-        return jsonify({
+        with timer.stage('stats'):
+            processing_stats = get_processing_stats(processed_data)
+        response = {
             "success": True,
             "timestamp": datetime.now().isoformat(),
             "processing_time": processing_time,
-            "processing_stats": get_processing_stats(processed_data),
+            "processing_stats": processing_stats,
             "processed_data": processed_data
-        })
+        }
+        if parallel:
+            response["timed_out_items"] = count_timed_out(processed_items)
+            # Items that ran out of time may match on a retry
+            if response["timed_out_items"]:
+                g.response_cacheable = False
+        if debug:
+            response["pruning_stats"] = pruning_stats
+        if include_timings:
+            # Serialization runs after this, so it is only reported on /metrics
+            response["stage_timings"] = dict(timer.timings)
+        with timer.stage('serialization'):
+            json_response = jsonify(response)
+        record_request_metrics('/process-invoice', match_method, timer, start_time)
+        return json_response
         
     except Exception as e:
         return jsonify({
@@ -125,27 +247,409 @@ def process_invoice():
             "timestamp": datetime.now().isoformat()
         }), 500
 
+@app.route('/process-invoices', methods=['POST'])
+@cached_response
+def process_invoices():
+    """
+    Process a batch of invoices in one request.
+    Identical item names across the whole batch are matched only once.
+    """
+    start_time = time.time()
+    timer = StageTimer()
+    try:
+        # Get the product and alias databases from the in-memory store
+        try:
+            with timer.stage('catalog_load'):
+                snapshot = catalog_store.get_snapshot()
+        except FileNotFoundError:
+            return jsonify({
+                "success": False,
+                "error": "Product database file not found on the server.",
+                "timestamp": datetime.now().isoformat()
+            }), 500
+
+        # Get the invoices from the request
+        data = request.get_json()
+        invoices = data.get('invoices')
+        if not isinstance(invoices, list):
+            return jsonify({"success": False, "message": "'invoices' must be a list of invoice data"}), 400
+        match_method = data.get('match_method', 'basic') # Default to basic
+        # Report how many catalog entries were pruned before fuzzy scoring
+        debug = bool(data.get('debug', False))
+        pruning_stats = {} if debug else None
+        # Report how long each stage of the request took
+        include_timings = bool(data.get('include_timings', False))
+        # Match the items across the process pool, within a time budget
+        parallel = bool(data.get('parallel', False))
+        try:
+            deadline = start_time + get_time_budget(data)
+            fuzzy_options = get_fuzzy_options(data)
+            suggestion_format = get_suggestion_format(data)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+
+        # Match the items of all invoices with the alias -> basic/fuzzy pipeline
+        invoices_items = match_invoices(invoices, snapshot, match_method, pruning_stats, timer, parallel, deadline,
+                                        fuzzy_options, suggestion_format)
+
+        results = []
+        all_items = []
+        with timer.stage('stats'):
+            for invoice_data, processed_items in zip(invoices, invoices_items):
+                processed_data = invoice_data.copy()
+                # Invoices without items are returned as they are
+                if invoice_data.get('items'):
+                    processed_data['items'] = processed_items
+                all_items.extend(processed_items)
+                results.append({
+                    "processing_stats": get_processing_stats(processed_data),
+                    "processed_data": processed_data
+                })
+
+            # Aggregate statistics over the whole batch
+            processing_stats = {
+                'total_invoices': len(invoices),
+                'distinct_item_names': len({item.get('original_name', item.get('product_name')) for item in all_items}),
+                **get_processing_stats({'items': all_items})
+            }
+
+        end_time = time.time()
+        processing_time = end_time - start_time
+
+        response = {
+            "success": True,
+            "timestamp": datetime.now().isoformat(),
+            "processing_time": processing_time,
+            "processing_stats": processing_stats,
+            "results": results
+        }
+        if parallel:
+            response["timed_out_items"] = count_timed_out(all_items)
+            # Items that ran out of time may match on a retry
+            if response["timed_out_items"]:
+                g.response_cacheable = False
+        if debug:
+            response["pruning_stats"] = pruning_stats
+        if include_timings:
+            # Serialization runs after this, so it is only reported on /metrics
+            response["stage_timings"] = dict(timer.timings)
+        with timer.stage('serialization'):
+            json_response = jsonify(response)
+        record_request_metrics('/process-invoices', match_method, timer, start_time)
+        return json_response
+
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "timestamp": datetime.now().isoformat()
+        }), 500
+
+def stream_invoice(invoice_data: dict, snapshot, match_method: str, pruning_stats: dict, timer: StageTimer,
+                   parallel: bool, deadline: float, fuzzy_options: dict, start_time: float, include_timings: bool,
+                   suggestion_format: str = 'full'):
+    """
+    Match the items of an invoice in batches and yield the NDJSON lines of the streaming response.
+    Every item is sent as {"type": "item", "index": ..., "item": ...} once its batch is matched, where
+    index is its position in the request. The last line is {"type": "stats", ...} with the processing
+    stats and the invoice without its items, or {"type": "error", ...} if matching failed.
+    Only the current batch is kept in memory, the items already sent are dropped.
+    """
+    items = invoice_data.get('items') or []
+    processing_stats = ProcessingStats()
+    timed_out_items = 0
+    try:
+        for start in range(0, len(items), STREAM_BATCH_ITEMS):
+            batch = items[start:start + STREAM_BATCH_ITEMS]
+            # One invoice per item keeps the items in their original order, alias matches included
+            invoices_items = match_invoices([{'items': [item]} for item in batch], snapshot, match_method,
+                                            pruning_stats, timer, parallel, deadline, fuzzy_options,
+                                            suggestion_format)
+            for index, processed_items in enumerate(invoices_items, start):
+                for item in processed_items:
+                    processing_stats.add(item)
+                    if item.get('review_reason') == 'time_budget_exceeded':
+                        timed_out_items += 1
+                    with timer.stage('serialization'):
+                        line = app.json.dumps({"type": "item", "index": index, "item": item})
+                    yield line + '\n'
+
+        response = {
+            "type": "stats",
+            "success": True,
+            "timestamp": datetime.now().isoformat(),
+            "processing_time": time.time() - start_time,
+            "processing_stats": processing_stats.result(),
+            "processed_data": {key: value for key, value in invoice_data.items() if key != 'items'}
+        }
+        if parallel:
+            response["timed_out_items"] = timed_out_items
+        if pruning_stats is not None:
+            response["pruning_stats"] = pruning_stats
+        if include_timings:
+            response["stage_timings"] = dict(timer.timings)
+        yield app.json.dumps(response) + '\n'
+        record_request_metrics('/process-invoice', match_method, timer, start_time)
+    except Exception as e:
+        # The status code is already sent, so report the error in the stream
+        yield app.json.dumps({
+            "type": "error",
+            "success": False,
+            "error": str(e),
+            "timestamp": datetime.now().isoformat()
+        }) + '\n'
+
+def match_invoices(invoices: list[dict], snapshot, match_method: str = 'basic', pruning_stats: dict = None,
+                   timer: StageTimer = None, parallel: bool = False, deadline: float = None,
+                   fuzzy_options: dict = None, suggestion_format: str = 'full') -> list[list[dict]]:
+    """
+    Match the items of several invoices with the alias -> basic/fuzzy pipeline,
+    or with the matcher cascade if `match_method` is 'cascade'.
+    Items are first matched against the alias map, then every distinct remaining
+    item name is matched once and the result is copied to all items with that name.
+    The cascade matches aliases itself, so its items keep their original order.
+    Pass a `timer` to measure each stage.
+    With `parallel`, fuzzy matching is split across the process pool, and names not
+    matched by `deadline` are returned as Review Required.
+    `fuzzy_options` overrides the fuzzy thresholds and suggestion cap, see get_fuzzy_options.
+    With the 'compact' `suggestion_format`, possible matches are returned as compact suggestions.
+    Returns the processed items of each invoice, alias matches first.
+    """
+    method = get_method(match_method)
+    fuzzy_options = fuzzy_options or get_fuzzy_options({})
+
+    # Pre-process items with alias matching
+    alias_matched_items = []
+    items_have_no_alias = []
+    with time_stage(timer, 'alias_pass'):
+        for invoice_data in invoices:
+            matched_items = []
+            remaining_items = []
+            for item in invoice_data.get('items') or []:
+                # The alias matcher is the first tier of the cascade
+                if method == 'cascade':
+                    remaining_items.append(item)
+                    continue
+                matched_item = alias_match_item(item, snapshot.alias_map, snapshot.product_db)
+                if matched_item:
+                    matched_items.append(matched_item)
+                else:
+                    remaining_items.append(item)
+            alias_matched_items.append(matched_items)
+            items_have_no_alias.append(remaining_items)
+
+    # Distinct names of the items the alias map didn't match
+    distinct_names = list(dict.fromkeys(
+        item.get('product_name', '') for items in items_have_no_alias for item in items
+    ))
+
+    # Reuse the cached results of names matched by earlier requests
+    with time_stage(timer, 'cache_lookup'):
+        match_cache.sync_versions(snapshot.catalog_version, snapshot.alias_version)
+        thresholds = tuple(sorted(fuzzy_options.items())) if method in ('fuzzy', 'cascade') else None
+        matches = {}
+        cache_keys = {}
+        for name in distinct_names:
+            cache_name = normalize_cache_name(name)
+            if cache_name is None:
+                continue
+            cache_key = (cache_name, match_method, thresholds, snapshot.catalog_version, snapshot.alias_version)
+            cached = match_cache.get(cache_key)
+            if cached is not None:
+                matches[name] = cached
+            else:
+                cache_keys[name] = cache_key
+        # Names this process hasn't seen may have been matched by another worker or before a restart
+        memoized = match_memo.get_many(list(cache_keys.values()))
+        for name, cache_key in list(cache_keys.items()):
+            if cache_key in memoized:
+                matches[name] = memoized[cache_key]
+                match_cache.put(cache_key, memoized[cache_key])
+                del cache_keys[name]
+
+    # Process each distinct remaining name once with the selected method
+    names_to_match = [name for name in distinct_names if name not in matches]
+    if names_to_match:
+        with time_stage(timer, f'{method}_pass'):
+            names_data = {'items': [{'product_name': name} for name in names_to_match]}
+            if method == 'fuzzy' and parallel and match_pool.enabled:
+                # The pool processes have their own copy of the fuzzy index
+                matched_items, _ = match_pool.match_names(names_to_match, fuzzy_options, deadline, pruning_stats)
+                names_data = {'items': matched_items}
+            elif method == 'cascade':
+                # Every name stops at the cheapest matcher confident about it
+                names_data = cascade_matching(names_data, snapshot, get_matchers(), fuzzy_options, pruning_stats)
+            elif method == 'fuzzy':
+                # Reuse the normalized catalog names built for this catalog version
+                fuzzy_index = snapshot.get_index('fuzzy', FuzzyMatchIndex)
+                names_data = fuzzy_matching(names_data, snapshot.product_db, index=fuzzy_index, stats=pruning_stats,
+                                            **fuzzy_options)
+            else:
+                # Reuse the lookup index built for this catalog version
+                basic_index = snapshot.get_index('basic', BasicMatchIndex)
+                names_data = basic_matching(names_data, snapshot.product_db, basic_index)
+            new_entries = {}
+            for name, matched in zip(names_to_match, names_data['items']):
+                matches[name] = matched
+                # Names that ran out of time are matched again by the next request
+                if name in cache_keys and 'review_reason' not in matched:
+                    match_cache.put(cache_keys[name], matched)
+                    new_entries[cache_keys[name]] = matched
+        with time_stage(timer, 'memo_write'):
+            match_memo.put_many(new_entries, snapshot.catalog_version, snapshot.alias_version)
+
+    # Fan the results back out to every item
+    with time_stage(timer, 'fan_out'):
+        invoices_items = []
+        # Output: {matcher: number of items}
+        matched_counts = {'alias': sum(len(matched_items) for matched_items in alias_matched_items)}
+        unmatched_count = 0
+        for matched_items, remaining_items in zip(alias_matched_items, items_have_no_alias):
+            processed_items = [apply_match(item, matches[item.get('product_name', '')]) for item in remaining_items]
+            if suggestion_format == 'compact':
+                # Results are cached in the full format, compact them per response
+                processed_items = [compact_suggestions(item) for item in processed_items]
+            for item in processed_items:
+                if item.get('product_id'):
+                    # Cascade items record the tier that matched them
+                    matcher = item.get('match_tier') or method
+                    matched_counts[matcher] = matched_counts.get(matcher, 0) + 1
+                else:
+                    unmatched_count += 1
+            invoices_items.append(matched_items + processed_items)
+
+    # Count the items by the matcher that matched them
+    for matcher, count in matched_counts.items():
+        ITEMS_MATCHED.inc(count, matcher=matcher)
+    ITEMS_UNMATCHED.inc(unmatched_count, match_method=method)
+    return invoices_items
+
+def apply_match(item: dict, matched: dict) -> dict:
+    """Copy the match result of an item name onto an invoice item with that name"""
+    enhanced_item = item.copy()
+    # Rename product_name to original_name
+    if 'original_name' in matched and 'product_name' in enhanced_item:
+        enhanced_item['original_name'] = enhanced_item.pop('product_name')
+    enhanced_item.update({k: v for k, v in matched.items() if k not in ('product_name', 'original_name')})
+
+    # Override subtotal
+    if enhanced_item.get('quantity') and enhanced_item.get('unit_price'):
+        enhanced_item['subtotal'] = enhanced_item['quantity'] * enhanced_item['unit_price']
+
+    return enhanced_item
+
+def compact_suggestions(item: dict) -> dict:
+    """
+    Replace the possible matches of an enhanced item with its compact suggestions,
+    [product_id, matched_name, unit, match_score] lists, best first.
+    """
+    if 'possible_matches' not in item:
+        return item
+    item = item.copy()
+    item['suggestions'] = [
+        [match['product_id'], match['matched_name'], match.get('unit'), match['match_score']]
+        # Items without any candidate have [""] as possible matches
+        for match in item.pop('possible_matches') if isinstance(match, dict)
+    ]
+    return item
+
+def record_request_metrics(endpoint: str, match_method: str, timer: StageTimer, start_time: float):
+    """Add the duration and stage timings of a finished request to the metrics"""
+    method = get_method(match_method)
+    REQUEST_DURATION.observe(time.time() - start_time, endpoint=endpoint, match_method=method)
+    observe_stages(timer, method)
+
+def get_method(match_method: str) -> str:
+    """Matching method of a request, anything unknown falls back to basic"""
+    return match_method if match_method in ('fuzzy', 'cascade') else 'basic'
+
+def get_fuzzy_options(data: dict) -> dict:
+    """
+    Read the fuzzy matching options of a request, falling back to the service defaults.
+    Raises ValueError if one of them is invalid.
+    """
+    options = {
+        'threshold': data.get('threshold', FUZZY_THRESHOLD),
+        'suggestion_threshold': data.get('suggestion_threshold', FUZZY_SUGGESTION_THRESHOLD),
+        'max_suggestions': data.get('max_suggestions', FUZZY_MAX_SUGGESTIONS),
+    }
+    for key in ('threshold', 'suggestion_threshold'):
+        value = options[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 100:
+            raise ValueError(f"'{key}' must be a number between 0 and 100")
+    max_suggestions = options['max_suggestions']
+    if isinstance(max_suggestions, bool) or not isinstance(max_suggestions, int) or max_suggestions < 1:
+        raise ValueError("'max_suggestions' must be a positive integer")
+    return options
+
+def get_suggestion_format(data: dict) -> str:
+    """Read the suggestion format of a request, raises ValueError if it is unknown"""
+    suggestion_format = data.get('suggestion_format', 'full')
+    if suggestion_format not in SUGGESTION_FORMATS:
+        raise ValueError("'suggestion_format' must be one of: " + ', '.join(SUGGESTION_FORMATS))
+    return suggestion_format
+
+def get_time_budget(data: dict) -> float:
+    """Read the time budget of a request in seconds, raises ValueError if it isn't a number >= 0"""
+    try:
+        time_budget = float(data.get('time_budget', MATCH_TIME_BUDGET))
+    except (TypeError, ValueError):
+        raise ValueError("'time_budget' must be a number of seconds")
+    if not math.isfinite(time_budget) or time_budget < 0:
+        raise ValueError("'time_budget' must be a finite number of seconds, 0 or more")
+    return time_budget
+
+def count_timed_out(items: list[dict]) -> int:
+    """Count the items returned as Review Required because the time budget ran out"""
+    return len([item for item in items if item.get('review_reason') == 'time_budget_exceeded'])
+
 def get_processing_stats(invoice_data: dict) -> dict:
     """Get processing statistics"""
-    items = invoice_data.get('items', [])
-    matched_items = len([item for item in items if item.get('product_id')])
-    unmatched_items = len(items) - matched_items
-    
-    stats = {
-        'total_items': len(items),
-        'matched_items': matched_items,
-        'unmatched_items': unmatched_items,
-    }
+    processing_stats = ProcessingStats()
+    for item in invoice_data.get('items', []):
+        processing_stats.add(item)
+    return processing_stats.result()
+
+class ProcessingStats:
+    """Processing statistics collected one item at a time, so streamed items don't have to be kept"""
+
+    def __init__(self):
+        self.total_items = 0
+        self.matched_items = 0
+        # Match scores are only reported if the first item has one, i.e. with fuzzy matching
+        self.has_scores = None
+        self.score_count = 0
+        self.score_sum = 0
+        self.min_score = None
+        self.max_score = None
+
+    def add(self, item: dict):
+        self.total_items += 1
+        if item.get('product_id'):
+            self.matched_items += 1
+        if self.has_scores is None:
+            self.has_scores = 'match_score' in item
+        if self.has_scores and 'match_score' in item:
+            score = item['match_score']
+            self.score_count += 1
+            self.score_sum += score
+            self.min_score = score if self.min_score is None else min(self.min_score, score)
+            self.max_score = score if self.max_score is None else max(self.max_score, score)
 
-    # Add match score stats if available from fuzzy matching
-    if items and 'match_score' in items[0]:
-        scores = [item['match_score'] for item in items if 'match_score' in item]
-        if scores:
-            stats['average_match_score'] = sum(scores) / len(scores)
-            stats['min_match_score'] = min(scores)
-            stats['max_match_score'] = max(scores)
+    def result(self) -> dict:
+        stats = {
+            'total_items': self.total_items,
+            'matched_items': self.matched_items,
+            'unmatched_items': self.total_items - self.matched_items,
+        }
 
-    return stats
+        # Add match score stats if available from fuzzy matching
+        if self.score_count:
+            stats['average_match_score'] = self.score_sum / self.score_count
+            stats['min_match_score'] = self.min_score
+            stats['max_match_score'] = self.max_score
+
+        return stats
 
 @app.route('/update-alias', methods=['POST'])
 def update_alias():
@@ -159,16 +663,10 @@ def update_alias():
     if not items:
         return jsonify({"success": False, "message": "No items provided"}), 400
         
-    shared_dir = os.path.join(os.path.dirname(__file__), 'shared')
-    alias_db_path = os.path.join(shared_dir, 'product_alias.csv')
-    
     try:
-        if os.path.exists(alias_db_path):
-            alias_df = pd.read_csv(alias_db_path)
-        else:
-            alias_df = pd.DataFrame(columns=['alias_name', 'product_id'])
-
-        new_aliases_count = 0
+        aliases = []
+        # Ids of products that aren't in the catalog, an alias to them would never match
+        unknown_product_ids = []
         for item in items:
             original_name = item.get('original_name')
             product_id = item.get('product_id')
@@ -177,26 +675,29 @@ def update_alias():
             # The logic is that original_name is an alias for the product
             # identified by product_id.
             if original_name and product_id:
-                # Check if the alias already exists and points to the same product_id
-                existing_alias = alias_df[alias_df['alias_name'] == original_name]
-                if not existing_alias.empty:
-                    if existing_alias.iloc[0]['product_id'] != product_id:
-                        # Update existing alias if product_id is different
-                        alias_df.loc[alias_df['alias_name'] == original_name, 'product_id'] = product_id
-                        new_aliases_count += 1
-                else:
-                    # Add new alias
-                    new_alias_df = pd.DataFrame([{'alias_name': original_name, 'product_id': product_id}])
-                    alias_df = pd.concat([alias_df, new_alias_df], ignore_index=True)
-                    new_aliases_count += 1
+                # A point lookup once the products are in the database
+                product = catalog_store.find_product(product_id)
+                if product is None:
+                    unknown_product_ids.append(product_id)
+                    continue
+                # Store the id as the catalog has it, e.g. 1002 when "1002" was posted
+                aliases.append((original_name, product['product_id']))
+
+        # Only new aliases and aliases pointing to a different product are written,
+        # appended to the alias journal instead of rewriting the whole CSV
+        new_aliases_count = catalog_store.alias_store.upsert(aliases)
         
         if new_aliases_count > 0:
-            alias_df.to_csv(alias_db_path, index=False)
+            # Cached results may have been computed before these aliases existed
+            match_cache.invalidate()
         
-        return jsonify({
+        response = {
             "success": True, 
             "message": f"Alias database updated. {new_aliases_count} aliases processed."
-        }), 200
+        }
+        if unknown_product_ids:
+            response["unknown_product_ids"] = unknown_product_ids
+        return jsonify(response), 200
         
     except Exception as e:
         return jsonify({
@@ -205,14 +706,47 @@ def update_alias():
             "timestamp": datetime.now().isoformat()
         }), 500
 
+def warm_up():
+    """
+    Load the catalog and build the matching indexes ahead of the first request.
+    Under gunicorn this runs in the master before fork, so workers share the pages.
+    """
+    try:
+        snapshot = catalog_store.get_snapshot()
+    except FileNotFoundError as e:
+        print(f"Skipping catalog warm-up: {e}")
+        return None
+    snapshot.get_index('basic', BasicMatchIndex)
+    snapshot.get_index('fuzzy', FuzzyMatchIndex)
+    snapshot.get_index('exact', ExactMatchIndex)
+    snapshot.get_index('search', ProductSearchIndex)
+    warm_up_match_cache(snapshot)
+    return snapshot
+
+def warm_up_match_cache(snapshot):
+    """Fill the match cache with the most recently used results of the match memo"""
+    match_cache.sync_versions(snapshot.catalog_version, snapshot.alias_version)
+    entries = match_memo.warm_up(snapshot.catalog_version, snapshot.alias_version, match_cache.max_size)
+    for cache_key, matched in entries:
+        match_cache.put(cache_key, matched)
+    print(f"Match cache warmed up with {len(entries)} memoized results")
+
 if __name__ == '__main__':
     # Adjust the path to be relative to the script's location
-    shared_dir = os.path.join(os.path.dirname(__file__), 'shared')
-    os.makedirs(shared_dir, exist_ok=True)
+    os.makedirs(SHARED_DIR, exist_ok=True)
     
     print("Starting Simple Invoice Agent Python Service...")
     print("Available endpoints:")
     print("  GET  /health - Health check")
     print("  POST /process-invoice - Basic invoice processing with exact matching")
+    print("  POST /process-invoices - Batch processing of many invoices in one request")
+    print("  GET  /search-products - Search the products matching a typed query")
+    print("  GET  /metrics - Prometheus metrics of the service")
+    print("This is the development server, use `gunicorn -c gunicorn.conf.py product_matching:app` in production")
     
+    # Fork the parallel matching pool before the server starts its threads
+    if match_pool.enabled:
+        warm_up()
+        match_pool.start()
+
     app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file
@@ -0,0 +1,349 @@
+"""
+Product and alias database stored in SQLite.
+
+`shared/product_db.sqlite3` replaces `product_db.csv` and `product_alias.csv` as
+the system of record once it exists. Products and aliases are indexed by
+product_id, product_name and alias_name, so a product or an alias is a point
+lookup, and aliases are upserted in one transaction instead of rewriting a file.
+The service matches aliases and checks the products of /update-alias with point
+lookups, and so does the Streamlit app when it looks products up. Basic and fuzzy
+matching compare an item with every product name, so the service still holds the
+catalog, memory-mapped from its snapshot and shared by every worker.
+Every write stamps a new version in the `meta` table in the same transaction,
+which is how the service notices changes made by any process.
+
+Columns are declared without a type, so values keep the type pandas gave them
+when reading the CSV. Blank values are stored as NULL.
+
+Run `python product_store.py migrate [shared_dir]` once to import the existing
+CSVs (alias journal included), and `python product_store.py export [shared_dir]`
+to write them back from the database, e.g. for tools that still read the CSVs.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import pandas as pd
+from alias_store import AliasStore, csv_value
+from catalog_snapshot import get_snapshot_path, write_snapshot
+from matching_methods import ProductCatalog
+from matching_methods.catalog import CATALOG_COLUMNS
+from matching_methods.normalize import normalize_key
+
+# Seconds to wait for another process's write to finish
+BUSY_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    row INTEGER PRIMARY KEY,
+    product_id,
+    product_name,
+    unit,
+    currency,
+    extra
+);
+CREATE INDEX IF NOT EXISTS products_product_id ON products (product_id);
+CREATE INDEX IF NOT EXISTS products_product_name ON products (product_name);
+CREATE TABLE IF NOT EXISTS aliases (
+    alias_name PRIMARY KEY,
+    alias_key TEXT NOT NULL,
+    product_id,
+    updated_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS aliases_alias_key ON aliases (alias_key, updated_at);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value
+);
+"""
+
+
+def get_database_path(shared_dir: str) -> str:
+    return os.path.join(shared_dir, 'product_db.sqlite3')
+
+
+def clean_value(value):
+    """Blank values are NaN in pandas and NULL in SQLite, use None for both"""
+    return None if isinstance(value, float) and value != value else value
+
+
+def get_product_id_variants(product_id) -> list:
+    """`product_id` as given, then as the number or text it stands for. None of them if it isn't an id."""
+    if isinstance(product_id, bool) or not isinstance(product_id, (str, int, float)):
+        return []
+    variants = [product_id, csv_value(product_id)]
+    if not isinstance(product_id, str):
+        variants.append(str(product_id))
+    return list(dict.fromkeys(variants))
+
+
+def clean_catalog(catalog: ProductCatalog) -> ProductCatalog:
+    """Copy of a catalog with None instead of NaN, i.e. with the values it reads back from the database"""
+    columns = {name: [clean_value(catalog.get(row, name)) for row in range(len(catalog))] for name in catalog.columns}
+    return ProductCatalog.from_columns(columns, len(catalog))
+
+
+class ProductStore:
+    """SQLite product and alias database, safe to use from several threads and processes"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Connection of the current thread, connections are never shared across threads or forks"""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    def _get_meta(self, connection: sqlite3.Connection, name: str, default=None):
+        row = connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else default
+
+    def _set_meta(self, connection: sqlite3.Connection, name: str, value):
+        connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+
+    # --- Versions ---
+
+    def catalog_signature(self):
+        """(stamp, rows) of the last product import, or None if there are no products yet"""
+        connection = self._connection()
+        stamp = self._get_meta(connection, 'catalog_stamp')
+        if stamp is None:
+            return None
+        return (stamp, self._get_meta(connection, 'catalog_rows', 0))
+
+    def alias_signature(self):
+        """(stamp, aliases) of the last alias write, or None if no alias was ever written"""
+        connection = self._connection()
+        stamp = self._get_meta(connection, 'alias_stamp')
+        if stamp is None:
+            return None
+        return (stamp, self._get_meta(connection, 'alias_count', 0))
+
+    # --- Products ---
+
+    def replace_products(self, catalog: ProductCatalog, stamp: int = None):
+        """Replace every product with the rows of `catalog` in one transaction"""
+        extra_names = [name for name in catalog.columns if name not in CATALOG_COLUMNS]
+        rows = []
+        for row in range(len(catalog)):
+            extra = {name: clean_value(catalog.get(row, name)) for name in extra_names}
+            rows.append((
+                row,
+                clean_value(catalog.product_ids[row]),
+                clean_value(catalog.product_names[row]),
+                clean_value(catalog.units[row]),
+                clean_value(catalog.currencies[row]),
+                json.dumps(extra, ensure_ascii=False) if extra else None
+            ))
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute("DELETE FROM products")
+            connection.executemany("INSERT INTO products VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._set_meta(connection, 'columns', json.dumps(list(catalog.columns), ensure_ascii=False))
+            self._set_meta(connection, 'catalog_rows', len(rows))
+            self._set_meta(connection, 'catalog_stamp', stamp or time.time_ns())
+
+    def load_catalog(self) -> ProductCatalog:
+        """
+        Load every product as a columnar catalog, in the order they were imported.
+        Raises FileNotFoundError if no product was imported yet.
+        """
+        connection = self._connection()
+        # Read the products and the columns they were imported with in one transaction
+        with connection:
+            connection.execute('BEGIN')
+            columns = self._get_meta(connection, 'columns')
+            if columns is None:
+                raise FileNotFoundError(f"No products imported into {self.path}")
+            rows = connection.execute(
+                "SELECT product_id, product_name, unit, currency, extra FROM products ORDER BY row"
+            ).fetchall()
+        columns = json.loads(columns)
+        values = {
+            'product_id': [row[0] for row in rows],
+            'product_name': [row[1] for row in rows],
+            'unit': [row[2] for row in rows],
+            'currency': [row[3] for row in rows],
+        }
+        extras = [json.loads(row[4]) if row[4] else {} for row in rows]
+        for name in columns:
+            if name not in values:
+                values[name] = [extra.get(name) for extra in extras]
+        return ProductCatalog.from_columns({name: values[name] for name in columns}, len(rows))
+
+    def _records(self, query: str, params: tuple) -> list[dict]:
+        connection = self._connection()
+        columns = json.loads(self._get_meta(connection, 'columns') or '[]') or list(CATALOG_COLUMNS)
+        records = []
+        for product_id, product_name, unit, currency, extra in connection.execute(query, params):
+            record = {'product_id': product_id, 'product_name': product_name, 'unit': unit, 'currency': currency,
+                      **(json.loads(extra) if extra else {})}
+            records.append({name: record.get(name) for name in columns})
+        return records
+
+    def find_product(self, product_id) -> dict:
+        """
+        Return the product with `product_id`, or None. The last row wins on duplicates, like ProductCatalog.find.
+        An id posted as text finds the number it stands for, e.g. "1002" finds 1002, and the other way round.
+        """
+        for candidate in get_product_id_variants(product_id):
+            records = self._records(
+                "SELECT product_id, product_name, unit, currency, extra FROM products "
+                "WHERE product_id = ? ORDER BY row DESC LIMIT 1", (candidate,)
+            )
+            if records:
+                return records[0]
+        return None
+
+    def find_products_by_name(self, product_name: str) -> list[dict]:
+        """Return the products named exactly `product_name`, e.g. the same product in different units"""
+        return self._records(
+            "SELECT product_id, product_name, unit, currency, extra FROM products "
+            "WHERE product_name = ? ORDER BY row", (product_name,)
+        )
+
+    # --- Aliases ---
+
+    def lookup_alias(self, name: str):
+        """Return the product_id an item name is an alias of, or None"""
+        row = self._connection().execute(
+            "SELECT product_id FROM aliases WHERE alias_key = ? ORDER BY updated_at DESC LIMIT 1",
+            (normalize_key(name),)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def lookup_map(self) -> dict:
+        """Return the {normalized alias_name: product_id} map, the latest alias wins on equal keys"""
+        rows = self._connection().execute("SELECT alias_key, product_id FROM aliases ORDER BY updated_at")
+        return dict(rows)
+
+    def aliases(self) -> list[tuple]:
+        """Return every (alias_name, product_id) pair, in the order they were last written"""
+        return self._connection().execute(
+            "SELECT alias_name, product_id FROM aliases ORDER BY updated_at"
+        ).fetchall()
+
+    def upsert(self, aliases: list[tuple]) -> int:
+        """
+        Add or update (alias_name, product_id) pairs in one transaction.
+        Only new aliases and aliases pointing to a different product are written.
+        Returns the number of aliases written.
+        """
+        connection = self._connection()
+        with connection:
+            # Take the write lock first, so the aliases can't change between the lookups and the writes
+            connection.execute('BEGIN IMMEDIATE')
+            # Later pairs win, like later writes
+            updated_at = max(time.time_ns(), (connection.execute(
+                "SELECT MAX(updated_at) FROM aliases").fetchone()[0] or 0) + 1)
+            written = 0
+            for alias_name, product_id in aliases:
+                row = connection.execute("SELECT product_id FROM aliases WHERE alias_name = ?",
+                                         (alias_name,)).fetchone()
+                if row is not None and row[0] == product_id:
+                    continue
+                connection.execute(
+                    "INSERT INTO aliases VALUES (?, ?, ?, ?) ON CONFLICT (alias_name) DO UPDATE SET "
+                    "product_id = excluded.product_id, updated_at = excluded.updated_at",
+                    (alias_name, normalize_key(str(alias_name)), product_id, updated_at)
+                )
+                updated_at += 1
+                written += 1
+            if written:
+                self._set_meta(connection, 'alias_count',
+                               connection.execute("SELECT COUNT(*) FROM aliases").fetchone()[0])
+                self._set_meta(connection, 'alias_stamp', updated_at)
+        return written
+
+    # --- CSV migration and export ---
+
+    def import_csv(self, product_db_path: str, alias_db_path: str = None):
+        """
+        Import product_db.csv and product_alias.csv, with its journal, and write the catalog
+        snapshot of the imported products. Returns the number of products and aliases imported.
+        """
+        catalog = clean_catalog(ProductCatalog.from_csv(product_db_path))
+        import_catalog(self, catalog, get_snapshot_path(product_db_path))
+        aliases = AliasStore(alias_db_path).aliases() if alias_db_path else []
+        return len(catalog), self.upsert(aliases)
+
+    def export_csv(self, product_db_path: str, alias_db_path: str = None):
+        """Write the products and aliases to CSV files shaped like product_db.csv and product_alias.csv"""
+        catalog = self.load_catalog()
+        columns = {name: [catalog.get(row, name) for row in range(len(catalog))] for name in catalog.columns}
+        write_csv(pd.DataFrame(columns, columns=list(catalog.columns)), product_db_path)
+        if alias_db_path:
+            write_csv(pd.DataFrame(self.aliases(), columns=['alias_name', 'product_id']), alias_db_path)
+
+
+class DatabaseAliasStore:
+    """AliasStore interface over the aliases of a ProductStore"""
+
+    def __init__(self, product_store: ProductStore):
+        self.product_store = product_store
+
+    def signature(self):
+        return self.product_store.alias_signature()
+
+    def lookup_map(self) -> 'DatabaseAliasMap':
+        # Aliases are looked up one by one instead of copied into every process
+        return DatabaseAliasMap(self.product_store)
+
+    def upsert(self, aliases: list[tuple]) -> int:
+        return self.product_store.upsert(aliases)
+
+
+class DatabaseAliasMap:
+    """Read-only {normalized alias_name: product_id} map answering every lookup from the database"""
+
+    def __init__(self, product_store: ProductStore):
+        self.product_store = product_store
+
+    def get(self, key: str, default=None):
+        product_id = self.product_store.lookup_alias(key)
+        return default if product_id is None else product_id
+
+
+def import_catalog(product_store: ProductStore, catalog: ProductCatalog, snapshot_path: str):
+    """
+    Replace the products of the database with `catalog`.
+    The snapshot is written first and tagged with the new catalog version, so the
+    service memory-maps it as soon as it sees the new products.
+    """
+    stamp = time.time_ns()
+    write_snapshot(None, snapshot_path, catalog=catalog, source={'catalog_signature': [stamp, len(catalog)]})
+    product_store.replace_products(catalog, stamp)
+
+
+def write_csv(df: pd.DataFrame, path: str):
+    # Write to a new file and swap it in, readers never see a partial CSV
+    tmp_path = path + '.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('migrate', 'export'):
+        print("Usage: python product_store.py migrate|export [shared_dir]")
+        sys.exit(1)
+    shared_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(__file__) or '.', 'shared')
+    product_db_path = os.path.join(shared_dir, 'product_db.csv')
+    alias_db_path = os.path.join(shared_dir, 'product_alias.csv')
+    store = ProductStore(get_database_path(shared_dir))
+    if sys.argv[1] == 'migrate':
+        products, aliases = store.import_csv(product_db_path, alias_db_path)
+        print(f"Imported {products:,} products and {aliases:,} aliases into {store.path}")
+    else:
+        store.export_csv(product_db_path, alias_db_path)
+        print(f"Exported {store.path} to {product_db_path} and {alias_db_path}")
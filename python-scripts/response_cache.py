@@ -0,0 +1,180 @@
+"""
+Response cache for repeated submissions of the same request.
+
+n8n retries and double clicks on "Process Invoice" send the same payload
+again. Responses are keyed by a hash of the endpoint and the request body,
+kept for a limited time and bounded by their total size. Keys include the
+catalog and alias versions, and the cache is cleared as soon as a request sees
+new ones. Identical requests arriving while the first one is still being
+matched wait for it and share its response instead of matching again.
+Under gunicorn every worker keeps its own cache.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+
+
+def make_request_key(endpoint: str, data, catalog_version: str, alias_version: str) -> str:
+    """Hash the endpoint and the request body, ignoring the order of its keys"""
+    body = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    digest = hashlib.sha256()
+    for part in (endpoint, catalog_version, alias_version, body):
+        digest.update(part.encode('utf-8', 'surrogatepass'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class CachedResponse:
+    """Serialized response body, status and content type of a request"""
+
+    __slots__ = ('body', 'status', 'mimetype', 'cacheable', 'expires_at')
+
+    def __init__(self, body: bytes, status: int, mimetype: str, cacheable: bool = True):
+        self.body = body
+        self.status = status
+        self.mimetype = mimetype
+        # Responses depending on more than the request, e.g. a time budget, aren't stored
+        self.cacheable = cacheable
+        self.expires_at = None
+
+    @property
+    def size(self) -> int:
+        return len(self.body)
+
+
+class InFlight:
+    """A request being computed, identical requests wait for its response"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class ResponseCache:
+    """Thread-safe TTL cache of responses bounded by total body size, with request coalescing"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._bytes = 0
+        self._versions = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.ttl > 0
+
+    def sync_versions(self, catalog_version: str, alias_version: str):
+        """Drop every entry if the catalog or alias database changed since the last call"""
+        versions = (catalog_version, alias_version)
+        if versions == self._versions:
+            return
+        with self._lock:
+            if versions != self._versions:
+                self._entries.clear()
+                self._bytes = 0
+                self._versions = versions
+
+    def get_or_compute(self, key: str, compute) -> tuple[CachedResponse, str]:
+        """
+        Return the response for `key` and how it was served: 'hit', 'coalesced' or 'miss'.
+        On a miss `compute()` is called to build the CachedResponse, and identical
+        requests arriving meanwhile wait for it instead of computing it again.
+        """
+        with self._lock:
+            response = self._get(key)
+            if response is not None:
+                self.hits += 1
+                return response, 'hit'
+            flight = self._in_flight.get(key)
+            if flight is None:
+                flight = self._in_flight[key] = InFlight()
+                leader = True
+                self.misses += 1
+            else:
+                leader = False
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response, 'coalesced'
+
+        try:
+            flight.response = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+                if flight.response is not None:
+                    self._put(key, flight.response)
+            flight.done.set()
+        return flight.response, 'miss'
+
+    def _get(self, key: str):
+        """Return the live entry for `key`, dropping it if it expired. Call with the lock held"""
+        response = self._entries.get(key)
+        if response is None:
+            return None
+        if response.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def _put(self, key: str, response: CachedResponse):
+        """Store a response, evicting the least recently used ones beyond max_bytes. Call with the lock held"""
+        if not self.enabled or not response.cacheable or response.size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        response.expires_at = time.monotonic() + self.ttl
+        self._entries[key] = response
+        self._bytes += response.size
+        while self._bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        response = self._entries.pop(key)
+        self._bytes -= response.size
+
+    def invalidate(self):
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._versions = None
+
+    def reset_stats(self):
+        """Zero the cache counters"""
+        with self._lock:
+            self.hits = self.misses = self.coalesced = self.evictions = 0
+
+    def stats(self) -> dict:
+        """Get the cache counters"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,74 @@
+"""
+Startup self-benchmark run once by the gunicorn master.
+
+It sends a synthetic invoice built from the loaded catalog through the Flask
+test client for a short time, then reports the requests per second and the
+resident memory of the process. Workers report their own memory after fork,
+including how much of it is still shared with the master.
+"""
+
+import random
+import time
+from matching_methods import ProductCatalog
+
+
+def get_memory_usage() -> dict:
+    """
+    Return the resident memory of this process in MB (Linux only).
+    `shared_mb` counts the pages still shared with other processes, such as
+    the catalog pages inherited copy-on-write from the gunicorn master.
+    """
+    fields = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    fields[key] = int(value.split()[0])
+    except (OSError, ValueError):
+        return {}
+    shared_kb = fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0)
+    return {
+        'rss_mb': round(fields.get('Rss', 0) / 1024, 1),
+        'pss_mb': round(fields.get('Pss', 0) / 1024, 1),
+        'shared_mb': round(shared_kb / 1024, 1),
+    }
+
+
+def build_invoice(product_db: ProductCatalog, n_items: int = 20, seed: int = 0) -> dict:
+    """Build an invoice from catalog names, dropping a character from some to force fuzzy work"""
+    rng = random.Random(seed)
+    names = [name for name in product_db.product_names if isinstance(name, str)]
+    items = []
+    for name in rng.sample(names, min(n_items, len(names))):
+        if len(name) > 2 and rng.random() < 0.5:
+            i = rng.randrange(len(name))
+            name = name[:i] + name[i + 1:]
+        items.append({'product_name': name, 'quantity': 1, 'unit_price': 100, 'subtotal': 100})
+    return {'invoice_number': 'self-benchmark', 'items': items}
+
+
+def run_self_benchmark(app, product_db: ProductCatalog, seconds: float = 1.0, match_method: str = 'fuzzy',
+                       before_request=None) -> dict:
+    """
+    Post the synthetic invoice to /process-invoice for `seconds` and measure throughput.
+    `before_request` is called before every request, e.g. to clear caches.
+    """
+    client = app.test_client()
+    payload = {'invoice_data': build_invoice(product_db), 'match_method': match_method}
+    requests_count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        if before_request is not None:
+            before_request()
+        response = client.post('/process-invoice', json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"Self-benchmark request failed with status {response.status_code}")
+        requests_count += 1
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': requests_count,
+        'requests_per_second': round(requests_count / elapsed, 1),
+        **get_memory_usage(),
+    }
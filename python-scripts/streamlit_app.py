@@ -1,9 +1,25 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
 import json
 import requests
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from matching_methods.catalog import ProductCatalog
+from product_store import ProductStore, get_database_path
+
+# Seconds to wait for a connection to n8n, and for its response
+CONNECT_TIMEOUT = 10
+PROCESS_TIMEOUT = 300
+UPLOAD_TIMEOUT = 60
+SEARCH_TIMEOUT = 10
+# Number of products a product search returns
+SEARCH_LIMIT = 30
+# Session state kept when moving on to the next invoice
+PERSISTENT_KEYS = ('product_db', 'uploads')
 
 st.set_page_config(layout="wide")
 
@@ -29,6 +45,79 @@ def load_config():
 
 config = load_config()
 
+# --- Shared HTTP session ---
+class WebhookRetry(Retry):
+    """
+    Retry policy of the n8n requests. A POST isn't idempotent, a retried upload could
+    be stored twice, so it is only sent again when n8n refused it with 429 or 503 and
+    said when to come back with Retry-After. Connection errors are retried for every
+    method, the request never reached n8n.
+    """
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method.upper() == 'POST':
+            return has_retry_after and status_code in (429, 503)
+        return super().is_retry(method, status_code, has_retry_after)
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """
+    One pooled session for every request to n8n, shared by all browser sessions,
+    so connections are kept alive instead of opened for every call.
+    """
+    # Retry connection errors and busy or unreachable gateways with backoff (1s, 2s, 4s),
+    # POSTs only as described in WebhookRetry
+    # A read timeout isn't retried, the webhook may already have run
+    retry = WebhookRetry(
+        total=3, connect=3, read=0, status=3,
+        backoff_factor=1,
+        status_forcelist=(429, 502, 503, 504),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# --- Background uploads ---
+@st.cache_resource
+def get_upload_executor() -> ThreadPoolExecutor:
+    """Threads uploading the finalized invoices, so the reviewer can go on with the next one"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix='upload')
+
+def upload_invoice(webhook_url: str, final_data: dict) -> str:
+    """Send a finalized invoice to the n8n upload webhook, runs in an upload thread"""
+    response = get_http_session().post(
+        webhook_url,
+        data=json.dumps(final_data),
+        headers={'Content-Type': 'application/json'},
+        timeout=(CONNECT_TIMEOUT, UPLOAD_TIMEOUT)
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code} {response.reason}: {response.text}")
+    return response.text
+
+def show_uploads():
+    """Show the status of the uploads started in this browser session"""
+    uploads = st.session_state.get('uploads', [])
+    if not uploads:
+        return
+    st.subheader("Uploads")
+    for upload in reversed(uploads):
+        future = upload['future']
+        if not future.done():
+            st.info(f"Uploading `{upload['file_name']}`...")
+        elif future.exception() is not None:
+            st.error(f"Failed to upload `{upload['file_name']}`: {future.exception()}")
+        else:
+            st.success(f"Uploaded `{upload['file_name']}` to the database.")
+
+with st.sidebar:
+    # Poll the uploads while any of them is still running
+    pending_uploads = any(not upload['future'].done() for upload in st.session_state.get('uploads', []))
+    st.fragment(show_uploads, run_every=2 if pending_uploads else None)()
+
 if not config:
     st.stop()
 
@@ -40,21 +129,181 @@ st.info("""
 """)
 
 # --- Load Product Database from a fixed path ---
-@st.cache_data
+# Loaded once and shared, it is never modified
+@st.cache_resource
 def load_product_db():
     # Path relative to the script location
     script_dir = os.path.dirname(__file__)
     db_path = os.path.join(script_dir, "shared", "product_db.csv")
+    store = get_product_store()
     try:
-        df = pd.read_csv(db_path)
-        return df.to_dict(orient='records')
+        if store is not None:
+            return store.load_catalog()
+        # Columnar catalog, much smaller than one dict per product
+        return ProductCatalog.from_csv(db_path)
     except FileNotFoundError:
         st.error(f"Error: Product database not found at `{db_path}`. Please ensure the file exists.")
         return None
 
-product_db = load_product_db()
-if product_db:
-    st.session_state.product_db = product_db
+@st.cache_resource
+def open_product_store(path: str) -> ProductStore:
+    return ProductStore(path)
+
+def get_product_store():
+    """
+    The product database once the CSVs were migrated to it (see product_store.py), or None.
+    Products are then looked up in it one at a time instead of loading the whole catalog.
+    """
+    path = get_database_path(os.path.join(os.path.dirname(__file__), "shared"))
+    return open_product_store(path) if os.path.exists(path) else None
+
+# Without the product database, products are looked up in the loaded catalog
+if get_product_store() is None:
+    product_db = load_product_db()
+    if product_db:
+        st.session_state.product_db = product_db
+
+@st.cache_resource
+def get_product_options():
+    """
+    Sorted product names for the dropdown and a product_name -> row map for quick lookups.
+    Built once per catalog instead of on every rerun.
+    """
+    catalog = load_product_db() or ProductCatalog.from_records([])
+    product_db_map = {name: row for row, name in enumerate(catalog.product_names)}
+    return sorted(name for name in product_db_map if isinstance(name, str) and name), product_db_map
+
+def find_product(product_id) -> dict:
+    """The product with `product_id`, or None"""
+    store = get_product_store()
+    if store is not None:
+        return store.find_product(product_id)
+    catalog = load_product_db() or ProductCatalog.from_records([])
+    row = catalog.find(product_id)
+    return catalog.record(row) if row is not None else None
+
+def find_product_by_name(product_name: str) -> dict:
+    """The product picked by its name in the table, the last one wins on equal names, or None"""
+    store = get_product_store()
+    if store is not None:
+        products = store.find_products_by_name(product_name)
+        return products[-1] if products else None
+    catalog = load_product_db() or ProductCatalog.from_records([])
+    row = get_product_options()[1].get(product_name)
+    return catalog.record(row) if row is not None else None
+
+# --- Review table ---
+def highlight_review_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """Styler function to highlight the rows to review, for the whole table at once"""
+    colors = np.where(df['status'] == 'Review Required', 'background-color: #FFF3CD', 'background-color: ')
+    return pd.DataFrame(np.repeat(colors[:, None], df.shape[1], axis=1), index=df.index, columns=df.columns)
+
+def keep_pending_edits():
+    """
+    Move the edits the editor still holds into the table data. Call it before anything
+    that makes the editor start over, e.g. new dropdown options, or the edits are lost.
+    """
+    if 'current_df' in st.session_state:
+        st.session_state.edited_df = st.session_state.current_df
+
+def recompute_edited_rows(df_before: pd.DataFrame, edited_df: pd.DataFrame,
+                          editor_state: dict) -> tuple[pd.DataFrame, bool]:
+    """
+    Update the dependent columns of the rows changed in the editor, found from its edit state.
+    Rows whose product changed get the product details, every changed row gets its subtotal.
+    Returns the updated dataframe and whether any dependent value changed, i.e. the table must be redrawn.
+    """
+    # Edited rows are given by their position in the dataframe passed to the editor
+    edited_rows = {df_before.index[int(position)]: changes
+                   for position, changes in (editor_state.get('edited_rows') or {}).items()}
+    # Rows added in the editor are the ones it returns that weren't passed to it
+    added_labels = edited_df.index.difference(df_before.index)
+    product_labels = pd.Index([label for label, changes in edited_rows.items() if 'matched_name' in changes])
+    product_labels = product_labels.append(added_labels).intersection(edited_df.index)
+    labels = pd.Index(list(edited_rows)).append(added_labels).unique().intersection(edited_df.index)
+    if labels.empty:
+        return edited_df, False
+    rows_before = edited_df.loc[labels].copy()
+
+    if not product_labels.empty:
+        names = edited_df.loc[product_labels, 'matched_name']
+        is_selected = names.notna().to_numpy()
+        selected_products = [find_product_by_name(name) or {} for name in names[is_selected]]
+        selected_labels = product_labels[is_selected]
+        # Product deselected or it's a new empty row
+        edited_df.loc[product_labels[~is_selected], 'product_id'] = None
+        edited_df.loc[product_labels[~is_selected], 'status'] = 'Review Required'
+        # For new rows, some fields will be NaN. Let's not set them to 0 yet.
+        empty_new_labels = added_labels.difference(selected_labels)
+        if not empty_new_labels.empty:
+            edited_df.loc[empty_new_labels, 'unit'] = None
+            edited_df.loc[empty_new_labels, 'unit_price'] = 0.0
+        # A product is selected, so update its details from the DB
+        if not selected_labels.empty:
+            edited_df.loc[selected_labels, 'product_id'] = [product.get('product_id') for product in selected_products]
+            edited_df.loc[selected_labels, 'unit'] = [product.get('unit') for product in selected_products]
+            # Assume product_db might have unit_price
+            edited_df.loc[selected_labels, 'unit_price'] = [product.get('unit_price', 0.0) for product in selected_products]
+            edited_df.loc[selected_labels, 'status'] = 'Matched'
+
+    # Always recalculate subtotal
+    quantity = pd.to_numeric(edited_df.loc[labels, 'quantity'], errors='coerce')
+    unit_price = pd.to_numeric(edited_df.loc[labels, 'unit_price'], errors='coerce')
+    edited_df.loc[labels, 'subtotal'] = (quantity * unit_price).fillna(0.0)
+
+    return edited_df, not edited_df.loc[labels].equals(rows_before)
+
+# --- Suggested products ---
+def get_item_suggestions(item: dict) -> list[dict]:
+    """
+    Ranked products suggested by the service for an unmatched item, best first.
+    Read from its compact suggestions, or from its possible matches in the full format.
+    """
+    if item.get('suggestions'):
+        return [{'product_id': product_id, 'matched_name': name, 'unit': unit, 'match_score': score}
+                for product_id, name, unit, score in item['suggestions']]
+    # Items without any candidate have [""] as possible matches
+    return [match for match in item.get('possible_matches') or [] if isinstance(match, dict)]
+
+def format_suggestion(suggestion: dict) -> str:
+    unit = f" / {suggestion['unit']}" if suggestion.get('unit') else ""
+    return f"{suggestion['matched_name']}{unit} ({suggestion['match_score']}%)"
+
+def apply_suggestion(label):
+    """Match a row of the table to the product picked from its suggestions"""
+    key = f"suggestion_{label}"
+    choice = st.session_state.get(key)
+    # Start from the latest state of the table, the edits the editor still holds included
+    df = st.session_state.get('current_df', st.session_state.edited_df).copy()
+    if choice is None or label not in df.index:
+        return
+    suggestion = st.session_state.row_suggestions[label][choice]
+    # Look the product up by its id, products of different units can share a name
+    product = find_product(suggestion['product_id']) or {}
+    df.loc[label, 'product_id'] = suggestion['product_id']
+    df.loc[label, 'matched_name'] = suggestion['matched_name']
+    df.loc[label, 'unit'] = suggestion.get('unit')
+    df.loc[label, 'unit_price'] = product.get('unit_price', 0.0)
+    df.loc[label, 'status'] = 'Matched'
+    subtotal = (pd.to_numeric(df.loc[label, 'quantity'], errors='coerce')
+                * pd.to_numeric(df.loc[label, 'unit_price'], errors='coerce'))
+    df.loc[label, 'subtotal'] = 0.0 if pd.isna(subtotal) else subtotal
+    st.session_state.edited_df = df
+    # Clear the choice, the row isn't offered any more once it is matched
+    st.session_state[key] = None
+
+# --- Product search ---
+@st.cache_data(ttl=300, show_spinner=False)
+def search_product_names(search_url: str, query: str) -> list[str]:
+    """
+    Names of the products matching `query`, best first, from the service's /search-products.
+    Results are cached, so repeating a search doesn't call the service again.
+    Raises if the service can't be reached, failures aren't cached.
+    """
+    response = get_http_session().get(search_url, params={'q': query, 'limit': SEARCH_LIMIT},
+                                      timeout=(CONNECT_TIMEOUT, SEARCH_TIMEOUT))
+    response.raise_for_status()
+    return [result['product_name'] for result in response.json()['results']]
 
 # --- File Uploads ---
 st.header("Upload Invoice")
@@ -67,8 +316,8 @@ if invoice_file:
     if st.button("Process Invoice"):
         # Clear the last session state
         for key in list(st.session_state.keys()):
-            # Except for the product database
-            if key != 'product_db':
+            # Except for the product database and the running uploads
+            if key not in PERSISTENT_KEYS:
                 del st.session_state[key]
         # Clear the last processed data
         st.session_state.processed_data = None
@@ -81,7 +330,8 @@ if invoice_file:
         files = {"file": (invoice_file.name, invoice_file.getvalue(), invoice_file.type)}
         with st.spinner("Processing invoice via n8n... This may take a moment."):
             try:
-                response = requests.post(n8n_webhook_url, files=files, timeout=300)
+                response = get_http_session().post(n8n_webhook_url, files=files,
+                                                   timeout=(CONNECT_TIMEOUT, PROCESS_TIMEOUT))
                 response.raise_for_status()
                 # Get the response as a JSON object
                 processed_json = response.json()
@@ -207,34 +457,76 @@ if 'processed_data' in st.session_state:
         # Prepare data for the table on first run
         if 'edited_df' not in st.session_state:
             table_data = []
-            for item in invoice_data['items']:
+            # Output: {row label: suggested products}
+            row_suggestions = {}
+            for row, item in enumerate(invoice_data['items']):
                 item_copy = item.copy()
                 if item_copy.get('product_id') is None:
                     item_copy['status'] = 'Review Required'
+                    suggestions = get_item_suggestions(item_copy)
+                    if suggestions:
+                        row_suggestions[row] = suggestions
                 else:
                     item_copy['status'] = 'Matched'
                 table_data.append(item_copy)
             df = pd.DataFrame(table_data)
-            # The 'possible_matches' column can contain mixed types (lists of dicts, empty lists)
-            # which Arrow cannot serialize. We can safely drop it as it's not used in the UI.
-            if 'possible_matches' in df.columns:
-                df = df.drop(columns=['possible_matches'])
+            # The suggestion columns can contain mixed types (lists of dicts, empty lists)
+            # which Arrow cannot serialize. They are kept per row outside of the table instead.
+            df = df.drop(columns=[col for col in ('possible_matches', 'suggestions') if col in df.columns])
             st.session_state.edited_df = df
+            st.session_state.row_suggestions = row_suggestions
+        row_suggestions = st.session_state.get('row_suggestions') or {}
 
         # --- In-place Table Editing ---
 
         # 1. Prepare product list for dropdown
-        all_products = st.session_state.get('product_db', [])
-        product_names = [p['product_name'] for p in all_products if p.get('product_name')]
-        product_db_map = {p['product_name']: p for p in all_products}
-
-        # Styler function to highlight rows
-        def highlight_review_rows(row):
-            color = '#FFF3CD' if row.status == 'Review Required' else ''
-            return [f'background-color: {color}' for _ in row]
-        
-        # Keep a copy of the dataframe before editing
-        df_before_edit = st.session_state.edited_df.copy()
+        # Products suggested by the service come first in the dropdown, in their rank order
+        suggested_names = list(dict.fromkeys(
+            suggestion['matched_name'] for suggestions in row_suggestions.values() for suggestion in suggestions
+        ))
+
+        search_url = config.get("PRODUCT_SEARCH_URL")
+        found_names = []
+        if search_url:
+            # With the search service, the dropdown only offers the products found by the search
+            # and the ones already matched, instead of shipping the whole catalog on every rerun.
+            # The text input only reruns on Enter or when it loses focus, which debounces the lookups.
+            search_query = st.text_input(
+                "Search products",
+                key="product_search",
+                placeholder="Type a product name and press Enter",
+                # New options make the editor start over
+                on_change=keep_pending_edits,
+                help="Matching products are added to the options of the Matched Product column."
+            ).strip()
+            if search_query:
+                try:
+                    found_names = search_product_names(search_url, search_query)
+                    st.caption(f"Found {len(found_names)} products for `{search_query}`, "
+                               "pick one in the Matched Product column.")
+                except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    st.warning(f"Product search is unavailable: {e}")
+                    search_url = None
+        # Without the search service the dropdown offers the whole catalog, unless there are
+        # suggestions to pick from, then the catalog is only shipped on every rerun when asked for
+        show_catalog = not search_url and st.checkbox(
+            "Offer every catalog product",
+            value=not suggested_names,
+            key="show_catalog",
+            # New options make the editor start over
+            on_change=keep_pending_edits,
+            help="Otherwise the Matched Product column only offers the suggested and the matched products."
+        )
+        if show_catalog:
+            # Only offering every product needs the whole catalog
+            sorted_product_names, _ = get_product_options()
+            suggested = set(suggested_names)
+            product_options = suggested_names + [name for name in sorted_product_names if name not in suggested]
+        else:
+            matched_names = st.session_state.edited_df.get('matched_name', pd.Series(dtype=object))
+            product_options = list(dict.fromkeys(suggested_names + sorted(set(found_names) | {
+                name for name in matched_names.dropna() if isinstance(name, str) and name
+            })))
 
         # Define columns to display and their order
         display_cols = [
@@ -246,7 +538,7 @@ if 'processed_data' in st.session_state:
         existing_display_cols = [col for col in display_cols if col in st.session_state.edited_df.columns]
 
         edited_df = st.data_editor(
-            st.session_state.edited_df.style.apply(highlight_review_rows, axis=1),
+            st.session_state.edited_df.style.apply(highlight_review_rows, axis=None),
             column_config={
                 "status": st.column_config.TextColumn("Status", disabled=True),
                 "product_id": st.column_config.TextColumn("Product ID", disabled=True),
@@ -254,7 +546,7 @@ if 'processed_data' in st.session_state:
                 "matched_name": st.column_config.SelectboxColumn(
                     "Matched Product",
                     help="Select the correct product from the database.",
-                    options=sorted(product_names),
+                    options=product_options,
                     required=False,
                 ),
                 "quantity": st.column_config.NumberColumn("Quantity", format="%d"),
@@ -270,41 +562,38 @@ if 'processed_data' in st.session_state:
             key="product_editor"
         )
         
-        # Detect changes and update dependent columns
-        if not edited_df.equals(df_before_edit):
-            # On any change, re-process the entire dataframe to update derived values
-            for i in edited_df.index:
-                selected_product_name = edited_df.loc[i, 'matched_name']
-                
-                if pd.isna(selected_product_name) or selected_product_name is None:
-                    # Product deselected or it's a new empty row
-                    edited_df.loc[i, 'product_id'] = None
-                    edited_df.loc[i, 'status'] = 'Review Required'
-                    # For new rows, some fields will be NaN. Let's not set them to 0 yet.
-                    is_new_row = i not in df_before_edit.index
-                    if is_new_row:
-                        edited_df.loc[i, 'unit'] = None
-                        edited_df.loc[i, 'unit_price'] = 0.0
-                else:
-                    # A product is selected, so update its details from the DB
-                    selected_product_details = product_db_map.get(selected_product_name, {})
-                    edited_df.loc[i, 'product_id'] = selected_product_details.get('product_id')
-                    edited_df.loc[i, 'unit'] = selected_product_details.get('unit')
-                    # Assume product_db might have unit_price
-                    unit_price = selected_product_details.get('unit_price', 0.0)
-                    edited_df.loc[i, 'unit_price'] = unit_price
-                    edited_df.loc[i, 'status'] = 'Matched'
-
-                # Always recalculate subtotal
-                quantity = edited_df.loc[i, 'quantity']
-                unit_price = edited_df.loc[i, 'unit_price']
-                if pd.notna(quantity) and pd.notna(unit_price):
-                    edited_df.loc[i, 'subtotal'] = float(quantity) * float(unit_price)
-                else:
-                    edited_df.loc[i, 'subtotal'] = 0.0
-
-            st.session_state.edited_df = edited_df
-            st.rerun()
+        # Detect changes from the editor's edit state and only update the changed rows
+        editor_state = st.session_state.get('product_editor') or {}
+        if any(editor_state.get(key) for key in ('edited_rows', 'added_rows', 'deleted_rows')):
+            edited_df, needs_redraw = recompute_edited_rows(
+                st.session_state.edited_df, edited_df, editor_state
+            )
+            # The editor only shows the values it was given, so redraw it if a dependent value changed.
+            # Other edits stay in the editor's state, replacing its data would drop the next edit.
+            if needs_redraw:
+                st.session_state.edited_df = edited_df
+                st.rerun()
+        # Latest state of the table, including the edits kept by the editor
+        st.session_state.current_df = edited_df
+
+        # Per-row lists of the products suggested for the rows to review
+        review_labels = [label for label in edited_df.index[edited_df['status'] == 'Review Required']
+                         if label in row_suggestions]
+        if review_labels:
+            with st.expander("Suggested products", expanded=True):
+                st.caption("The best matches found for the rows to review, pick one to match its row.")
+                for label in review_labels:
+                    suggestions = row_suggestions[label]
+                    st.selectbox(
+                        f"Row {label}: {edited_df.at[label, 'original_name']}",
+                        options=range(len(suggestions)),
+                        index=None,
+                        format_func=lambda choice, suggestions=suggestions: format_suggestion(suggestions[choice]),
+                        placeholder="Choose a suggested product",
+                        key=f"suggestion_{label}",
+                        on_change=apply_suggestion,
+                        args=(label,)
+                    )
 
     else:
         st.info("No items were extracted from the invoice.")
@@ -313,7 +602,7 @@ if 'processed_data' in st.session_state:
         # Copy the processed data
         final_data = st.session_state.processed_data.copy()
         # Use the final state of the dataframe from session state
-        final_items_df = st.session_state.edited_df.copy()
+        final_items_df = st.session_state.get('current_df', st.session_state.edited_df).copy()
         # Convert dataframe to a list of dicts for the final JSON
         final_items = final_items_df.to_dict(orient='records')
         # Clean up NaN values for JSON serialization and add other final details
@@ -338,7 +627,6 @@ if 'processed_data' in st.session_state:
             cleaned_item.setdefault('original_name', cleaned_item.get('matched_name'))
 
             if cleaned_item.get('matched_name'):
-                selection = product_db_map.get(cleaned_item['matched_name'], {})
                 cleaned_item['match_score'] = 100
             else:
                 cleaned_item['match_score'] = 0
@@ -380,31 +668,15 @@ if 'final_data' in st.session_state:
                 st.error("N8N_GDRIVE_UPLOAD_WEBHOOK not found in config.json.")
                 st.stop()
             
-            with st.spinner("Uploading to database via n8n..."):
-                try:
-                    headers = {'Content-Type': 'application/json'}
-                    response = requests.post(
-                        n8n_gdrive_webhook_url,
-                        data=json.dumps(st.session_state.final_data),
-                        headers=headers,
-                        timeout=60
-                    )
-                    response.raise_for_status()
-                    # If the response is 200, then the file is uploaded to the database
-                    if response.status_code == 200:
-                        st.success("Successfully uploaded to the database!")
-                    else:
-                        st.error(f"Failed to upload to database: {response.text}")
-                except requests.exceptions.RequestException as e:
-                    st.error(f"Failed to upload to database: {e}")
-                    try:
-                        st.error(f"Response content: {response.text}")
-                    except NameError:
-                        pass # response object may not exist
+            # Upload in the background, its status is shown in the sidebar
+            final_data = json.loads(json.dumps(st.session_state.final_data))
+            future = get_upload_executor().submit(upload_invoice, n8n_gdrive_webhook_url, final_data)
+            st.session_state.setdefault('uploads', []).append({'file_name': file_name, 'future': future})
+            st.rerun()
     with col3:
         if st.button("Upload the next file"):
-            # Clear the session state to allow for a new upload, preserving the product DB
+            # Clear the session state to allow for a new upload, preserving the product DB and the uploads
             for key in list(st.session_state.keys()):
-                if key != 'product_db':
+                if key not in PERSISTENT_KEYS:
                     del st.session_state[key]
             st.rerun() 
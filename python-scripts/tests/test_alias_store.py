@@ -0,0 +1,55 @@
+"""
+Aliases written to the journal must match the catalog before the journal is compacted into the CSV.
+
+Run from python-scripts/ with: python -m pytest tests
+"""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alias_store import AliasStore
+from matching_methods import ProductCatalog, alias_match_item
+
+CATALOG = ProductCatalog.from_records([
+    {'product_id': 1001, 'product_name': '豬皮', 'unit': '斤'},
+    {'product_id': 1002, 'product_name': '高麗菜', 'unit': '斤'},
+])
+
+
+def make_store(tmp_path) -> AliasStore:
+    csv_path = tmp_path / 'product_alias.csv'
+    csv_path.write_text('alias_name,product_id\n豬肉皮,1001\n', encoding='utf-8')
+    return AliasStore(str(csv_path))
+
+
+def test_journaled_alias_matches_before_compaction(tmp_path):
+    # The product_id comes as a JSON string from /update-alias, the catalog ids are numbers
+    assert make_store(tmp_path).upsert([('包心菜', '1002')]) == 1
+    entry = json.loads((tmp_path / 'product_alias.journal').read_text(encoding='utf-8'))
+    assert entry == {'alias_name': '包心菜', 'product_id': 1002}
+
+    # Read back by another process, from the CSV and the journal
+    alias_map = make_store(tmp_path).lookup_map()
+    item = alias_match_item({'product_name': '包心菜'}, alias_map, CATALOG)
+    assert item['product_id'] == 1002 and item['matched_name'] == '高麗菜'
+
+
+def test_same_alias_with_id_as_text_is_unchanged(tmp_path):
+    store = make_store(tmp_path)
+    assert store.upsert([('豬肉皮', '1001'), ('包心菜', 1002)]) == 1
+    assert store.upsert([('包心菜', '1002')]) == 0
+
+
+def test_text_ids_are_kept(tmp_path):
+    store = make_store(tmp_path)
+    store.upsert([('蘋果', 'P0002')])
+    assert make_store(tmp_path).lookup_map()['蘋果'] == 'P0002'
+
+
+def test_untyped_journal_entries_are_typed_on_replay(tmp_path):
+    (tmp_path / 'product_alias.journal').write_text(
+        json.dumps({'alias_name': '包心菜', 'product_id': '1002'}, ensure_ascii=False) + '\n', encoding='utf-8')
+    assert make_store(tmp_path).lookup_map()['包心菜'] == 1002
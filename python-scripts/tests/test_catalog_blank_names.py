@@ -0,0 +1,67 @@
+"""
+Catalog rows whose product name is blank, "NA" or "null" are read from the CSV as NaN.
+They must be skipped by the matching indexes instead of failing the snapshot or the import.
+
+Run from python-scripts/ with: python -m pytest tests
+"""
+
+import importlib.util
+import os
+import sys
+import pytest
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT_DIR = os.path.dirname(SCRIPTS_DIR)
+sys.path.insert(0, SCRIPTS_DIR)
+
+from catalog_snapshot import load_snapshot, write_snapshot
+from matching_methods import BasicMatchIndex, ProductCatalog, basic_matching
+
+CSV = 'product_id,product_name,unit,currency\nP1,富士蘋果,KG,TWD\nP2,,斤,TWD\nP3,NA,斤,TWD\nP4,null,斤,TWD\nP5,高麗菜,斤,TWD\n'
+
+
+@pytest.fixture
+def product_db_path(tmp_path):
+    path = tmp_path / 'product_db.csv'
+    path.write_text(CSV, encoding='utf-8')
+    return str(path)
+
+
+def test_basic_index_skips_nan_names(product_db_path):
+    catalog = ProductCatalog.from_csv(product_db_path)
+    assert isinstance(catalog.product_names[1], float)
+    index = BasicMatchIndex(catalog)
+    items = basic_matching({'items': [{'product_name': '高麗菜'}, {'product_name': 'NA'}]}, catalog, index)['items']
+    assert [item['product_id'] for item in items] == ['P5', None]
+
+
+def test_snapshot_of_catalog_with_nan_names(product_db_path, tmp_path):
+    snapshot_path = write_snapshot(product_db_path, str(tmp_path / 'product_db.snapshot'))
+    catalog, indexes = load_snapshot(snapshot_path, product_db_path)
+    assert len(catalog) == 5
+    assert indexes['basic'].product_map.get('富士蘋果') == 0
+
+
+def test_converter_removes_tmp_csv_when_snapshot_fails(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT_DIR)
+    spec = importlib.util.spec_from_file_location('excel_converter', os.path.join(ROOT_DIR, 'utils', 'excel_converter.py'))
+    excel_converter = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(excel_converter)
+    csv_path = tmp_path / 'product_db.csv'
+    csv_path.write_text('old', encoding='utf-8')
+
+    def convert(excel_path, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(CSV)
+        return {'rows_read': 5}
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('snapshot failed')
+
+    monkeypatch.setattr(excel_converter, 'CSV_PATH', str(csv_path))
+    monkeypatch.setattr(excel_converter, 'convert_streaming', convert)
+    monkeypatch.setattr(excel_converter, 'write_snapshot', fail)
+    with pytest.raises(RuntimeError):
+        excel_converter.main()
+    assert csv_path.read_text(encoding='utf-8') == 'old'
+    assert not os.path.exists(str(csv_path) + '.tmp')
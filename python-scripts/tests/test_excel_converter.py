@@ -0,0 +1,104 @@
+"""
+The streaming conversion of utils/excel_converter.py must write the same CSV as
+pandas, and leave the workbooks it can't convert exactly to the pandas fallback.
+
+Run from python-scripts/ with: python -m pytest tests
+"""
+
+import datetime
+import importlib.util
+import os
+import sys
+import pytest
+from openpyxl import Workbook
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+spec = importlib.util.spec_from_file_location(
+    'excel_converter', os.path.join(os.path.dirname(SCRIPTS_DIR), 'utils', 'excel_converter.py'))
+excel_converter = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(excel_converter)
+
+HEADER = ['商品編號', '商品名稱', '單位', '幣別']
+
+WORKBOOKS = {
+    'text ids': [
+        ['J021010', '肉皮\\豬皮', '斤', 'TWD'],
+        ['J021011', '高麗菜', 'KG', 'TWD'],
+        ['J021010', '肉皮\\豬皮', '斤', 'TWD'],
+        ['J021012', None, '斤', None],
+        [None, None, None, None],
+        ['J021013', 'Pork Belly, "Skin-on"', '斤', 'TWD'],
+    ],
+    'int ids with blanks': [
+        [1001, '富士蘋果', 'KG', 'TWD'],
+        [None, '富士蘋果', '斤', 'TWD'],
+        [1003, '雞胸肉', 'KG', 'TWD'],
+        [1003, '雞胸肉', 'KG', 'TWD'],
+    ],
+    'floats and errors': [
+        [1.5, '蒜泥', 'KG', 'TWD'],
+        [2, '#N/A', 'KG', 'NA'],
+        [3, 'null', 'KG', 'TWD'],
+        [4.0, '青江菜', 'KG', 'TWD'],
+    ],
+    'int and text ids': [
+        [1001, '富士蘋果', 'KG', 'TWD'],
+        ['A100', '高麗菜', 'KG', 'TWD'],
+        [1001, '富士蘋果', 'KG', 'TWD'],
+    ],
+    'short rows and trailing blank rows': [
+        ['P1', '豬皮'],
+        ['P2', '高麗菜', 'KG', 'TWD'],
+        [None, None, None, None],
+        [None, None, None, None],
+    ],
+}
+
+FALLBACK_WORKBOOKS = {
+    'int and numeric text ids': [
+        [1001, '富士蘋果', 'KG', 'TWD'],
+        ['1002', '高麗菜', 'KG', 'TWD'],
+    ],
+    'huge int': [
+        [2 ** 70, '富士蘋果', 'KG', 'TWD'],
+        [1002, '高麗菜', 'KG', 'TWD'],
+    ],
+    'dates': [
+        ['P1', '富士蘋果', datetime.datetime(2024, 1, 2), 'TWD'],
+    ],
+    'booleans': [
+        ['P1', '富士蘋果', True, 'TWD'],
+    ],
+}
+
+
+def write_workbook(path, rows: list[list]):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(HEADER)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+def convert(tmp_path, rows: list[list]) -> tuple[bytes, bytes]:
+    """Return the CSVs written by the streaming and the pandas conversion"""
+    excel_path = str(tmp_path / 'product_dataset.xlsx')
+    write_workbook(excel_path, rows)
+    excel_converter.convert_streaming(excel_path, str(tmp_path / 'streaming.csv'))
+    excel_converter.convert_with_pandas(excel_path, str(tmp_path / 'pandas.csv'))
+    return (tmp_path / 'streaming.csv').read_bytes(), (tmp_path / 'pandas.csv').read_bytes()
+
+
+@pytest.mark.parametrize('name', WORKBOOKS)
+def test_streaming_matches_pandas(tmp_path, name):
+    streaming_csv, pandas_csv = convert(tmp_path, WORKBOOKS[name])
+    assert streaming_csv == pandas_csv
+
+
+@pytest.mark.parametrize('name', FALLBACK_WORKBOOKS)
+def test_unsupported_workbooks_fall_back_to_pandas(tmp_path, name):
+    with pytest.raises(excel_converter.UnsupportedWorkbook):
+        convert(tmp_path, FALLBACK_WORKBOOKS[name])
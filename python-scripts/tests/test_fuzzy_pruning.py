@@ -0,0 +1,71 @@
+"""
+The default "exact" pruning only skips products that can't reach the suggestion
+threshold, so it must return the same suggestions as scoring the whole catalog.
+
+Run from python-scripts/ with: python -m pytest tests
+"""
+
+import os
+import random
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matching_methods import FuzzyMatchIndex, ProductCatalog
+
+WORDS = ['豬', '皮', '肉', '雞', '胸', '腿', '高麗菜', '蘋果', '富士', '生菜', '蒜泥', '牛', '腱', '廣東', '青江菜',
+         '地瓜葉', '香菇', '金針菇', '豆腐', '鮭魚', '蝦仁', '花枝', '洋蔥', '紅蘿蔔', '馬鈴薯', '玉米', '番茄', '檸檬',
+         'Pork', 'Belly', 'Skin-on', 'Chicken', 'Apple', 'Fuji', 'Salmon', 'Shrimp', 'Tofu', 'Onion', 'Carrot',
+         'A', 'B2', '500g', '(大)', '/', '1KG']
+
+
+def make_name(rng: random.Random) -> str:
+    return (' ' if rng.random() < 0.3 else '').join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+
+
+def make_query(rng: random.Random, names: list[str]) -> str:
+    """A catalog name with typos, extra or missing words, or a made-up name"""
+    if rng.random() < 0.2:
+        return make_name(rng)
+    name = rng.choice(names)
+    for _ in range(rng.randint(0, 3)):
+        i = rng.randrange(len(name) + 1)
+        edit = rng.random()
+        if edit < 0.4 and len(name) > 1:
+            name = name[:i] + name[i + 1:]
+        elif edit < 0.7:
+            name = name[:i] + rng.choice(WORDS) + name[i:]
+        else:
+            name = name.upper() if rng.random() < 0.5 else ' ' + name + ' '
+    return name
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    rng = random.Random(4)
+    names = list(dict.fromkeys(make_name(rng) for _ in range(400)))
+    catalog = ProductCatalog.from_records([{'product_id': f'P{i:04d}', 'product_name': name}
+                                           for i, name in enumerate(names)])
+    queries = [make_query(rng, names) for _ in range(400)]
+    return FuzzyMatchIndex(catalog), queries
+
+
+def suggestions(candidates, scores, threshold: int) -> dict:
+    """{product index: score} of the products reaching the threshold"""
+    if candidates is None:
+        candidates = range(len(scores))
+    return {int(i): int(score) for i, score in zip(candidates, scores) if score >= threshold}
+
+
+# Pruning only starts above a threshold of 50
+@pytest.mark.parametrize('threshold', [55, 60, 85])
+def test_exact_pruning_matches_full_scan(dataset, threshold):
+    index, queries = dataset
+    stats = {}
+    pruned = index.score(queries, threshold, pruning='exact', workers=1, stats=stats)
+    full = index.score(queries, threshold, pruning='off', workers=1)
+    for query, (candidates, scores), (_, all_scores) in zip(queries, pruned, full):
+        assert suggestions(candidates, scores, threshold) == suggestions(None, all_scores, threshold), query
+    # Otherwise the test wouldn't exercise the pruning
+    assert stats['pruned'] > 0
@@ -0,0 +1,52 @@
+"""
+/metrics sums the metrics of every process sharing a directory, e.g. the gunicorn workers.
+
+Run from python-scripts/ with: python -m pytest tests
+"""
+
+import multiprocessing
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+
+
+def count_requests(text: str) -> int:
+    return sum(int(count) for count in re.findall(r'invoice_request_duration_seconds_count\{[^}]*\} (\d+)', text))
+
+
+def handle_requests(count: int):
+    for _ in range(count):
+        metrics.REQUEST_DURATION.observe(0.01, endpoint='/process-invoice', match_method='fuzzy')
+    # What gunicorn's worker_exit hook does
+    metrics.flush()
+
+
+def test_metrics_are_summed_over_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, '_directory', None)
+    monkeypatch.setattr(metrics, '_process_pid', None)
+    for metric in metrics.REGISTRY:
+        metric.reset()
+    metrics.use_shared_directory(str(tmp_path))
+    metrics.REQUEST_DURATION.observe(0.01, endpoint='/process-invoice', match_method='fuzzy')
+
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=handle_requests, args=(count,)) for count in (2, 3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # The workers don't report the value recorded by their parent before the fork
+    assert count_requests(metrics.render_metrics()) == 6
+
+    # Exited workers stay in the sums, as one file
+    for worker in workers:
+        metrics.mark_process_dead(worker.pid)
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith('.json')) == [metrics.EXITED_FILE]
+    assert count_requests(metrics.render_metrics()) == 6
+
+    for metric in metrics.REGISTRY:
+        metric.reset()
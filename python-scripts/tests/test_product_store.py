@@ -0,0 +1,73 @@
+"""
+Point lookups of the SQLite product database, and the service switching to it.
+
+Run from python-scripts/ with: python -m pytest tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog_store import CatalogStore
+from matching_methods import ProductCatalog, alias_match_item
+from product_store import ProductStore, DatabaseAliasStore, clean_catalog, get_database_path
+
+CSV = 'product_id,product_name,unit,currency,unit_price\n1001,豬皮,斤,TWD,80\n1002,高麗菜,斤,TWD,\n1003,高麗菜,KG,TWD,50\n'
+
+
+def make_store(tmp_path) -> ProductStore:
+    csv_path = tmp_path / 'product_db.csv'
+    csv_path.write_text(CSV, encoding='utf-8')
+    store = ProductStore(get_database_path(str(tmp_path)))
+    store.import_csv(str(csv_path))
+    return store
+
+
+def test_find_product(tmp_path):
+    store = make_store(tmp_path)
+    product = store.find_product(1001)
+    assert product == {'product_id': 1001, 'product_name': '豬皮', 'unit': '斤', 'currency': 'TWD', 'unit_price': 80.0}
+    # Ids posted as text find the numbers they stand for
+    assert store.find_product('1002')['product_name'] == '高麗菜'
+    assert store.find_product('P1') is None
+    assert store.find_product(['1001']) is None
+
+
+def test_find_products_by_name(tmp_path):
+    store = make_store(tmp_path)
+    assert [product['unit'] for product in store.find_products_by_name('高麗菜')] == ['斤', 'KG']
+    assert store.find_products_by_name('白菜') == []
+
+
+def test_aliases_are_looked_up_in_the_database(tmp_path):
+    store = make_store(tmp_path)
+    alias_store = DatabaseAliasStore(store)
+    assert alias_store.upsert([('包心菜', 1003)]) == 1
+    alias_map = alias_store.lookup_map()
+    assert alias_map.get('沒有') is None
+    item = alias_match_item({'product_name': ' 包心菜 '}, alias_map, store.load_catalog())
+    assert item['product_id'] == 1003 and item['unit'] == 'KG'
+    # Later aliases are seen without reloading the map
+    alias_store.upsert([('包心菜', 1002)])
+    assert alias_map.get('包心菜') == 1002
+
+
+def test_catalog_store_switches_to_a_database_migrated_while_running(tmp_path):
+    (tmp_path / 'product_db.csv').write_text(CSV, encoding='utf-8')
+    catalog_store = CatalogStore(str(tmp_path))
+    assert catalog_store.product_store is None
+    assert catalog_store.find_product('1003')['unit'] == 'KG'
+
+    # The database file exists before the migration imported the products
+    store = ProductStore(get_database_path(str(tmp_path)))
+    store.alias_signature()
+    catalog_store.get_snapshot()
+    assert catalog_store.product_store is None
+
+    catalog = clean_catalog(ProductCatalog.from_csv(str(tmp_path / 'product_db.csv')))
+    store.replace_products(catalog)
+    snapshot = catalog_store.get_snapshot()
+    assert isinstance(catalog_store.alias_store, DatabaseAliasStore)
+    assert snapshot.product_signature == store.catalog_signature()
+    assert catalog_store.find_product(1001)['product_name'] == '豬皮'
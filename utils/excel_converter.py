@@ -1,16 +1,283 @@
 # A script to convert the `product_dataset.xlsx` to `shared/product_db.csv`
+# and its binary snapshot `shared/product_db.snapshot`
+# If the CSVs were migrated to `shared/product_db.sqlite3`, the products are
+# imported into it too, the CSV is still written for the tools reading it
 # Please run this script in the root directory of the project
 # with command: python ./utils/excel_converter.py
+#
+# The workbook is streamed row by row with openpyxl's read-only mode instead of
+# being loaded whole with `pd.read_excel`, so ERP exports with hundreds of
+# thousands of rows convert in bounded memory. The first pass profiles the
+# columns and spools the rows to a temporary file, the second writes the CSV. The CSV is
+# byte-identical to what `pd.read_excel(...).drop_duplicates().to_csv(...)`
+# writes. Workbooks holding values whose conversion by pandas isn't replicated
+# here (dates, booleans, numbers stored as text, ...) are converted with pandas.
 
+import csv
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+import time
 import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
 
-# Convert `product_dataset.xlsx` to `shared/product_db.csv`
-df = pd.read_excel("./DB/product_dataset.xlsx")
-# Update the column names to match the expected format
-df.columns = ['product_id', 'product_name', 'unit', 'currency']
-# Remove duplicate rows
-df = df.drop_duplicates()
-# Save to CSV
-df.to_csv("./python-scripts/shared/product_db.csv", index=False)
+# The snapshot format is shared with the service
+sys.path.insert(0, "./python-scripts")
+from catalog_snapshot import get_snapshot_path, write_snapshot
+from matching_methods import ProductCatalog
+from product_store import ProductStore, clean_catalog, get_database_path, import_catalog
 
-print("Conversion complete!")
\ No newline at end of file
+EXCEL_PATH = "./DB/product_dataset.xlsx"
+CSV_PATH = "./python-scripts/shared/product_db.csv"
+COLUMNS = ['product_id', 'product_name', 'unit', 'currency']
+# Number of rows written to the CSV at once
+CHUNK_ROWS = 10000
+# Print progress every this many rows
+PROGRESS_ROWS = 50000
+
+# Strings pandas reads as NaN by default
+NA_STRINGS = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+              '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+# Strings pandas turns into booleans
+BOOL_STRINGS = {'True', 'TRUE', 'true', 'False', 'FALSE', 'false'}
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+# Placeholder for NaN in the dedupe keys
+NA = object()
+
+class UnsupportedWorkbook(Exception):
+    """The workbook holds values the streaming converter can't convert exactly like pandas"""
+
+def convert_cell(cell):
+    """Convert a cell the way pandas' openpyxl reader does"""
+    if cell.value is None:
+        return ""
+    elif cell.data_type == TYPE_ERROR:
+        return float('nan')
+    elif cell.data_type == TYPE_NUMERIC:
+        value = int(cell.value)
+        if value == cell.value:
+            return value
+        return float(cell.value)
+    return cell.value
+
+def is_na(value) -> bool:
+    return (isinstance(value, str) and value in NA_STRINGS) or (isinstance(value, float) and value != value)
+
+def is_plain_text(value: str) -> bool:
+    """Text pandas keeps as it is, i.e. not a number, a boolean or blank"""
+    if not value.strip() or value in BOOL_STRINGS:
+        return False
+    try:
+        float(value)
+    except ValueError:
+        return True
+    return False
+
+def iter_rows(path: str):
+    """Yield the converted cells of every row of the first sheet"""
+    workbook = load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook.worksheets[0]
+        sheet.reset_dimensions()
+        for row in sheet.rows:
+            converted_row = [convert_cell(cell) for cell in row]
+            # Trim trailing empty cells
+            while converted_row and converted_row[-1] == "":
+                converted_row.pop()
+            yield converted_row
+    finally:
+        workbook.close()
+
+class ColumnProfile:
+    """What pass 1 learned about one column, decides how pandas would type it"""
+
+    def __init__(self):
+        self.has_na = False
+        self.has_float = False
+        self.has_text = False
+        self.has_uncertain = False
+
+    def add(self, value):
+        if is_na(value):
+            self.has_na = True
+        elif isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            # Booleans, dates, times...
+            raise UnsupportedWorkbook(f"unsupported cell value {value!r}")
+        elif isinstance(value, int):
+            if not INT64_MIN <= value <= INT64_MAX:
+                raise UnsupportedWorkbook(f"integer {value} doesn't fit in 64 bits")
+        elif isinstance(value, float):
+            self.has_float = True
+        elif is_plain_text(value):
+            self.has_text = True
+        else:
+            # Numbers or booleans stored as text
+            self.has_uncertain = True
+
+    def kind(self) -> str:
+        """'object', 'int' or 'float', the dtype pandas gives the column"""
+        if self.has_text:
+            return 'object'
+        if self.has_uncertain:
+            raise UnsupportedWorkbook("numbers or booleans stored as text")
+        if self.has_na or self.has_float:
+            return 'float'
+        return 'int'
+
+def format_value(value, kind: str):
+    """Return (CSV field, dedupe key) of a value in a column of `kind`"""
+    if is_na(value):
+        return '', NA
+    if kind == 'float':
+        value = float(value)
+        return repr(value), value
+    return str(value), value
+
+def profile_workbook(path: str, spool):
+    """
+    Pass 1: find the width of the sheet, its last row with data and the type of each column.
+    The data rows are written to `spool`, so pass 2 doesn't have to parse the workbook again.
+    Raises UnsupportedWorkbook if the streaming conversion can't match pandas.
+    """
+    width = 0
+    last_row_with_data = -1
+    profiles = [ColumnProfile() for _ in COLUMNS]
+    # First data row missing the trailing cells of each column, they are read as NaN
+    # unless the row comes after the last row with data
+    first_missing = [None] * len(COLUMNS)
+    for row_number, row in enumerate(iter_rows(path)):
+        if row:
+            last_row_with_data = row_number
+        width = max(width, len(row))
+        if width > len(COLUMNS):
+            raise UnsupportedWorkbook(f"expected {len(COLUMNS)} columns, found {width}")
+        # The first row is the header
+        if row_number > 0:
+            for profile, value in zip(profiles, row):
+                profile.add(value)
+            marshal.dump(row, spool)
+            for i in range(len(row), len(COLUMNS)):
+                if first_missing[i] is None:
+                    first_missing[i] = row_number
+        if row_number and row_number % PROGRESS_ROWS == 0:
+            print(f"  Scanned {row_number:,} rows...")
+    if width != len(COLUMNS) or last_row_with_data < 0:
+        raise UnsupportedWorkbook(f"expected {len(COLUMNS)} columns, found {width}")
+    for profile, row_number in zip(profiles, first_missing):
+        if row_number is not None and row_number <= last_row_with_data:
+            profile.has_na = True
+    return last_row_with_data, [profile.kind() for profile in profiles]
+
+def convert_streaming(excel_path: str, csv_path: str) -> dict:
+    """
+    Convert the workbook to CSV in two streaming passes, dropping duplicate rows.
+    Returns the validation summary.
+    """
+    with tempfile.TemporaryFile() as spool:
+        print("Pass 1: profiling the columns...")
+        last_row_with_data, kinds = profile_workbook(excel_path, spool)
+        spool.seek(0)
+        print("Pass 2: writing the CSV...")
+        return write_csv(spool, last_row_with_data, kinds, csv_path)
+
+def write_csv(spool, last_row_with_data: int, kinds: list[str], csv_path: str) -> dict:
+    """Pass 2: write the spooled rows to the CSV in chunks, dropping duplicate rows"""
+    summary = {
+        'rows_read': 0,
+        'blank_rows': 0,
+        'duplicate_rows': 0,
+        'rows_written': 0,
+        **{f'missing_{column}': 0 for column in COLUMNS},
+        'conflicting_product_ids': 0,
+    }
+    seen_rows = set()
+    # product_ids written so far, to report the ones shared by different rows
+    seen_product_ids = set()
+    with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerow(COLUMNS)
+        chunk = []
+        # Rows after the last row with data are dropped, like pandas does
+        for _ in range(last_row_with_data):
+            row = marshal.load(spool)
+            summary['rows_read'] += 1
+            row = row + [""] * (len(COLUMNS) - len(row))
+            fields, keys = zip(*(format_value(value, kind) for value, kind in zip(row, kinds)))
+            if all(key is NA for key in keys):
+                summary['blank_rows'] += 1
+
+            # Dedupe through a hash set of row digests, like drop_duplicates keeping the first row
+            digest = hashlib.blake2b(repr([
+                None if key is NA else (type(key).__name__, key) for key in keys
+            ]).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+            if digest in seen_rows:
+                summary['duplicate_rows'] += 1
+                continue
+            seen_rows.add(digest)
+
+            for column, key in zip(COLUMNS, keys):
+                if key is NA:
+                    summary[f'missing_{column}'] += 1
+            if keys[0] is not NA:
+                if keys[0] in seen_product_ids:
+                    summary['conflicting_product_ids'] += 1
+                else:
+                    seen_product_ids.add(keys[0])
+
+            chunk.append(fields)
+            summary['rows_written'] += 1
+            if len(chunk) >= CHUNK_ROWS:
+                writer.writerows(chunk)
+                chunk = []
+            if summary['rows_read'] % PROGRESS_ROWS == 0:
+                print(f"  Converted {summary['rows_read']:,} rows...")
+        writer.writerows(chunk)
+    return summary
+
+def convert_with_pandas(excel_path: str, csv_path: str) -> dict:
+    """Convert the whole workbook in memory with pandas"""
+    df = pd.read_excel(excel_path)
+    # Update the column names to match the expected format
+    df.columns = COLUMNS
+    rows_read = len(df)
+    # Remove duplicate rows
+    df = df.drop_duplicates()
+    df.to_csv(csv_path, index=False)
+    return {'rows_read': rows_read, 'duplicate_rows': rows_read - len(df), 'rows_written': len(df)}
+
+def main():
+    start = time.time()
+    # Save to a temporary CSV first, so the service never sees the new CSV without its snapshot
+    tmp_path = CSV_PATH + ".tmp"
+    try:
+        summary = convert_streaming(EXCEL_PATH, tmp_path)
+    except UnsupportedWorkbook as e:
+        print(f"Falling back to pandas: {e}")
+        summary = convert_with_pandas(EXCEL_PATH, tmp_path)
+
+    database_path = get_database_path(os.path.dirname(CSV_PATH))
+    try:
+        if os.path.exists(database_path):
+            # Replace the products of the database in one transaction, with the snapshot of the new version
+            import_catalog(ProductStore(database_path), clean_catalog(ProductCatalog.from_csv(tmp_path)),
+                           get_snapshot_path(CSV_PATH))
+        else:
+            # Write the pre-normalized snapshot the service memory-maps instead of parsing the CSV
+            write_snapshot(tmp_path, get_snapshot_path(CSV_PATH))
+    except Exception:
+        # Leave the current CSV, snapshot and database as they are
+        os.remove(tmp_path)
+        print("Conversion failed, the product database was not updated.")
+        raise
+    os.replace(tmp_path, CSV_PATH)
+
+    print("Validation summary:")
+    for key, value in summary.items():
+        print(f"  {key}: {value:,}")
+    print(f"Conversion complete in {time.time() - start:.1f}s!")
+
+if __name__ == '__main__':
+    main()